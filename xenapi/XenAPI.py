@@ -54,17 +54,26 @@
 # OF THIS SOFTWARE.
 # --------------------------------------------------------------------
 
+import errno
 import gettext
 import xmlrpclib
 import httplib
+import Queue
+import select
 import socket
+import string
 import sys
+import threading
+import time
 
 translation = gettext.translation('xen-xm', fallback = True)
 
 API_VERSION_1_1 = '1.1'
 API_VERSION_1_2 = '1.2'
 
+# The maximum number of calls Session.batch() makes at the same time.
+BATCH_MAX_WORKERS = 8
+
 class Failure(Exception):
     def __init__(self, details):
         self.details = details
@@ -81,6 +90,12 @@ class Failure(Exception):
                      for i in range(len(self.details))])
 
 
+class Timeout(Exception):
+    """Raised when a call doesn't complete within its connect or read timeout,
+    or its deadline has already passed. Unlike a Failure, this doesn't come
+    from xapi: we gave up waiting for it."""
+
+
 # Just a "constant" that we use to decide whether to retry the RPC
 _RECONNECT_AND_RETRY = object()
 
@@ -112,6 +127,439 @@ class UDSTransport(xmlrpclib.Transport):
         for key, value in self._extra_headers:
             connection.putheader(key, value)
 
+class ProjectingUnmarshaller(xmlrpclib.Unmarshaller):
+    """An Unmarshaller that only keeps some of the fields of each record.
+
+    Records are the structs nested record_depth structs deep in the response
+    (2 for get_record, where the record is the Value of the response struct,
+    and 3 for get_all_records, where it's a Value in the map of refs to
+    records). Members of those structs whose names aren't in fields are
+    skipped as they're parsed, so none of their values are ever built.
+    """
+
+    def __init__(self, fields, record_depth, use_datetime=0):
+        xmlrpclib.Unmarshaller.__init__(self, use_datetime)
+        self._fields = set(fields)
+        self._record_depth = record_depth
+        self._struct_depth = 0
+        self._member_depth = 0
+        # The member depth at which we started skipping, if we're skipping.
+        self._skip_from = None
+
+    def start(self, tag, attrs):
+        if tag == "member":
+            self._member_depth += 1
+        if self._skip_from is not None:
+            return
+        if tag == "struct":
+            self._struct_depth += 1
+        xmlrpclib.Unmarshaller.start(self, tag, attrs)
+
+    def data(self, text):
+        if self._skip_from is None:
+            self._data.append(text)
+
+    def end(self, tag, join=string.join):
+        if tag == "member":
+            skipped_member = self._member_depth == self._skip_from
+            self._member_depth -= 1
+            if skipped_member:
+                self._skip_from = None
+                return
+        if self._skip_from is not None:
+            return
+        if tag == "struct":
+            self._struct_depth -= 1
+        elif tag == "name" and self._struct_depth == self._record_depth:
+            if join(self._data, "") not in self._fields:
+                self._skip_from = self._member_depth
+                return
+        return xmlrpclib.Unmarshaller.end(self, tag, join)
+
+
+def _record_depth(methodname):
+    """How deeply nested the records in a response to methodname are, or None
+    if it doesn't return records."""
+    if methodname.endswith('.get_record'):
+        return 2
+    if (methodname.endswith('.get_all_records')
+            or methodname.endswith('.get_all_records_where')):
+        return 3
+    return None
+
+
+def _project(result, fields, record_depth):
+    """Filter an already parsed result the way a ProjectingUnmarshaller
+    would have."""
+    def project_record(record):
+        return dict([(k, v) for k, v in record.items() if k in fields])
+    if record_depth == 2:
+        return project_record(result)
+    return dict([(ref, project_record(record))
+                 for ref, record in result.items()])
+
+
+# A thread only makes one call at a time, so the projection for the current
+# call can be kept per thread rather than per transport.
+_projection = threading.local()
+
+
+class ProjectingTransportMixin:
+    """Lets a transport parse responses with a ProjectingUnmarshaller.
+
+    Session sets the projection around each call that asks for one.
+    """
+
+    supports_projection = True
+
+    def set_projection(self, fields, record_depth):
+        _projection.value = (fields, record_depth)
+
+    def clear_projection(self):
+        _projection.value = None
+
+    def getparser(self):
+        projection = getattr(_projection, 'value', None)
+        if projection is None:
+            return xmlrpclib.Transport.getparser(self)
+        fields, record_depth = projection
+        target = ProjectingUnmarshaller(
+            fields, record_depth, use_datetime=self._use_datetime)
+        return xmlrpclib.ExpatParser(target), target
+
+
+# Bytes sent and received by the current thread, so Session can work out the
+# payload sizes of each call without knowing how the transport works.
+_wire = threading.local()
+
+
+def record_wire_bytes(sent, received):
+    """Called by transports to account for the bytes a request sent and
+    received."""
+    _wire.sent = getattr(_wire, 'sent', 0) + sent
+    _wire.received = getattr(_wire, 'received', 0) + received
+
+
+def _wire_bytes():
+    return getattr(_wire, 'sent', 0), getattr(_wire, 'received', 0)
+
+
+class _CountingResponse:
+    """Wraps an HTTPResponse to count the bytes read from it. If sock is
+    given, its timeout is cut short by the current deadline before each read,
+    so a response that trickles in can't run past the deadline."""
+
+    def __init__(self, response, sock=None, timeout=None):
+        self.response = response
+        self.sock = sock
+        self.timeout = timeout
+        self.count = 0
+
+    def read(self, amt=None):
+        if self.sock is not None:
+            self.sock.settimeout(time_left(self.timeout))
+        data = self.response.read(amt)
+        self.count += len(data)
+        return data
+
+    def getheader(self, name, default=None):
+        return self.response.getheader(name, default)
+
+
+class CallInfo:
+    """What a call hook is told about each call a Session makes.
+
+    seconds includes any retries after SESSION_INVALID (counted in retries)
+    and the re-logins they needed; request_bytes and response_bytes count
+    everything sent and received for the call, if the transport reports it.
+    error is the exception the call raised, or None."""
+
+    def __init__(self, host, method, seconds, request_bytes, response_bytes,
+                 retries, error):
+        self.host = host
+        self.method = method
+        self.seconds = seconds
+        self.request_bytes = request_bytes
+        self.response_bytes = response_bytes
+        self.retries = retries
+        self.error = error
+
+
+class ConnectionPool:
+    """A per-process pool of persistent HTTP connections, keyed by host.
+
+    At most maxsize idle connections are kept for each host, and connections
+    that have been idle for longer than idle_timeout seconds (or that the
+    server has closed from its end) are thrown away instead of being reused.
+    """
+
+    def __init__(self, maxsize=4, idle_timeout=30):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._idle = {}
+        self.created = 0
+        self.reused = 0
+        self.dropped = 0
+
+    def get(self, key, factory):
+        """Return a (connection, reused) pair for the given key, creating a
+        new connection with factory() if there are no usable idle ones."""
+        now = time.time()
+        stale = []
+        conn = None
+        self._lock.acquire()
+        try:
+            idle = self._idle.get(key, [])
+            while idle and conn is None:
+                candidate, last_used = idle.pop()
+                if (now - last_used > self.idle_timeout
+                        or _is_half_closed(candidate)):
+                    stale.append(candidate)
+                else:
+                    conn = candidate
+            self.dropped += len(stale)
+            if conn is None:
+                self.created += 1
+            else:
+                self.reused += 1
+        finally:
+            self._lock.release()
+        for candidate in stale:
+            candidate.close()
+        if conn is None:
+            return factory(), False
+        return conn, True
+
+    def put(self, key, conn):
+        """Return a connection to the pool once its response has been read."""
+        self._lock.acquire()
+        try:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.maxsize:
+                idle.append((conn, time.time()))
+                return
+            self.dropped += 1
+        finally:
+            self._lock.release()
+        conn.close()
+
+    def discard(self, conn):
+        """Close a connection that turned out to be unusable."""
+        self._lock.acquire()
+        try:
+            self.dropped += 1
+        finally:
+            self._lock.release()
+        conn.close()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            idle, self._idle = self._idle, {}
+        finally:
+            self._lock.release()
+        for conns in idle.values():
+            for conn, _ in conns:
+                conn.close()
+
+    def stats(self):
+        self._lock.acquire()
+        try:
+            return {
+                'created': self.created,
+                'reused': self.reused,
+                'dropped': self.dropped,
+                'idle': sum([len(conns) for conns in self._idle.values()]),
+            }
+        finally:
+            self._lock.release()
+
+
+def _is_half_closed(conn):
+    """An idle keep-alive connection should never be readable. If it is, the
+    server has either closed its end or sent us something we didn't ask for,
+    and we can't use it either way."""
+    if conn.sock is None:
+        return True
+    try:
+        readable, _, _ = select.select([conn.sock], [], [], 0)
+    except (select.error, socket.error, ValueError):
+        return True
+    return bool(readable)
+
+
+# Deadlines and read timeout overrides apply to all the calls a thread makes
+# within a with block, whichever session they're made on.
+_limits = threading.local()
+
+
+class _Limit:
+    def __init__(self, name, value):
+        self.name = name
+        self.value = value
+
+    def __enter__(self):
+        self.previous = getattr(_limits, self.name, None)
+        setattr(_limits, self.name, self.value)
+
+    def __exit__(self, *exc_info):
+        setattr(_limits, self.name, self.previous)
+
+
+def deadline(seconds):
+    """Return a context manager that makes every call in its with block give
+    up with a Timeout once the given number of seconds have passed. Nested
+    deadlines can only shorten the outer one.
+    Example:
+    with deadline(20):
+        records = session.xenapi.VM.get_all_records()
+    """
+    value = time.time() + seconds
+    outer = current_deadline()
+    if outer is not None:
+        value = min(value, outer)
+    return _Limit('deadline', value)
+
+
+def current_deadline():
+    """Return the current thread's deadline (in time.time() terms), or None
+    if it doesn't have one."""
+    return getattr(_limits, 'deadline', None)
+
+
+def read_timeout(seconds):
+    """Return a context manager that overrides the transport's read timeout
+    for the calls in its with block. This is for calls that are expected to
+    block, such as event.from."""
+    return _Limit('read_timeout', seconds)
+
+
+def time_left(timeout):
+    """Return the time a blocking operation may take given its own timeout
+    (which may be None) and the current deadline."""
+    limit = current_deadline()
+    if limit is None:
+        return timeout
+    left = limit - time.time()
+    if left <= 0:
+        raise Timeout('Deadline exceeded')
+    if timeout is None:
+        return left
+    return min(timeout, left)
+
+
+class PooledTransport(ProjectingTransportMixin, xmlrpclib.SafeTransport):
+    """An XML-RPC transport that keeps HTTP/1.1 connections open and shares
+    them, through a ConnectionPool, with every other transport in the process
+    that uses the same pool.
+
+    Unlike the standard transports, a single PooledTransport may be used by
+    several threads at once because each request checks out its own
+    connection.
+
+    connect_timeout and read_timeout (in seconds, or None to wait forever)
+    bound how long we wait for a connection and for each read of the
+    response. Both are cut short by the current deadline(), which is checked
+    again before each read of the response, and a call that runs out of time
+    raises Timeout. A response that trickles in may still overrun the
+    deadline by the time it takes to fill one read (of 1024 bytes, as
+    xmlrpclib reads them).
+    """
+
+    thread_safe = True
+
+    def __init__(self, pool=None, use_https=True, ignore_ssl=False,
+                 use_datetime=0, connect_timeout=None, read_timeout=None):
+        context = None
+        if use_https and ignore_ssl:
+            import ssl
+            context = ssl._create_unverified_context()
+        xmlrpclib.SafeTransport.__init__(self, use_datetime, context=context)
+        if pool is None:
+            pool = ConnectionPool()
+        self.pool = pool
+        self.use_https = use_https
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+
+    def make_connection(self, host):
+        chost, self._extra_headers, x509 = self.get_host_info(host)
+        if self.use_https:
+            return httplib.HTTPSConnection(
+                chost, None, context=self.context, **(x509 or {}))
+        return httplib.HTTPConnection(chost)
+
+    def close(self):
+        # Connections belong to the pool, not to us.
+        pass
+
+    def request(self, host, handler, request_body, verbose=0):
+        key = (self.use_https, host)
+        for attempt in (0, 1):
+            conn, reused = self.pool.get(
+                key, lambda: self.make_connection(host))
+            try:
+                return self._pooled_request(
+                    key, conn, host, handler, request_body, verbose)
+            except socket.timeout:
+                conn.close()
+                raise Timeout('Timed out waiting for %s' % (host,))
+            except socket.error, e:
+                # Retry once if a reused connection was closed by the server
+                # between requests.
+                if attempt or not reused or e.errno not in (
+                        errno.ECONNRESET, errno.ECONNABORTED, errno.EPIPE):
+                    conn.close()
+                    raise
+                self.pool.discard(conn)
+            except httplib.BadStatusLine:
+                if attempt or not reused:
+                    conn.close()
+                    raise
+                self.pool.discard(conn)
+            except Exception:
+                conn.close()
+                raise
+
+    def _pooled_request(self, key, conn, host, handler, request_body,
+                        verbose):
+        self._extra_headers = self.get_host_info(host)[1]
+        if verbose:
+            conn.set_debuglevel(1)
+        if conn.sock is None:
+            conn.timeout = time_left(self.connect_timeout)
+            conn.connect()
+        timeout = getattr(_limits, 'read_timeout', None)
+        if timeout is None:
+            timeout = self.read_timeout
+        conn.sock.settimeout(time_left(timeout))
+        self.send_request(conn, handler, request_body)
+        self.send_host(conn, host)
+        self.send_user_agent(conn)
+        self.send_content(conn, request_body)
+
+        response = conn.getresponse(buffering=True)
+        counted = _CountingResponse(response, conn.sock, timeout)
+        if response.status == 200:
+            self.verbose = verbose
+            result = self.parse_response(counted)
+        else:
+            counted.read()
+            result = None
+        record_wire_bytes(len(request_body), counted.count)
+
+        if response.will_close:
+            conn.close()
+        else:
+            self.pool.put(key, conn)
+
+        if response.status != 200:
+            raise xmlrpclib.ProtocolError(
+                host + handler, response.status, response.reason,
+                response.msg)
+        return result
+
 class Session(xmlrpclib.ServerProxy):
     """A server proxy and session manager for communicating with xapi using
     the Xen-API.
@@ -140,9 +588,45 @@ class Session(xmlrpclib.ServerProxy):
         self.last_login_method = None
         self.last_login_params = None
         self.API_version = API_VERSION_1_1
+        # The API version only needs negotiating once per host, so remember
+        # it across re-logins (and let a session pool seed it).
+        self.negotiated_API_version = None
+        self._login_lock = threading.Lock()
+        # Callables that are passed a CallInfo after every call.
+        self.call_hooks = []
 
 
-    def xenapi_request(self, methodname, params):
+    def xenapi_request(self, methodname, params, fields=None):
+        if not self.call_hooks:
+            return self._request(methodname, params, fields, [0])
+
+        retries = [0]
+        error = None
+        start = time.time()
+        sent, received = _wire_bytes()
+        try:
+            try:
+                return self._request(methodname, params, fields, retries)
+            except Exception, e:
+                error = e
+                raise
+        finally:
+            now_sent, now_received = _wire_bytes()
+            if methodname.startswith('login') or methodname == 'logout':
+                methodname = 'session.' + methodname
+            self._notify(CallInfo(
+                self._ServerProxy__host, methodname, time.time() - start,
+                now_sent - sent, now_received - received, retries[0], error))
+
+    def _notify(self, call):
+        for hook in self.call_hooks:
+            try:
+                hook(call)
+            except Exception:
+                # Instrumentation must never break the call it's watching.
+                pass
+
+    def _request(self, methodname, params, fields, retries):
         if methodname.startswith('login'):
             self._login(methodname, params)
             return None
@@ -153,12 +637,13 @@ class Session(xmlrpclib.ServerProxy):
             retry_count = 0
             while retry_count < 3:
                 full_params = (self._session,) + params
-                result = _parse_result(getattr(self, methodname)(*full_params))
+                result = _parse_result(
+                    self._call(methodname, full_params, fields))
                 if result is _RECONNECT_AND_RETRY:
                     retry_count += 1
+                    retries[0] = retry_count
                     if self.last_login_method:
-                        self._login(self.last_login_method,
-                                    self.last_login_params)
+                        self._relogin(full_params[0])
                     else:
                         raise xmlrpclib.Fault(401, 'You must log in')
                 else:
@@ -166,7 +651,119 @@ class Session(xmlrpclib.ServerProxy):
             raise xmlrpclib.Fault(
                 500, 'Tried 3 times to get a valid session, but failed')
 
+    def _call(self, methodname, full_params, fields=None):
+        # Transports that don't know about deadlines can't cut a call short,
+        # but we can at least not start one that's already too late.
+        time_left(None)
+        record_depth = None
+        if fields is not None:
+            record_depth = _record_depth(methodname)
+        if record_depth is None:
+            return getattr(self, methodname)(*full_params)
+
+        transport = self._ServerProxy__transport
+        if not getattr(transport, 'supports_projection', False):
+            response = getattr(self, methodname)(*full_params)
+            if (type(response) == dict and 'Value' in response
+                    and response.get('Status') == 'Success'):
+                response['Value'] = _project(
+                    response['Value'], fields, record_depth)
+            return response
+
+        transport.set_projection(fields, record_depth)
+        try:
+            return getattr(self, methodname)(*full_params)
+        finally:
+            transport.clear_projection()
+
+    def project(self, fields):
+        """Return a dispatcher like session.xenapi, except that calls that
+        return records (get_record, get_all_records and
+        get_all_records_where) only keep the given fields of each record.
+
+        With a transport that supports it, the other fields are dropped while
+        the response is being parsed, so they never take up any memory.
+        Example:
+        vms = session.project(['name_label']).VM.get_all_records()
+        """
+        fields = list(fields)
+
+        def send(methodname, params):
+            return self.xenapi_request(methodname, params, fields)
+        return _Dispatcher(self.API_version, send, None)
+
+    def _relogin(self, stale_session):
+        # When several threads find the session invalid at once, only the
+        # first of them needs to log in again.
+        self._login_lock.acquire()
+        try:
+            if self._session == stale_session and self.last_login_method:
+                self._login(self.last_login_method, self.last_login_params)
+        finally:
+            self._login_lock.release()
+
+    def batch(self, calls, max_workers=BATCH_MAX_WORKERS):
+        """Make several independent calls and return their results in order.
+
+        calls is a sequence of (methodname, params) pairs, for example
+        [('VM.get_record', (vm_ref,)), ...]. If the transport can be shared
+        between threads the calls are made concurrently, at most max_workers
+        at a time. A call that fails with a Failure has the Failure in its
+        place in the results instead of aborting the whole batch; any other
+        error is raised once all the calls are done.
+        """
+        calls = [(method, tuple(params)) for method, params in calls]
+        results = [None] * len(calls)
+        errors = []
+        # The worker threads share the caller's limits.
+        limits = (current_deadline(), getattr(_limits, 'read_timeout', None))
+
+        def run(i):
+            method, params = calls[i]
+            _limits.deadline, _limits.read_timeout = limits
+            try:
+                results[i] = self.xenapi_request(method, params)
+            except Failure, e:
+                results[i] = e
+            except Exception:
+                errors.append(sys.exc_info())
+
+        transport = self._ServerProxy__transport
+        if getattr(transport, 'thread_safe', False):
+            workers = min(max_workers, len(calls))
+        else:
+            workers = 1
+
+        if workers <= 1:
+            for i in range(len(calls)):
+                run(i)
+        else:
+            pending = Queue.Queue()
+            for i in range(len(calls)):
+                pending.put(i)
+
+            def worker():
+                while True:
+                    try:
+                        i = pending.get_nowait()
+                    except Queue.Empty:
+                        return
+                    run(i)
+
+            threads = [threading.Thread(target=worker)
+                       for _ in range(workers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        if errors:
+            exc_type, exc_value, tb = errors[0]
+            raise exc_type, exc_value, tb
+        return results
+
     def _login(self, method, params):
+        time_left(None)
         try:
             result = _parse_result(
                 getattr(self, 'session.%s' % method)(*params))
@@ -176,7 +773,9 @@ class Session(xmlrpclib.ServerProxy):
             self._session = result
             self.last_login_method = method
             self.last_login_params = params
-            self.API_version = self._get_api_version()
+            if self.negotiated_API_version is None:
+                self.negotiated_API_version = self._get_api_version()
+            self.API_version = self.negotiated_API_version
         except socket.error, e:
             if e.errno == socket.errno.ETIMEDOUT:
                 raise xmlrpclib.Fault(504, 'The connection timed out')
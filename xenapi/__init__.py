@@ -3,7 +3,17 @@ from __future__ import absolute_import
 # XenAPI.py and provision.py are taken from:
 # https://github.com/xapi-project/xen-api/tree/v1.25.0/scripts/examples/python
 
-# We only seem to use the Session class
-from .XenAPI import Session
+# We only seem to use the Session and Failure classes, plus our own transport
+# and the pooling, timeout and instrumentation helpers that go with it
+from .XenAPI import (
+    CallInfo, ConnectionPool, Failure, PooledTransport,
+    ProjectingTransportMixin, Session, Timeout, current_deadline, deadline,
+    read_timeout, record_wire_bytes, time_left)
+from .call_stats import CallStats
+from .session_pool import SessionPool
 
-__all__ = ['Session']
+__all__ = [
+    'CallInfo', 'CallStats', 'ConnectionPool', 'Failure', 'PooledTransport',
+    'ProjectingTransportMixin', 'Session', 'SessionPool', 'Timeout',
+    'current_deadline', 'deadline', 'read_timeout', 'record_wire_bytes',
+    'time_left']
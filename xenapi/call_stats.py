@@ -0,0 +1,126 @@
+"""
+Per-method, per-host statistics for the XenAPI calls a process makes.
+
+A CallStats is a call hook: add it to a Session's call_hooks (any number of
+sessions can share one) and it keeps a count, a latency histogram, payload
+sizes and SESSION_INVALID retry counts for every (host, method) pair:
+
+    stats = CallStats()
+    session.call_hooks.append(stats)
+    ...
+    stats.snapshot()[('xs01', 'VM.get_all_records')]['count']
+
+snapshot() returns plain dicts for tests and ad-hoc reporting, and
+prometheus_text() renders the same data in the Prometheus text format for
+anything that can scrape or ingest it.
+"""
+
+import threading
+
+
+# Upper bounds (in seconds) of the latency histogram buckets. Calls slower
+# than the last bound are only counted in the implicit +Inf bucket.
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class CallStats(object):
+    """
+    Collect statistics from the CallInfo of every call it's given.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def __call__(self, call):
+        key = (call.host, call.method)
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = {
+                    'count': 0,
+                    'errors': 0,
+                    'retries': 0,
+                    'seconds': 0.0,
+                    'request_bytes': 0,
+                    'response_bytes': 0,
+                    'buckets': [0] * len(self.buckets),
+                }
+            stats['count'] += 1
+            if call.error is not None:
+                stats['errors'] += 1
+            stats['retries'] += call.retries
+            stats['seconds'] += call.seconds
+            stats['request_bytes'] += call.request_bytes
+            stats['response_bytes'] += call.response_bytes
+            for i, bound in enumerate(self.buckets):
+                if call.seconds <= bound:
+                    stats['buckets'][i] += 1
+                    break
+
+    def snapshot(self):
+        """
+        Return a copy of the statistics, keyed by (host, method). The
+        'buckets' entry is a list of (upper bound, cumulative count) pairs.
+        """
+        with self._lock:
+            snapshot = {}
+            for key, stats in self._stats.items():
+                stats = dict(stats)
+                cumulative = 0
+                buckets = []
+                for bound, count in zip(self.buckets, stats['buckets']):
+                    cumulative += count
+                    buckets.append((bound, cumulative))
+                stats['buckets'] = buckets
+                snapshot[key] = stats
+            return snapshot
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+
+    def prometheus_text(self, prefix='xenapi'):
+        """
+        Render the statistics in the Prometheus text exposition format.
+        """
+        snapshot = sorted(self.snapshot().items())
+        lines = []
+
+        def metric(name, kind, help):
+            lines.append('# HELP %s_%s %s' % (prefix, name, help))
+            lines.append('# TYPE %s_%s %s' % (prefix, name, kind))
+
+        def sample(name, labels, value, extra=''):
+            host, method = labels
+            lines.append('%s_%s{host="%s",method="%s"%s} %s' % (
+                prefix, name, _escape(host), _escape(method), extra, value))
+
+        for name, field, help in [
+                ('calls_total', 'count', "XenAPI calls made."),
+                ('call_errors_total', 'errors', "XenAPI calls that failed."),
+                ('session_retries_total', 'retries',
+                 "Calls retried after SESSION_INVALID."),
+                ('request_bytes_total', 'request_bytes',
+                 "Bytes sent in XenAPI requests."),
+                ('response_bytes_total', 'response_bytes',
+                 "Bytes received in XenAPI responses.")]:
+            metric(name, 'counter', help)
+            for key, stats in snapshot:
+                sample(name, key, stats[field])
+
+        metric('call_seconds', 'histogram', "XenAPI call latency.")
+        for key, stats in snapshot:
+            for bound, count in stats['buckets']:
+                sample('call_seconds_bucket', key, count,
+                       ',le="%s"' % (bound,))
+            sample('call_seconds_bucket', key, stats['count'], ',le="+Inf"')
+            sample('call_seconds_sum', key, stats['seconds'])
+            sample('call_seconds_count', key, stats['count'])
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"')
@@ -0,0 +1,206 @@
+"""
+A process-wide pool of authenticated XenAPI sessions.
+
+Logging in to xapi costs a login_with_password call plus the four calls
+Session makes to negotiate the API version, and logging out again costs one
+more. Callers that talk to the same host over and over (every Celery task,
+every poll) can instead borrow an already authenticated session from a
+SessionPool and give it back when they're done.
+
+Sessions that have gone stale on the xapi side (because xapi restarted, or
+expired them) are revalidated by Session's usual SESSION_INVALID handling,
+which logs in again with the original credentials.
+
+Only a pool's master accepts logins; a slave refuses them with HOST_IS_SLAVE
+and the master's address. The pool follows that redirect and remembers the
+master for the slave's hostname, so later sessions go straight to it and
+every host in a pool shares the master's sessions. If the master stops
+answering (because it failed over to another host), the redirect is
+forgotten and the next login finds the new master through the slave again.
+"""
+
+import socket
+import threading
+import time
+
+from .XenAPI import Failure, Timeout
+
+
+# How many times a login follows HOST_IS_SLAVE to a master, or falls back from
+# an unreachable master to the host it was given, before giving up.
+MAX_REDIRECTS = 3
+
+
+class SessionPool(object):
+    """
+    Hand out logged-in sessions keyed by (hostname, username).
+
+    :param session_factory:
+        A callable that takes a hostname and returns a new (not yet logged in)
+        xenapi.Session for that host.
+    :param max_idle:
+        Number of seconds a session may sit unused in the pool before it is
+        logged out and discarded.
+    :param clock:
+        A callable returning the current time in seconds. Only useful for
+        tests.
+    """
+
+    def __init__(self, session_factory, max_idle=300, clock=time.time):
+        self.session_factory = session_factory
+        self.max_idle = max_idle
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._api_versions = {}
+        self._masters = {}
+
+    def acquire(self, hostname, username, password):
+        """
+        Return an authenticated session for the given host and credentials,
+        reusing an idle one if there is one available. If the host is a pool
+        slave, the session is for the pool's master.
+        """
+        stale = []
+        session = None
+        with self._lock:
+            key = (self._masters.get(hostname, hostname), username)
+            stale.extend(self._expire_idle())
+            idle = self._idle.get(key, [])
+            while idle and session is None:
+                candidate, _ = idle.pop()
+                if candidate.last_login_params == (username, password):
+                    session = candidate
+                else:
+                    # The credentials have changed since this session was
+                    # created, so we can't use it to log in again.
+                    stale.append(candidate)
+        self._logout_all(stale)
+
+        if session is None:
+            session = self._login(hostname, username, password)
+        return session
+
+    def _login(self, hostname, username, password):
+        with self._lock:
+            target = self._masters.get(hostname, hostname)
+        redirects = 0
+        while True:
+            key = (target, username)
+            with self._lock:
+                api_version = self._api_versions.get(key)
+            session = self.session_factory(target)
+            session.negotiated_API_version = api_version
+            try:
+                session.xenapi.login_with_password(username, password)
+            except Failure, e:
+                if e.details[0] != 'HOST_IS_SLAVE' or (
+                        redirects >= MAX_REDIRECTS):
+                    raise
+                redirects += 1
+                target = e.details[1]
+                with self._lock:
+                    self._masters[hostname] = target
+                continue
+            except (socket.error, Timeout):
+                if target == hostname or redirects >= MAX_REDIRECTS:
+                    raise
+                redirects += 1
+                # The master we remembered has gone away, so ask the host
+                # we were given who the master is now.
+                self.forget_master(target)
+                target = hostname
+                continue
+            session.pool_key = key
+            with self._lock:
+                self._api_versions[key] = session.negotiated_API_version
+            return session
+
+    def master_for(self, hostname):
+        """
+        Return the address of the pool master we were redirected to for the
+        given host, or the host itself if it hasn't redirected us.
+        """
+        with self._lock:
+            return self._masters.get(hostname, hostname)
+
+    def forget_master(self, master):
+        """
+        Forget every redirect to the given master, so the next login to any
+        of its pool's hosts finds the current master again.
+        """
+        with self._lock:
+            for hostname, target in self._masters.items():
+                if target == master:
+                    del self._masters[hostname]
+
+    def release(self, session, discard=False):
+        """
+        Return a session to the pool. Sessions that did not come from this
+        pool are logged out instead.
+
+        If discard is true, the session (and its host) can't be trusted any
+        more, for example because its host stopped answering: the session is
+        logged out rather than pooled, and any redirect to its host is
+        forgotten.
+        """
+        # Session turns unknown attributes into XML-RPC methods, so we can't
+        # use getattr() with a default here.
+        key = vars(session).get('pool_key')
+        if discard and key is not None:
+            self.forget_master(key[0])
+        if discard or key is None or session.last_login_method is None:
+            self._logout_all([session])
+            return
+        with self._lock:
+            self._idle.setdefault(key, []).append((session, self.clock()))
+
+    def expire(self):
+        """
+        Log out and discard any sessions that have been idle for too long.
+        """
+        with self._lock:
+            stale = self._expire_idle()
+        self._logout_all(stale)
+
+    def clear(self):
+        """
+        Log out and discard all idle sessions.
+        """
+        with self._lock:
+            stale = [s for idle in self._idle.values() for s, _ in idle]
+            self._idle = {}
+        self._logout_all(stale)
+
+    def idle_count(self, hostname=None, username=None):
+        """
+        Return the number of idle sessions in the pool, optionally limited to
+        a single (hostname, username) key.
+        """
+        with self._lock:
+            if hostname is None:
+                return sum(len(idle) for idle in self._idle.values())
+            return len(self._idle.get((hostname, username), []))
+
+    def _expire_idle(self):
+        # Must be called with self._lock held. Returns the expired sessions so
+        # they can be logged out after the lock is released.
+        cutoff = self.clock() - self.max_idle
+        stale = []
+        for key, idle in self._idle.items():
+            fresh = [(s, t) for s, t in idle if t > cutoff]
+            stale.extend(s for s, t in idle if t <= cutoff)
+            if fresh:
+                self._idle[key] = fresh
+            else:
+                del self._idle[key]
+        return stale
+
+    def _logout_all(self, sessions):
+        for session in sessions:
+            try:
+                session.xenapi.session.logout()
+            except Exception:
+                # The session is being thrown away anyway, and xapi will
+                # eventually expire it on its own.
+                pass
@@ -0,0 +1,66 @@
+import threading
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from xenserver import tasks
+from xenserver.poller import FleetPoller
+
+
+class Command(BaseCommand):
+    help = (
+        "Poll every active XenServer from this process, instead of through "
+        "Celery beat and the updateVms task.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'hostnames', nargs='*', help="Only poll these servers.")
+        parser.add_argument(
+            '--workers', type=int, default=settings.XENZEN_POLL_WORKERS,
+            help="How many servers to poll at once.")
+        parser.add_argument(
+            '--appliers', type=int, default=settings.XENZEN_POLL_APPLIERS,
+            help="How many threads write poll results to the database.")
+        parser.add_argument(
+            '--report-interval', type=int, default=60,
+            help="How often (in seconds) to report poll durations.")
+
+    def handle(self, *args, **options):
+        self.poller = poller = FleetPoller(
+            workers=options['workers'], appliers=options['appliers'],
+            hostnames=options['hostnames'])
+        stop = threading.Event()
+        thread = threading.Thread(
+            target=poller.run, args=(stop, self.report),
+            kwargs={'report_interval': options['report_interval']})
+        thread.daemon = True
+        thread.start()
+        self.stdout.write("Polling with %d workers" % (options['workers'],))
+
+        try:
+            while thread.is_alive():
+                thread.join(1)
+        except KeyboardInterrupt:
+            stop.set()
+            thread.join()
+
+    def report(self, summary):
+        tasks.logCallStats()
+        if not summary:
+            return
+        total = sum(seconds for _, seconds in summary)
+        self.stdout.write(
+            "Last poll of %d servers took %.2fs on average; slowest: %s" % (
+                len(summary), total / len(summary), ", ".join(
+                    "%s (%.2fs)" % item for item in summary[:5])))
+        stats = self.poller.pipeline.stats()
+        self.stdout.write(
+            "Fetched %d (%d failed, %d dropped) in %.1fs, %.1fs waiting for "
+            "appliers; applied %d in %d batches (%d failed) in %.1fs; "
+            "%d waiting to fetch, %d waiting to apply" % (
+                stats['fetch']['count'], stats['fetch']['errors'],
+                stats['fetch']['expired'], stats['fetch']['seconds'],
+                stats['fetch']['blocked'],
+                stats['apply']['count'], stats['apply']['batches'],
+                stats['apply']['errors'], stats['apply']['seconds'],
+                stats['waiting'], stats['queued']))
@@ -0,0 +1,47 @@
+import threading
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from xenserver import tasks
+from xenserver.models import XenServer
+from xenserver.watcher import EventWatcher
+
+
+class Command(BaseCommand):
+    help = (
+        "Follow the event stream of each active XenServer (or one server in "
+        "each pool) and keep the VM inventory up to date as things change.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'hostnames', nargs='*', help="Only watch these servers.")
+
+    def handle(self, *args, **options):
+        servers = XenServer.objects.filter(active=True).order_by('pk')
+        if options['hostnames']:
+            servers = servers.filter(hostname__in=options['hostnames'])
+        servers = list(servers)
+        # Every server in a pool gets the same events, so we only watch one.
+        leaders = tasks.poolLeaders(servers)
+        servers = [xs for xs in servers
+                   if leaders.get(xs.pool_uuid, xs.pk) == xs.pk]
+
+        stop = threading.Event()
+        threads = []
+        for xenserver in servers:
+            watcher = EventWatcher(
+                xenserver, timeout=settings.XENZEN_EVENT_TIMEOUT)
+            thread = threading.Thread(
+                target=watcher.run, args=(stop,), name=xenserver.hostname)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+            self.stdout.write("Watching %s" % (xenserver.hostname,))
+
+        try:
+            while any(thread.is_alive() for thread in threads):
+                for thread in threads:
+                    thread.join(1)
+        except KeyboardInterrupt:
+            stop.set()
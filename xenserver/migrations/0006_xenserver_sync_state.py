@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xenserver', '0005_auto_20160624_1107'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='xenserver',
+            name='event_heartbeat',
+            field=models.DateTimeField(null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='xenserver',
+            name='last_full_sync',
+            field=models.DateTimeField(null=True, blank=True),
+        ),
+    ]
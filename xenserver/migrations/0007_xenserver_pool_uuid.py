@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xenserver', '0006_xenserver_sync_state'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='xenserver',
+            name='pool_uuid',
+            field=models.CharField(default=b'', max_length=255, blank=True),
+        ),
+    ]
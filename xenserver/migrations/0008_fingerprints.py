@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xenserver', '0007_xenserver_pool_uuid'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='xenmetrics',
+            name='fingerprint',
+            field=models.CharField(default=b'', max_length=40, blank=True),
+        ),
+        migrations.AddField(
+            model_name='xenvm',
+            name='fingerprint',
+            field=models.CharField(default=b'', max_length=40, blank=True),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xenserver', '0008_fingerprints'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='xenserver',
+            name='next_poll',
+            field=models.DateTimeField(null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='xenserver',
+            name='poll_failures',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='xenserver',
+            name='poll_interval',
+            field=models.IntegerField(null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='xenserver',
+            name='poll_lease',
+            field=models.DateTimeField(null=True, blank=True),
+        ),
+    ]
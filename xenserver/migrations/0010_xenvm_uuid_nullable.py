@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def clear_uuids(apps, schema_editor):
+    """
+    Blank uuids become null, and only the newest of any VMs sharing a uuid
+    keeps it, so the column can be made unique. The next sync fills in the
+    rest.
+    """
+    XenVM = apps.get_model('xenserver', 'XenVM')
+    XenVM.objects.filter(uuid='').update(uuid=None)
+    seen = set()
+    duplicates = []
+    for pk, uuid in XenVM.objects.exclude(uuid=None).order_by(
+            '-pk').values_list('pk', 'uuid'):
+        if uuid in seen:
+            duplicates.append(pk)
+        seen.add(uuid)
+    if duplicates:
+        XenVM.objects.filter(pk__in=duplicates).update(uuid=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xenserver', '0009_xenserver_poll_schedule'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='xenvm',
+            name='uuid',
+            field=models.CharField(max_length=255, null=True, blank=True),
+        ),
+        migrations.RunPython(clear_uuids, migrations.RunPython.noop),
+    ]
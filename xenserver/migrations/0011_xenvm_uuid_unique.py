@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xenserver', '0010_xenvm_uuid_nullable'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='xenvm',
+            name='uuid',
+            field=models.CharField(default=None, max_length=255, unique=True, null=True, blank=True),
+        ),
+    ]
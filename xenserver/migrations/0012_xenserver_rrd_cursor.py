@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xenserver', '0011_xenvm_uuid_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='xenserver',
+            name='rrd_cursor',
+            field=models.IntegerField(null=True, blank=True),
+        ),
+    ]
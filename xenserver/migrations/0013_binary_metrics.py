@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xenserver', '0012_xenserver_rrd_cursor'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='XenMetricTimes',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('times', models.BinaryField()),
+                ('vm', models.OneToOneField(to='xenserver.XenVM')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='xenmetrics',
+            name='data',
+            field=models.BinaryField(default=b''),
+            preserve_default=False,
+        ),
+    ]
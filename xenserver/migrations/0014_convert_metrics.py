@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import array
+import hashlib
+import json
+import math
+import struct
+import sys
+
+from django.db import migrations
+
+
+# A frozen copy of version 1 of xenserver.series, so this migration always
+# writes the format it was written for.
+HEADER = struct.Struct('<2sBcI')
+
+
+def encode(typecode, items):
+    packed = array.array(typecode, items)
+    if sys.byteorder != 'little':
+        packed.byteswap()
+    return HEADER.pack(b'XZ', 1, typecode, len(packed)) + packed.tostring()
+
+
+def decode(typecode, blob):
+    if hasattr(blob, 'tobytes'):
+        blob = blob.tobytes()
+    blob = bytes(blob)
+    packed = array.array(typecode)
+    packed.fromstring(blob[HEADER.size:])
+    if sys.byteorder != 'little':
+        packed.byteswap()
+    return packed.tolist()
+
+
+def to_binary(apps, schema_editor):
+    """
+    Convert each VM's JSON series to one shared array of timestamps and a
+    float32 array of values for each key, with NaN for gaps.
+    """
+    XenMetrics = apps.get_model('xenserver', 'XenMetrics')
+    XenMetricTimes = apps.get_model('xenserver', 'XenMetricTimes')
+    vm_ids = XenMetrics.objects.values_list('vm', flat=True).distinct()
+    for vm_id in vm_ids:
+        series = {}
+        for metric in XenMetrics.objects.filter(vm=vm_id):
+            series[metric.pk] = dict(zip(
+                json.loads(metric.timeblob), json.loads(metric.datablob)))
+        times = sorted(set(t for points in series.values() for t in points))
+        timesblob = encode(b'I', times)
+        XenMetricTimes.objects.create(vm_id=vm_id, times=timesblob)
+        for pk, points in series.items():
+            data = encode(b'f', [
+                float('nan') if points.get(t) is None else points[t]
+                for t in times])
+            XenMetrics.objects.filter(pk=pk).update(
+                data=data,
+                fingerprint=hashlib.sha1(timesblob + data).hexdigest())
+
+
+def to_json(apps, schema_editor):
+    """
+    Convert the binary series back to JSON. Each key gets all of its VM's
+    timestamps, with null for its gaps.
+    """
+    XenMetrics = apps.get_model('xenserver', 'XenMetrics')
+    XenMetricTimes = apps.get_model('xenserver', 'XenMetricTimes')
+    for metric_times in XenMetricTimes.objects.all():
+        timeblob = json.dumps(decode(b'I', metric_times.times))
+        for metric in XenMetrics.objects.filter(vm=metric_times.vm_id):
+            values = [None if math.isnan(v) else v
+                      for v in decode(b'f', metric.data)]
+            XenMetrics.objects.filter(pk=metric.pk).update(
+                timeblob=timeblob, datablob=json.dumps(values))
+    XenMetricTimes.objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xenserver', '0013_binary_metrics'),
+    ]
+
+    operations = [
+        migrations.RunPython(to_binary, to_json),
+    ]
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xenserver', '0014_convert_metrics'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='xenmetrics',
+            name='datablob',
+        ),
+        migrations.RemoveField(
+            model_name='xenmetrics',
+            name='timeblob',
+        ),
+    ]
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xenserver', '0015_remove_json_metrics'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='XenMetricRollup',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('key', models.CharField(max_length=128)),
+                ('resolution', models.IntegerField()),
+                ('times', models.BinaryField()),
+                ('minimum', models.BinaryField()),
+                ('average', models.BinaryField()),
+                ('maximum', models.BinaryField()),
+                ('last', models.BinaryField()),
+                ('vm', models.ForeignKey(to='xenserver.XenVM')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='xenmetricrollup',
+            unique_together=set([('vm', 'key', 'resolution')]),
+        ),
+    ]
@@ -29,6 +29,27 @@ class XenServer(models.Model):
 
     active = models.BooleanField(default=True)
 
+    # Last time an event watcher heard from this server, and last time we
+    # fetched its whole VM inventory.
+    event_heartbeat = models.DateTimeField(null=True, blank=True)
+    last_full_sync = models.DateTimeField(null=True, blank=True)
+
+    # The UUID of the pool this server belongs to, so we can sync each pool's
+    # inventory only once.
+    pool_uuid = models.CharField(max_length=255, blank=True, default='')
+
+    # Poll scheduling: when the next poll is due, when the lease held by the
+    # current poll (if any) expires, how many polls in a row have failed, and
+    # the current interval between polls in seconds (None means the default).
+    next_poll = models.DateTimeField(null=True, blank=True)
+    poll_lease = models.DateTimeField(null=True, blank=True)
+    poll_failures = models.IntegerField(default=0)
+    poll_interval = models.IntegerField(null=True, blank=True)
+
+    # The timestamp of the newest RRD sample we've stored, so each poll only
+    # needs to fetch the samples after it.
+    rrd_cursor = models.IntegerField(null=True, blank=True)
+
     def __unicode__(self):
         return self.hostname
 
@@ -83,7 +104,11 @@ class XenVM(models.Model):
     name = models.CharField(max_length=255)
     status = models.CharField(max_length=128)
     xsref = models.CharField(max_length=255, unique=True)
-    uuid = models.CharField(max_length=255)
+    # A VM's uuid stays the same when it's renamed or migrated, unlike its
+    # name or ref, so it's what the sync matches VMs by. It's only null while
+    # the VM is being provisioned.
+    uuid = models.CharField(
+        max_length=255, unique=True, null=True, blank=True, default=None)
 
     sockets = models.IntegerField()
     memory = models.IntegerField()
@@ -96,6 +121,18 @@ class XenVM(models.Model):
 
     template = models.ForeignKey(Template, null=True, default=None)
 
+    # A digest of the fields the sync derives from the VM's xapi record, so
+    # it can skip writing VMs that haven't changed. Anything else that writes
+    # one of those fields must clear it.
+    fingerprint = models.CharField(max_length=40, blank=True, default='')
+
+    def save(self, *args, **kwargs):
+        # Forms (like the admin's) save a blank uuid as '', which would break
+        # the unique constraint for the second such VM.
+        if not self.uuid:
+            self.uuid = None
+        super(XenVM, self).save(*args, **kwargs)
+
     def __unicode__(self):
         return self.name
 
@@ -117,11 +154,39 @@ class Addresses(models.Model):
         return self.__unicode__().encode('utf-8', 'replace')
 
 
+class XenMetricTimes(models.Model):
+    # The timestamps of a VM's RRD samples, shared by all its XenMetrics and
+    # encoded with xenserver.series.encode_times.
+    vm = models.OneToOneField(XenVM)
+    times = models.BinaryField()
+
+
 class XenMetrics(models.Model):
     vm = models.ForeignKey(XenVM)
     key = models.CharField(max_length=128)
-    timeblob = models.TextField()
-    datablob = models.TextField()
+    # The values of the series, one for each of the VM's XenMetricTimes,
+    # encoded with xenserver.series.encode_values.
+    data = models.BinaryField()
+    # A digest of the times and data, so unchanged series aren't rewritten.
+    fingerprint = models.CharField(max_length=40, blank=True, default='')
+
+
+class XenMetricRollup(models.Model):
+    # A metric's older samples folded into buckets of resolution seconds. The
+    # start of each bucket is encoded with xenserver.series.encode_times, and
+    # the minimum, average, maximum and last sample in each with
+    # xenserver.series.encode_values.
+    vm = models.ForeignKey(XenVM)
+    key = models.CharField(max_length=128)
+    resolution = models.IntegerField()
+    times = models.BinaryField()
+    minimum = models.BinaryField()
+    average = models.BinaryField()
+    maximum = models.BinaryField()
+    last = models.BinaryField()
+
+    class Meta:
+        unique_together = ('vm', 'key', 'resolution')
 
 
 class AuditLog(models.Model):
@@ -0,0 +1,235 @@
+"""
+Sync many servers at once, with the network I/O and database writes in
+separate stages.
+
+Fetching a server's state is nearly all waiting on the network, while
+applying it is all database work. A SyncPipeline runs many fetchers, which
+put a snapshot of each server on a bounded queue, and a few appliers, which
+take snapshots off the queue in batches and write each batch in a single
+transaction. When the appliers fall behind, the queue fills up and the
+fetchers wait, so memory use is bounded by the size of the queue.
+
+Each stage counts the servers it has handled, its errors and the time it
+spent, and the fetchers also count the time they spent waiting for room on
+the queue, so stats() shows which stage is the bottleneck.
+
+Polls that wait so long to be fetched that their lease would run out are
+dropped, since the server may have been leased for another poll by then. The
+scheduler leases it again once the lease has expired.
+"""
+
+import Queue
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from xenserver import tasks
+from xenserver.models import XenServer
+
+
+logger = logging.getLogger(__name__)
+
+
+class SyncPipeline(object):
+    """
+    Poll servers on a number of fetcher threads and write the results to the
+    database on a number of applier threads, with at most queue_size
+    snapshots waiting in between. done, if given, is called with each
+    server's hostname and how long its poll took.
+    """
+
+    def __init__(self, fetchers=32, appliers=2, queue_size=64,
+                 batch_size=16, done=None):
+        self.fetchers = fetchers
+        self.appliers = appliers
+        self.batch_size = batch_size
+        self.done = done
+        self.jobs = Queue.Queue()
+        self.snapshots = Queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._stats = {
+            'fetch': {'count': 0, 'errors': 0, 'seconds': 0.0,
+                      'blocked': 0.0, 'expired': 0},
+            'apply': {'count': 0, 'errors': 0, 'seconds': 0.0,
+                      'batches': 0},
+        }
+        self._fetcher_threads = []
+        self._applier_threads = []
+
+    def start(self):
+        for i in range(self.fetchers):
+            self._fetcher_threads.append(
+                self._thread(self._fetch_loop, 'fetch-%d' % (i,)))
+        for i in range(self.appliers):
+            self._applier_threads.append(
+                self._thread(self._apply_loop, 'apply-%d' % (i,)))
+
+    def _thread(self, target, name):
+        thread = threading.Thread(target=target, name=name)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def stop(self):
+        """
+        Finish the polls that have been submitted, then stop the threads.
+        """
+        for _ in self._fetcher_threads:
+            self.jobs.put(None)
+        for thread in self._fetcher_threads:
+            thread.join()
+        for _ in self._applier_threads:
+            self.snapshots.put(None)
+        for thread in self._applier_threads:
+            thread.join()
+        self._fetcher_threads = []
+        self._applier_threads = []
+
+    def submit(self, pk, hostname, inventory=True, lease=None):
+        """
+        Queue a poll of a server, which we must already hold the lease for
+        (until lease, if given).
+        """
+        self.jobs.put((pk, hostname, inventory, lease))
+
+    def stats(self):
+        """
+        Return a copy of each stage's counters, and how many polls are
+        waiting to be fetched and applied.
+        """
+        with self._lock:
+            stats = dict(
+                (stage, dict(counters))
+                for stage, counters in self._stats.items())
+        stats['waiting'] = self.jobs.qsize()
+        stats['queued'] = self.snapshots.qsize()
+        return stats
+
+    def _count(self, stage, **counts):
+        with self._lock:
+            for name, value in counts.items():
+                self._stats[stage][name] += value
+
+    def fetch(self, job):
+        """
+        Fetch one server's snapshot. Returns what apply() needs to write it,
+        or None if the server has been deleted or our lease on it would run
+        out before the poll's deadline.
+        """
+        pk, hostname, inventory, lease = job
+        if lease is not None and lease < timezone.now() + timedelta(
+                seconds=settings.XENZEN_POLL_DEADLINE):
+            logger.warning(
+                "Dropped the poll of %s, which waited too long to start",
+                hostname)
+            self._count('fetch', expired=1)
+            return None
+        started = time.time()
+        try:
+            xenserver = tasks.getInstance(XenServer, pk)
+        except XenServer.DoesNotExist:
+            logger.info("Server %s was deleted before it was polled", pk)
+            return None
+        snapshot = None
+        try:
+            snapshot = tasks.fetchServer(xenserver, inventory)
+        except Exception:
+            logger.exception("Failed to fetch %s", hostname)
+        self._count(
+            'fetch', count=1, errors=int(snapshot is None),
+            seconds=time.time() - started)
+        return (xenserver, snapshot, started)
+
+    def apply(self, batch):
+        """
+        Write a batch of snapshots from fetch() in a single transaction, and
+        schedule the next poll of each server.
+        """
+        started = time.time()
+        errors = 0
+        with transaction.atomic():
+            for xenserver, snapshot, _ in batch:
+                changed = False
+                failed = snapshot is None
+                if not failed:
+                    try:
+                        # A savepoint, so one bad snapshot doesn't roll back
+                        # the rest of the batch.
+                        with transaction.atomic():
+                            changed = tasks.applySnapshot(xenserver, snapshot)
+                    except Exception:
+                        logger.exception(
+                            "Failed to apply %s", xenserver.hostname)
+                        errors += 1
+                        failed = True
+                tasks.finishPoll(xenserver, failed=failed, changed=changed)
+        finished = time.time()
+        self._count(
+            'apply', count=len(batch), errors=errors,
+            seconds=finished - started, batches=1)
+        if self.done is not None:
+            for xenserver, _, fetch_started in batch:
+                self.done(xenserver.hostname, finished - fetch_started)
+
+    def abandon(self, pk, hostname):
+        """
+        Count a poll we couldn't even start as failed, which also releases
+        its lease.
+        """
+        try:
+            tasks.finishPoll(tasks.getInstance(XenServer, pk), failed=True)
+        except Exception:
+            logger.exception(
+                "Failed to release the poll lease on %s", hostname)
+
+    def _fetch_loop(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            try:
+                # These threads keep their database connections between
+                # polls, so drop any that have broken or outlived
+                # CONN_MAX_AGE first.
+                close_old_connections()
+                result = self.fetch(job)
+            except Exception:
+                logger.exception("Failed to fetch %s", job[1])
+                self._count('fetch', count=1, errors=1)
+                self.abandon(job[0], job[1])
+                continue
+            if result is None:
+                continue
+            waited = time.time()
+            self.snapshots.put(result)
+            self._count('fetch', blocked=time.time() - waited)
+
+    def _apply_loop(self):
+        while True:
+            result = self.snapshots.get()
+            if result is None:
+                return
+            batch = [result]
+            stopping = False
+            # Take whatever else is waiting, up to a full batch.
+            while len(batch) < self.batch_size:
+                try:
+                    result = self.snapshots.get_nowait()
+                except Queue.Empty:
+                    break
+                if result is None:
+                    stopping = True
+                    break
+                batch.append(result)
+            close_old_connections()
+            try:
+                self.apply(batch)
+            except Exception:
+                logger.exception("Failed to apply a batch of snapshots")
+            if stopping:
+                return
@@ -0,0 +1,121 @@
+"""
+Poll the whole fleet from a single long-running process.
+
+For large fleets, a FleetPoller replaces Celery beat, updateVms and the
+updateServer messages it fans out. It picks the servers that are due with the
+same schedule and leases as updateVms (so the two can safely overlap while
+switching over), and runs their polls through a SyncPipeline in this
+process. Sessions and keep-alive connections stay warm in the process-wide
+pools in xenserver.tasks, and nothing goes through the broker.
+"""
+
+import heapq
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+from xenserver import tasks
+from xenserver.models import XenServer
+from xenserver.pipeline import SyncPipeline
+
+
+logger = logging.getLogger(__name__)
+
+
+class FleetPoller(object):
+    """
+    Schedule and run the polls of every active XenServer, fetching from at
+    most workers of them at a time and writing the results with appliers
+    threads.
+    """
+
+    def __init__(self, workers=32, appliers=2, hostnames=None, tick=None):
+        self.hostnames = hostnames
+        self.tick = tick or settings.XENZEN_POLL_TICK
+        self.pipeline = SyncPipeline(
+            fetchers=workers, appliers=appliers,
+            queue_size=settings.XENZEN_POLL_QUEUE_SIZE,
+            batch_size=settings.XENZEN_POLL_BATCH_SIZE, done=self.record)
+        # Polls we hold the lease for, as (start time, pk, hostname,
+        # inventory, lease), soonest first.
+        self.pending = []
+        self._lock = threading.Lock()
+        # How long the last poll of each server took, by hostname.
+        self.durations = {}
+
+    def servers(self):
+        servers = XenServer.objects.filter(active=True).order_by('pk')
+        if self.hostnames:
+            servers = servers.filter(hostname__in=self.hostnames)
+        return servers
+
+    def schedule(self, now=None):
+        """
+        Lease the polls that are due within the next tick, and queue them to
+        start when they're due.
+        """
+        start = time.time()
+        for xenserver, countdown, inventory in tasks.duePolls(
+                list(self.servers()), now=now):
+            heapq.heappush(self.pending, (
+                start + countdown, xenserver.pk, xenserver.hostname,
+                inventory, xenserver.poll_lease))
+
+    def dispatch(self):
+        """
+        Hand every queued poll that is due to the workers. Returns how long
+        until the next one is due, or None if there are none left.
+        """
+        now = time.time()
+        while self.pending and self.pending[0][0] <= now:
+            _, pk, hostname, inventory, lease = heapq.heappop(self.pending)
+            self.pipeline.submit(pk, hostname, inventory, lease)
+        if self.pending:
+            return self.pending[0][0] - now
+        return None
+
+    def record(self, hostname, seconds):
+        """
+        Record how long a poll of a server took.
+        """
+        with self._lock:
+            self.durations[hostname] = seconds
+        logger.info("Polled %s in %.2fs", hostname, seconds)
+
+    def summary(self):
+        """
+        Return (hostname, seconds) for the last poll of each server, slowest
+        first.
+        """
+        with self._lock:
+            durations = self.durations.items()
+        return sorted(durations, key=lambda item: (-item[1], item[0]))
+
+    def run(self, stop=None, report=None, report_interval=60):
+        """
+        Poll until stop (a threading.Event) is set. If report is given, it is
+        called with the summary every report_interval seconds.
+        """
+        if stop is None:
+            stop = threading.Event()
+        self.pipeline.start()
+        next_tick = next_report = time.time()
+        while not stop.is_set():
+            now = time.time()
+            if now >= next_tick:
+                try:
+                    self.schedule()
+                except Exception:
+                    logger.exception("Failed to schedule polls")
+                next_tick = now + self.tick
+            if report is not None and now >= next_report:
+                report(self.summary())
+                next_report = now + report_interval
+            wait = next_tick - time.time()
+            due = self.dispatch()
+            if due is not None:
+                wait = min(wait, due)
+            stop.wait(max(wait, 0))
+        self.pipeline.stop()
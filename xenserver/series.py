@@ -0,0 +1,108 @@
+# Compact binary encoding for RRD metric series.
+#
+# A series is stored as an 8 byte header followed by a packed little-endian
+# array: the magic 'XZ', a format version, the array's typecode ('I' for
+# timestamps, 'f' for float32 values) and the number of items. Gaps in a
+# series of values are stored as NaN.
+#
+# downsample() reduces a decoded series to a number of points a chart can
+# draw without losing its peaks and troughs.
+
+import array
+import math
+import struct
+import sys
+
+
+MAGIC = 'XZ'
+VERSION = 1
+HEADER = struct.Struct('<2sBcI')
+
+NAN = float('nan')
+
+
+def _bytes(blob):
+    # Database drivers hand BinaryField values back as buffers or
+    # memoryviews.
+    if hasattr(blob, 'tobytes'):
+        return blob.tobytes()
+    return str(blob)
+
+
+def _encode(typecode, items):
+    packed = array.array(typecode, items)
+    if sys.byteorder != 'little':
+        packed.byteswap()
+    return HEADER.pack(MAGIC, VERSION, typecode, len(packed)) + (
+        packed.tostring())
+
+
+def _decode(typecode, blob):
+    blob = _bytes(blob)
+    magic, version, code, count = HEADER.unpack_from(blob)
+    if magic != MAGIC or version != VERSION or code != typecode:
+        raise ValueError("Not a version %d '%s' series" % (
+            VERSION, typecode))
+    packed = array.array(typecode)
+    packed.fromstring(blob[HEADER.size:])
+    if sys.byteorder != 'little':
+        packed.byteswap()
+    if len(packed) != count:
+        raise ValueError("Truncated series")
+    return packed
+
+
+def encode_times(ts):
+    return _encode('I', ts)
+
+
+def decode_times(blob):
+    """
+    Return the timestamps in an encoded series as an array of ints.
+    """
+    return _decode('I', blob)
+
+
+def encode_values(values):
+    return _encode('f', [NAN if v is None else v for v in values])
+
+
+def decode_values(blob):
+    """
+    Return the values in an encoded series as a list of floats, with None
+    for gaps.
+    """
+    return [None if math.isnan(v) else v for v in _decode('f', blob)]
+
+
+def downsample(times, values, max_points, lows=None, highs=None):
+    """
+    Reduce a series to at most max_points (timestamp, value) points by min/max
+    bucketing. The samples are split into max_points / 2 runs, and each run is
+    drawn as its lowest and highest value, in the order they happened, at the
+    run's first and last timestamps. Series with the same times are split the
+    same way, so they stay aligned. lows and highs are the minimum and maximum
+    behind each value, for series that have already been rolled up.
+    """
+    if len(times) <= max_points:
+        return zip(times, values)
+    if lows is None:
+        lows = values
+    if highs is None:
+        highs = values
+    runs = max_points // 2
+    points = []
+    for run in xrange(runs):
+        start = len(times) * run // runs
+        end = len(times) * (run + 1) // runs
+        present = [i for i in xrange(start, end) if lows[i] is not None]
+        first = last = None
+        if present:
+            low = min(present, key=lows.__getitem__)
+            high = max(present, key=highs.__getitem__)
+            first, last = lows[low], highs[high]
+            if high < low:
+                first, last = last, first
+        points.append((times[start], first))
+        points.append((times[end - 1], last))
+    return points
@@ -1,6 +1,8 @@
 import datetime
 import os
 
+from kombu import Queue
+
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 
@@ -112,10 +114,74 @@ CELERY_IGNORE_RESULT = True
 # Tell Celery where to find the tasks
 CELERY_IMPORTS = ('xenserver.tasks',)
 
+# Tasks are sent primary keys rather than model instances, so messages can be
+# JSON. Pickled messages are still accepted so that anything queued before an
+# upgrade runs; pickle can be dropped from CELERY_ACCEPT_CONTENT once those
+# queues have drained.
+CELERY_TASK_SERIALIZER = 'json'
+CELERY_RESULT_SERIALIZER = 'json'
+CELERY_ACCEPT_CONTENT = ['json', 'pickle']
+
+# Interactive power operations, provisioning and background polling each get
+# their own queue, and their own workers (see config/supervisor.conf), so a
+# burst of polls never delays a click in the UI. Workers only take one
+# message at a time, so a slow task can't hold others back behind it. Tasks
+# that aren't routed anywhere go to the default "celery" queue, which the
+# power workers also consume.
+CELERY_QUEUES = (
+    Queue('celery'),
+    Queue('power'),
+    Queue('provision'),
+    Queue('poll'),
+)
+CELERY_ROUTES = {
+    'xenserver.tasks.start_vm': {'queue': 'power'},
+    'xenserver.tasks.shutdown_vm': {'queue': 'power'},
+    'xenserver.tasks.reboot_vm': {'queue': 'power'},
+    'xenserver.tasks.destroy_vm': {'queue': 'power'},
+    'xenserver.tasks.create_vm': {'queue': 'provision'},
+    'xenserver.tasks.complete_vm': {'queue': 'provision'},
+    'xenserver.tasks.updateVms': {'queue': 'poll'},
+    'xenserver.tasks.updateServer': {'queue': 'poll'},
+    'xenserver.tasks.updateVm': {'queue': 'poll'},
+    'xenserver.tasks.compactMetrics': {'queue': 'poll'},
+}
+CELERYD_PREFETCH_MULTIPLIER = 1
+
+# Poll messages that haven't been picked up within this many seconds of when
+# they were meant to run are thrown away, since a newer poll will be along
+# soon anyway.
+XENZEN_POLL_EXPIRES = 30
+
+# Servers are polled every XENZEN_POLL_INTERVAL seconds (give or take
+# XENZEN_POLL_JITTER of it, so polls spread out over time). A server whose
+# inventory hasn't changed is polled XENZEN_POLL_STRETCH times less often each
+# time, up to XENZEN_POLL_MAX_INTERVAL, and one we can't reach backs off
+# exponentially up to XENZEN_POLL_MAX_BACKOFF. A poll holds a lease on its
+# server for up to XENZEN_POLL_LEASE seconds so polls never overlap. The
+# scheduler looks for servers that are due every XENZEN_POLL_TICK seconds.
+XENZEN_POLL_INTERVAL = 60
+XENZEN_POLL_JITTER = 0.1
+XENZEN_POLL_STRETCH = 1.5
+XENZEN_POLL_MAX_INTERVAL = 300
+XENZEN_POLL_MAX_BACKOFF = 900
+XENZEN_POLL_LEASE = 120
+XENZEN_POLL_TICK = 10
+
+# How many servers the xenzen_poll command fetches from at once, and how
+# many threads write the results to the database. Up to
+# XENZEN_POLL_QUEUE_SIZE fetched servers wait to be written, in batches of up
+# to XENZEN_POLL_BATCH_SIZE per transaction.
+XENZEN_POLL_WORKERS = 32
+XENZEN_POLL_APPLIERS = 2
+XENZEN_POLL_QUEUE_SIZE = 64
+XENZEN_POLL_BATCH_SIZE = 16
+
 CELERYBEAT_SCHEDULE = {
     'update-servers': {
         'task': 'xenserver.tasks.updateVms',
-        'schedule': datetime.timedelta(seconds=60)
+        'schedule': datetime.timedelta(seconds=XENZEN_POLL_TICK),
+        'options': {'expires': XENZEN_POLL_TICK},
     }
 }
 
@@ -147,6 +213,80 @@ PRETEND_MODE = False
 # XenServer host
 XENZEN_XENAPI_IGNORE_SSL = False
 
+# XenAPI sessions are pooled and reused between tasks. Sessions that have been
+# idle for longer than this many seconds are logged out.
+XENZEN_XENAPI_SESSION_MAX_IDLE = 300
+
+# Each worker process keeps up to this many idle HTTPS connections open to
+# each host, and closes connections that have been idle for longer than the
+# timeout (in seconds).
+XENZEN_XENAPI_CONNECTION_POOL_SIZE = 4
+XENZEN_XENAPI_CONNECTION_IDLE_TIMEOUT = 30
+
+# Give up (with xenapi.Timeout) on a host that takes longer than this many
+# seconds to accept a connection, or to send any part of a response. Calls
+# like VM.start and VM.shutdown block until the operation is done, so the
+# power and provisioning tasks wait up to XENZEN_XENAPI_OPERATION_TIMEOUT
+# for a response instead (though the tasks' own time limits still apply).
+XENZEN_XENAPI_CONNECT_TIMEOUT = 5
+XENZEN_XENAPI_READ_TIMEOUT = 30
+XENZEN_XENAPI_OPERATION_TIMEOUT = 600
+
+# Each worker, poller and watcher process logs its XenAPI call statistics to
+# the xenserver.call_stats logger every this many seconds.
+XENZEN_XENAPI_STATS_INTERVAL = 300
+
+# Each poll of a server (updateServer and updateVm) must finish its XenAPI
+# calls within this many seconds, so one hung host can't tie up a worker.
+XENZEN_POLL_DEADLINE = 20
+
+# The xenzen_watch command follows each server's event stream, waiting up to
+# XENZEN_EVENT_TIMEOUT seconds for each batch of events. While a watcher is
+# running for a server, the regular poll only fetches its whole VM inventory
+# every XENZEN_FULL_SYNC_INTERVAL seconds.
+XENZEN_EVENT_TIMEOUT = 30
+XENZEN_FULL_SYNC_INTERVAL = 900
+
+# The poll only fetches the VMs that match this xapi filter expression (as
+# used by VM.get_all_records_where), so templates and the control domain
+# never leave the server.
+XENZEN_VM_FILTER = (
+    'field "is_a_template"="false" and field "is_control_domain"="false"')
+
+# We keep XENZEN_RRD_WINDOW seconds of each VM's raw RRD samples. Each poll
+# only fetches the samples since the newest one we've stored, at
+# XENZEN_RRD_INTERVAL second resolution. If that's more than
+# XENZEN_RRD_MAX_GAP seconds ago (xapi only keeps minute samples for a couple
+# of hours), or we've never fetched any, the poll fetches the whole window.
+# That export is coarser, so it only fills in around the samples we've kept.
+XENZEN_RRD_WINDOW = 86400
+XENZEN_RRD_INTERVAL = 60
+XENZEN_RRD_MAX_GAP = 3600
+
+# Every XENZEN_METRICS_COMPACT_INTERVAL seconds, the compactMetrics task folds
+# each VM's raw samples into buckets of each resolution in
+# XENZEN_METRICS_ROLLUPS, as (resolution, retention) in seconds, with the
+# minimum, average, maximum and last sample in each. Buckets are kept for
+# their retention, and raw samples for XENZEN_RRD_WINDOW, so a VM's metrics
+# take the same space however long it runs. Samples are only folded while
+# they're still raw, so XENZEN_RRD_WINDOW must be longer than the largest
+# resolution (plus the compaction interval).
+XENZEN_METRICS_ROLLUPS = (
+    (300, 7 * 86400),
+    (3600, 400 * 86400),
+)
+XENZEN_METRICS_COMPACT_INTERVAL = 300
+
+# get_metrics downsamples each series to at most this many points, unless
+# it's asked for another max_points.
+XENZEN_METRICS_MAX_POINTS = 400
+
+CELERYBEAT_SCHEDULE['compact-metrics'] = {
+    'task': 'xenserver.tasks.compactMetrics',
+    'schedule': datetime.timedelta(seconds=XENZEN_METRICS_COMPACT_INTERVAL),
+    'options': {'expires': XENZEN_METRICS_COMPACT_INTERVAL},
+}
+
 try:
     from local_settings import *  # noqa: F401, F403
 except ImportError:
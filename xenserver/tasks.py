@@ -1,22 +1,50 @@
 from __future__ import absolute_import
 
+import bisect
+import hashlib
+import httplib
 import json
+import logging
+import random
+import re
+import socket
 import time
 import urllib2
+from contextlib import contextmanager
+from datetime import timedelta
 from uuid import uuid4
 
+from celery.signals import task_postrun
 from celery.utils.log import get_task_logger
 from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, IntegerField, Q, Value, When
+from django.utils import timezone
 from lxml import etree
 
 import xenapi
-from xenserver import iputil
+from xenserver import iputil, series
 from xenserver.celery import app
 from xenserver.models import (
-    Addresses, AddressPool, XenMetrics, XenServer, XenVM)
+    Addresses, AddressPool, Template, XenMetricRollup, XenMetrics,
+    XenMetricTimes, XenServer, XenVM)
 
 
 logger = get_task_logger(__name__)
+stats_logger = logging.getLogger('xenserver.call_stats')
+
+
+# The only VM record fields we use when syncing the inventory.
+VM_FIELDS = [
+    'name_label', 'uuid', 'power_state', 'VCPUs_max', 'memory_static_max',
+    'is_a_template', 'is_control_domain', 'guest_metrics']
+
+# The host and host_metrics fields we use when polling a pool's hosts.
+HOST_FIELDS = ['hostname', 'address', 'cpu_info', 'metrics']
+HOST_METRICS_FIELDS = ['memory_total', 'memory_free']
+
+# How many VMs' metrics compactMetrics loads and writes at a time.
+COMPACT_BATCH_SIZE = 100
 
 
 class StorageError(Exception):
@@ -27,131 +55,342 @@ class NetworkError(Exception):
     pass
 
 
-def getSession(hostname, username, password):
-    url = 'https://%s:443/' % (hostname)
-    # First acquire a valid session by logging in:
-    session = xenapi.Session(url, ignore_ssl=settings.XENZEN_XENAPI_IGNORE_SSL)
-    session.xenapi.login_with_password(username, password)
+# Keep-alive HTTPS connections to each host, shared by every session in this
+# worker process.
+connection_pool = xenapi.ConnectionPool(
+    maxsize=settings.XENZEN_XENAPI_CONNECTION_POOL_SIZE,
+    idle_timeout=settings.XENZEN_XENAPI_CONNECTION_IDLE_TIMEOUT)
 
-    return session
 
+# Statistics for every XenAPI call made by this process, by host and method,
+# and when logCallStats() last logged them.
+call_stats = xenapi.CallStats()
+stats_logged = time.time()
 
-def getHostMetrics(session, hostname):
-    t = time.time()-86400
 
-    uri = 'http://%s/rrd_updates?session_id=%s&start=%s&host=true' % (
-        hostname, session._session, int(t))
+def newSession(hostname):
+    url = 'https://%s:443/' % (hostname)
+    transport = xenapi.PooledTransport(
+        connection_pool, ignore_ssl=settings.XENZEN_XENAPI_IGNORE_SSL,
+        connect_timeout=settings.XENZEN_XENAPI_CONNECT_TIMEOUT,
+        read_timeout=settings.XENZEN_XENAPI_READ_TIMEOUT)
+    session = xenapi.Session(url, transport=transport)
+    session.call_hooks.append(call_stats)
+    return session
 
-    u = urllib2.urlopen(uri)
 
-    tree = etree.parse(u)
+def logCallStats(now=None):
+    """
+    Log this process's XenAPI call statistics, one line per host and method,
+    unless they were logged less than XENZEN_XENAPI_STATS_INTERVAL seconds
+    ago. The numbers are totals since the process started, so whatever
+    collects the log can work out rates. Returns whether they were logged.
+    """
+    global stats_logged
+    if now is None:
+        now = time.time()
+    if now - stats_logged < settings.XENZEN_XENAPI_STATS_INTERVAL:
+        return False
+    stats_logged = now
+    for (host, method), stats in sorted(call_stats.snapshot().items()):
+        stats_logger.info(
+            "host=%s method=%s calls=%d errors=%d retries=%d seconds=%.3f "
+            "request_bytes=%d response_bytes=%d", host, method,
+            stats['count'], stats['errors'], stats['retries'],
+            stats['seconds'], stats['request_bytes'],
+            stats['response_bytes'])
+    return True
+
+
+@task_postrun.connect
+def logCallStatsAfterTask(**kwargs):
+    # Each worker process logs its own statistics as it runs tasks.
+    logCallStats()
+
+
+# Sessions are shared between all the tasks that run in a worker process, so
+# we don't pay for a login and logout every time we talk to a host.
+session_pool = xenapi.SessionPool(
+    newSession, max_idle=settings.XENZEN_XENAPI_SESSION_MAX_IDLE)
 
-    rows = tree.xpath('/xport/data/row')
 
-    legend = tree.xpath('/xport/meta/legend/entry')
+def getSession(hostname, username, password):
+    # Borrow a valid session from the pool, logging in if necessary:
+    return session_pool.acquire(hostname, username, password)
+
+
+def releaseSession(session, discard=False):
+    session_pool.release(session, discard=discard)
+
+
+@contextmanager
+def xenserverSession(xenserver, deadline=None, read_timeout=None):
+    """
+    Borrow a session for the given XenServer for the duration of a with block.
+
+    If deadline is given, every call in the block (including logging in) gives
+    up with xenapi.Timeout once that many seconds have passed. If read_timeout
+    is given, it replaces XENZEN_XENAPI_READ_TIMEOUT for the calls in the
+    block, for calls that block until an operation is done.
+    """
+    if deadline is None:
+        limit = nullcontext()
+    else:
+        limit = xenapi.deadline(deadline)
+    if read_timeout is None:
+        timeout = nullcontext()
+    else:
+        timeout = xenapi.read_timeout(read_timeout)
+    with limit, timeout:
+        session = getSession(
+            xenserver.hostname, xenserver.username, xenserver.password)
+        discard = False
+        try:
+            yield session
+        except (socket.error, xenapi.Timeout):
+            # The host (or the pool master we were redirected to) isn't
+            # answering, so don't reuse the session or the redirect.
+            discard = True
+            raise
+        except xenapi.Failure, e:
+            # The master we were redirected to has been demoted.
+            discard = e.details[0] == 'HOST_IS_SLAVE'
+            raise
+        finally:
+            releaseSession(session, discard=discard)
+
+
+@contextmanager
+def nullcontext():
+    yield
+
+
+def getInstance(model, value, *related):
+    """
+    Fetch the object a task argument refers to. Tasks are sent primary keys,
+    but messages queued before we switched may still carry pickled model
+    instances, so we accept those too and refetch them rather than act on a
+    stale snapshot.
+    """
+    if isinstance(value, model):
+        value = value.pk
+    queryset = model.objects.all()
+    if related:
+        queryset = queryset.select_related(*related)
+    return queryset.get(pk=value)
+
+
+def findHost(session, hostname):
+    """
+    Return the ref of the host with the given hostname or address. A session
+    for a pool can see all of the pool's hosts, and may be connected to the
+    master rather than the host we asked for.
+    """
+    hosts = session.xenapi.host.get_all()
+    if len(hosts) == 1:
+        return hosts[0]
+    records = session.project(['hostname', 'address']).host.get_all_records()
+    for ref, record in records.items():
+        if hostname in (record.get('hostname'), record.get('address')):
+            return ref
+    pool = session.xenapi.pool.get_all()[0]
+    return session.xenapi.pool.get_master(pool)
+
+
+def pickHost(hosts, master, hostname):
+    """
+    Return the ref of the host with the given hostname or address, from a
+    pool's host records. If there's no such host, we must be talking to the
+    pool master on its behalf.
+    """
+    if len(hosts) == 1:
+        return hosts.keys()[0]
+    for ref, record in hosts.items():
+        if hostname in (record.get('hostname'), record.get('address')):
+            return ref
+    return master
+
+
+def hostResources(host, metrics):
+    """
+    Return the XenServer fields for a host and host_metrics record.
+    """
+    return {
+        'cores': int(host['cpu_info']['cpu_count']),
+        'memory': int(metrics['memory_total']) / 1048576,
+        'mem_free': int(metrics['memory_free']) / 1048576,
+    }
+
 
-    items = {}
-    keys = []
+def updateMembers(xenserver, pool_uuid, members):
+    """
+    Record the resources of the other hosts in a server's pool, given as a
+    dict of resources by hostname or address, in a single UPDATE.
+    """
+    servers = dict(XenServer.objects.filter(hostname__in=members.keys(
+    )).exclude(pk=xenserver.pk).values_list('pk', 'hostname'))
+    if not servers:
+        return 0
+
+    def case(field):
+        return Case(*[
+            When(pk=pk, then=Value(members[hostname][field]))
+            for pk, hostname in servers.items()
+        ], output_field=IntegerField())
+
+    return XenServer.objects.filter(pk__in=servers.keys()).update(
+        cores=case('cores'), memory=case('memory'),
+        mem_free=case('mem_free'), pool_uuid=pool_uuid)
+
+
+def getRecords(session, cls, refs):
+    """
+    Fetch the records for the given refs in a single batch, skipping any
+    objects that have vanished since we listed them. Any other failure is
+    raised.
+    """
+    results = session.batch([('%s.get_record' % cls, (ref,)) for ref in refs])
+    records = []
+    for ref, rec in zip(refs, results):
+        if isinstance(rec, xenapi.Failure):
+            if rec.details[0] == 'HANDLE_INVALID':
+                continue
+            raise rec
+        records.append((ref, rec))
+    return records
+
+
+def getHostMetrics(session, hostname, start=None, interval=None):
+    if start is None:
+        start = time.time() - settings.XENZEN_RRD_WINDOW
 
-    for i, l in enumerate(legend):
-        key = l.text
-        items[key] = []
-        keys.append(key)
+    uri = 'http://%s/rrd_updates?session_id=%s&start=%s&host=true' % (
+        hostname, session._session, int(start))
+    if interval is not None:
+        uri += '&interval=%d' % (interval,)
 
-    cpu_all = []
+    u = urllib2.urlopen(
+        uri, timeout=xenapi.time_left(settings.XENZEN_XENAPI_READ_TIMEOUT))
+    try:
+        return parseRrdUpdates(u)
+    finally:
+        u.close()
+
+
+def parseRrdUpdates(source):
+    """
+    Parse an rrd_updates export as it streams in. Returns the host's average
+    CPU utilisation (as a percentage), the row timestamps, and each VM's
+    series (with None for gaps) by VM uuid and metric name.
+
+    The legend comes before the data, so we split each legend key into its
+    (cf, type, oid, metric) parts once and work out which series (if any)
+    each column belongs to. Each row is then appended to those series and
+    thrown away, so memory use doesn't grow with the size of the export.
+    """
+    columns = None
+    cpu_total = 0.0
+    cpu_count = 0
     dhash = {}
     ts = []
 
-    for r in rows:
-        t = r.xpath('t')[0].text
-        ts.append(int(t))
-
-        values = r.xpath('v')
-        for k, v in zip(keys, values):
-            cf, rt, oid, key = k.split(':')
-            if cf == 'AVERAGE':
-                if rt == 'host' and key != 'cpu_avg' and key.startswith('cpu'):
-                    if v.text == 'NaN':
-                        continue
-                    cpu_all.append(float(v.text))
-
-                if rt == 'vm':
-                    if oid not in dhash:
-                        dhash[oid] = {}
-
-                    if key not in dhash[oid]:
-                        dhash[oid][key] = []
-
-                    if v.text == 'NaN':
-                        dhash[oid][key].append(None)
-                    else:
-                        dhash[oid][key].append(float(v.text))
-
-    cpu_host = int((sum(cpu_all)/len(cpu_all))*100)
+    for _, elem in etree.iterparse(source, tag=('legend', 'row')):
+        if elem.tag == 'legend':
+            columns = []
+            for entry in elem.iterchildren('entry'):
+                cf, rt, oid, key = entry.text.split(':')
+                if cf != 'AVERAGE':
+                    columns.append(None)
+                elif rt == 'vm':
+                    columns.append(dhash.setdefault(oid, {}).setdefault(
+                        key, []))
+                elif (rt == 'host' and key != 'cpu_avg' and
+                      key.startswith('cpu')):
+                    columns.append(True)
+                else:
+                    columns.append(None)
+        else:
+            values = elem.iterchildren()
+            ts.append(int(next(values).text))
+            for column, v in zip(columns, values):
+                if column is None:
+                    continue
+                value = None if v.text == 'NaN' else float(v.text)
+                if column is True:
+                    if value is not None:
+                        cpu_total += value
+                        cpu_count += 1
+                else:
+                    column.append(value)
+        # Drop what we've parsed, including the now-empty earlier rows.
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+    cpu_host = int((cpu_total / cpu_count) * 100) if cpu_count else 0
     return cpu_host, ts, dhash
 
 
 @app.task(time_limit=60)
 def shutdown_vm(vm):
+    vm = getInstance(XenVM, vm, 'xenserver')
     xenserver = vm.xenserver
-    session = getSession(
-        xenserver.hostname, xenserver.username, xenserver.password)
-
     logger.info("Stopping %s on %s" % (vm.name, xenserver.hostname))
 
-    session.xenapi.VM.shutdown(vm.xsref)
-    session.xenapi.session.logout()
+    with xenserverSession(
+            xenserver,
+            read_timeout=settings.XENZEN_XENAPI_OPERATION_TIMEOUT) as session:
+        session.xenapi.VM.shutdown(vm.xsref)
 
 
 @app.task(time_limit=60)
 def reboot_vm(vm):
+    vm = getInstance(XenVM, vm, 'xenserver')
     xenserver = vm.xenserver
-    session = getSession(
-        xenserver.hostname, xenserver.username, xenserver.password)
-
     logger.info("Rebooting %s on %s" % (vm.name, xenserver.hostname))
 
-    session.xenapi.VM.hard_reboot(vm.xsref)
-    session.xenapi.session.logout()
+    with xenserverSession(
+            xenserver,
+            read_timeout=settings.XENZEN_XENAPI_OPERATION_TIMEOUT) as session:
+        session.xenapi.VM.hard_reboot(vm.xsref)
 
 
 @app.task(time_limit=60)
 def start_vm(vm):
+    vm = getInstance(XenVM, vm, 'xenserver')
     xenserver = vm.xenserver
-    session = getSession(
-        xenserver.hostname, xenserver.username, xenserver.password)
-
     logger.info("Starting %s on %s" % (vm.name, xenserver.hostname))
 
-    session.xenapi.VM.start(vm.xsref, False, True)
-    session.xenapi.session.logout()
+    with xenserverSession(
+            xenserver,
+            read_timeout=settings.XENZEN_XENAPI_OPERATION_TIMEOUT) as session:
+        session.xenapi.VM.start(vm.xsref, False, True)
 
 
 @app.task(time_limit=120)
 def destroy_vm(vm):
+    vm = getInstance(XenVM, vm, 'xenserver')
     xenserver = vm.xenserver
-    session = getSession(
-        xenserver.hostname, xenserver.username, xenserver.password)
-
     logger.info("Terminating %s on %s" % (vm.name, xenserver.hostname))
 
-    vmobj = session.xenapi.VM.get_record(vm.xsref)
+    with xenserverSession(
+            xenserver,
+            read_timeout=settings.XENZEN_XENAPI_OPERATION_TIMEOUT) as session:
+        vmobj = session.xenapi.VM.get_record(vm.xsref)
 
-    try:
-        session.xenapi.VM.hard_shutdown(vm.xsref)
-    except:
-        pass
+        try:
+            session.xenapi.VM.hard_shutdown(vm.xsref)
+        except:
+            pass
 
-    # Get attached VBDs and destroy any attached disk VDIs
-    vbds = vmobj['VBDs']
-    for vbref in vbds:
-        vbd = session.xenapi.VBD.get_record(vbref)
-        if vbd['type'] == 'Disk':
-            vdi = vbd['VDI']
-            session.xenapi.VDI.destroy(vdi)
+        # Get attached VBDs and destroy any attached disk VDIs
+        vbds = vmobj['VBDs']
+        for vbref, vbd in getRecords(session, 'VBD', vbds):
+            if vbd['type'] == 'Disk':
+                vdi = vbd['VDI']
+                session.xenapi.VDI.destroy(vdi)
 
-    session.xenapi.VM.destroy(vm.xsref)
-    session.xenapi.session.logout()
+        session.xenapi.VM.destroy(vm.xsref)
 
     vm.delete()
 
@@ -181,162 +420,858 @@ def updateAddress(server, vm, ip, pool=None):
         addr.save()
 
 
-@app.task(time_limit=60)
-def updateVm(xenserver, vmref, vmobj):
-    if (not vmobj['is_a_template']) and (not vmobj['is_control_domain']):
+def isGuest(vmobj):
+    return (not vmobj['is_a_template']) and (not vmobj['is_control_domain'])
+
+
+def vmFields(xenserver, vmref, vmobj, netip):
+    """
+    Return the XenVM fields we derive from a guest VM record from xapi,
+    including their fingerprint. The ip is only included if we know it.
+    """
+    fields = {
+        'xsref': vmref,
+        'uuid': vmobj['uuid'],
+        'name': vmobj['name_label'],
+        'status': vmobj['power_state'],
+        'sockets': int(vmobj['VCPUs_max']),
+        'memory': int(vmobj['memory_static_max']) / 1048576,
+        'xenserver_id': xenserver.pk,
+    }
+    if netip:
+        fields['ip'] = netip
+    fields['fingerprint'] = fingerprint(fields)
+    return fields
+
+
+def syncVm(xenserver, vmref, vmobj, netip):
+    """
+    Create or update the XenVM for a guest VM record from xapi.
+    """
+    fields = vmFields(xenserver, vmref, vmobj, netip)
+
+    # The VM may have been synced through another host, renamed or migrated,
+    # but its uuid stays the same. VMs we're still provisioning don't have a
+    # uuid yet, so we fall back to their name.
+    vm = XenVM.objects.filter(
+        Q(uuid=fields['uuid']) | Q(xsref=vmref)).order_by('uuid').first()
+    if vm is None:
+        vm = XenVM.objects.filter(
+            Q(uuid=None) | Q(uuid=''), xenserver=xenserver,
+            name=fields['name']).first()
+    if vm is not None:
+        for name, value in fields.items():
+            setattr(vm, name, value)
+        vm.save()
+    else:
+        fields.setdefault('ip', '')
+        vm = XenVM.objects.create(**fields)
+
+    # Update the address table
+    if netip:
         try:
-            session = getSession(
-                xenserver.hostname, xenserver.username, xenserver.password)
-            netip = session.xenapi.VM_guest_metrics.get_record(
-                        vmobj['guest_metrics']
-                    )['networks']['0/ip']
-            session.xenapi.session.logout()
+            updateAddress(xenserver, vm, netip)
         except:
-            netip = ''
+            pass
+
+    return vm
+
+
+def poolVms(xenserver):
+    """
+    Return the XenVMs on the given server, or on any server in its pool.
+    Every host in a pool sees the same VMs, so its inventory is synced
+    through one of them.
+    """
+    if xenserver.pool_uuid:
+        return XenVM.objects.filter(xenserver__pool_uuid=xenserver.pool_uuid)
+    return XenVM.objects.filter(xenserver=xenserver)
+
+
+def poolLeaders(servers):
+    """
+    Pick the server to sync each pool's inventory through, by pool uuid:
+    the first active server that isn't failing its polls, or failing that,
+    the first server.
+    """
+    leaders = {}
+    for xenserver in sorted(servers, key=lambda xs: (
+            not xs.active, xs.poll_failures > 0, xs.pk)):
+        if xenserver.pool_uuid:
+            leaders.setdefault(xenserver.pool_uuid, xenserver.pk)
+    return leaders
+
+
+def purgeVms(xenserver, vmrefs):
+    """
+    Delete the XenVMs on the given server (or its pool) that xapi no longer
+    knows about.
+    """
+    vmrefs = list(vmrefs)
 
-        name = vmobj['name_label']
+    # Prevent cleaning an unreferenced VM
+    for vm in XenVM.objects.filter(xsref__startswith='TEMPREF'):
+        vmrefs.append(vm.xsref)
 
-        try:
-            vm = XenVM.objects.get(xenserver=xenserver, name=name)
-            vm.name = name
-            vm.status = vmobj['power_state']
-            vm.sockets = int(vmobj['VCPUs_max'])
-            vm.memory = int(vmobj['memory_static_max']) / 1048576
-            vm.uuid = vmobj['uuid']
-            vm.xenserver = xenserver
-            vm.xsref = vmref
-
-            if netip:
-                vm.ip = netip
-
-        except XenVM.DoesNotExist:
-            vm = XenVM.objects.create(
-                xsref=vmref,
-                uuid=vmobj['uuid'],
-                name=name,
-                status=vmobj['power_state'],
-                sockets=int(vmobj['VCPUs_max']),
-                memory=int(vmobj['memory_static_max']) / 1048576,
-                xenserver=xenserver,
-                ip=netip
-            )
+    # Purge lost VM's
+    poolVms(xenserver).exclude(xsref__in=vmrefs).delete()
 
-        vm.save()
 
-        # Update the address table
-        if netip:
-            try:
-                updateAddress(xenserver, vm, netip)
-            except:
-                pass
+def guestNetworks(session):
+    """
+    Return the networks map of every VM_guest_metrics object, by ref, fetched
+    in a single call.
+    """
+    records = session.project(['networks']).VM_guest_metrics.get_all_records()
+    return dict((ref, rec.get('networks', {})) for ref, rec in records.items())
 
 
-@app.task(time_limit=60)
-def updateServer(xenserver):
-    session = getSession(
-        xenserver.hostname, xenserver.username, xenserver.password)
+# Guest agents report addresses as <device>/ip (older agents, IPv4 only) or
+# <device>/ipv4/<n> and <device>/ipv6/<n>.
+GUEST_ADDRESS_RE = re.compile(r'^(\d+)/ip(?:(v4|v6)/(\d+))?$')
+
 
-    # get server info
-    host = session.xenapi.host.get_all()[0]
-    host_info = session.xenapi.host.get_record(host)
-    cores = int(host_info['cpu_info']['cpu_count'])
+def guestAddresses(networks):
+    """
+    Return all the addresses in a guest metrics networks map, ordered by
+    device with IPv4 addresses first, so the first one is the primary one.
+    """
+    keyed = []
+    for key, ip in networks.items():
+        match = GUEST_ADDRESS_RE.match(key)
+        if match is None or not ip:
+            continue
+        device, family, index = match.groups()
+        keyed.append(((int(device), family == 'v6', int(index or 0)), ip))
+    addresses = []
+    for _, ip in sorted(keyed):
+        if ip not in addresses:
+            addresses.append(ip)
+    return addresses
+
+
+def primaryIp(addresses):
+    for ip in addresses:
+        if ':' not in ip:
+            return ip
+    return ''
+
+
+def fingerprint(*values):
+    """
+    Return a short digest of the given (JSON-serialisable) values, so we can
+    tell whether anything we derived from xapi has changed without reading
+    the stored values back.
+    """
+    return hashlib.sha1(json.dumps(values, sort_keys=True)).hexdigest()
+
+
+def reconcileVms(xenserver, vms, networks):
+    """
+    Bring the XenVMs for a server in line with its whole inventory of guest VM
+    records (by ref) in one pass: new VMs are created in bulk, changed ones
+    are updated, and the ones xapi no longer knows about are deleted, all in
+    a single transaction. networks maps guest metrics refs to their networks,
+    as returned by guestNetworks().
+
+    VMs are matched by uuid, so renaming a VM or migrating it from another
+    server is an update rather than a delete and create. Each XenVM stores a
+    fingerprint of the fields we derive from its record, and VMs whose
+    fingerprint hasn't changed aren't written at all. The inventory covers
+    the server's whole pool, so XenVMs on any server in the pool that don't
+    match a VM in it are deleted. Returns the number of VMs created, updated,
+    left unchanged and deleted.
+    """
+    uuids = [vmobj['uuid'] for vmobj in vms.values()]
+    pool_refs = dict(poolVms(xenserver).values_list('pk', 'xsref'))
+    existing = XenVM.objects.filter(
+        Q(pk__in=pool_refs.keys()) | Q(uuid__in=uuids) |
+        Q(xsref__in=vms.keys())).only(
+        'xsref', 'uuid', 'name', 'xenserver', 'fingerprint')
+    by_uuid = {}
+    by_ref = {}
+    by_name = {}
+    for vm in existing:
+        if vm.uuid:
+            by_uuid[vm.uuid] = vm
+        by_ref[vm.xsref] = vm
+        if vm.pk in pool_refs and not vm.uuid:
+            by_name.setdefault(vm.name, vm)
+
+    created = []
+    updates = []
+    addresses = {}
+    seen = set()
+    for vmref, vmobj in vms.items():
+        addresses[vmref] = guestAddresses(
+            networks.get(vmobj['guest_metrics'], {}))
+        fields = vmFields(
+            xenserver, vmref, vmobj, primaryIp(addresses[vmref]))
+
+        # A VM we've only just provisioned may not have a uuid yet, and may
+        # still have a temporary ref, so fall back to its name.
+        vm = by_uuid.get(fields['uuid']) or by_ref.get(vmref)
+        if vm is None:
+            vm = by_name.get(fields['name'])
+            if vm is not None and (vm.pk in seen or vm.xsref in vms):
+                vm = None
+        if vm is None:
+            fields.setdefault('ip', '')
+            created.append(XenVM(**fields))
+            continue
+
+        seen.add(vm.pk)
+        if vm.fingerprint != fields['fingerprint']:
+            updates.append((vm.pk, fields))
+
+    with transaction.atomic():
+        for pk, fields in updates:
+            XenVM.objects.filter(pk=pk).update(**fields)
+        XenVM.objects.bulk_create(created)
+        # Delete what we didn't match, including duplicates of VMs we did,
+        # but not VMs that are still being provisioned.
+        stale = [pk for pk, xsref in pool_refs.items()
+                 if pk not in seen and not xsref.startswith('TEMPREF')]
+        if stale:
+            XenVM.objects.filter(pk__in=stale).delete()
+
+    reconcileAddresses(xenserver, addresses)
+    return {
+        'created': len(created),
+        'updated': len(updates),
+        'unchanged': len(seen) - len(updates),
+        'deleted': len(stale),
+    }
+
+
+def reconcileAddresses(xenserver, addresses):
+    """
+    Point the address table entries for every address of every VM (given as
+    lists of addresses by VM ref) at that VM, creating entries for addresses
+    in one of the zone's pools, in a handful of queries. Like updateAddress,
+    this only handles IPv4 addresses.
+    """
+    wanted = {}
+    for vmref, ips in addresses.items():
+        for ip in ips:
+            if ':' not in ip:
+                wanted[iputil.stoip(ip)] = (ip, vmref)
+    if not wanted:
+        return
 
-    xenserver.cores = cores
+    pools = [(pool, iputil.ipcalc(pool.subnet)) for pool in
+             AddressPool.objects.filter(zone=xenserver.zone)]
+    # bulk_create doesn't give us primary keys, so look the VMs up again.
+    vm_ids = dict(XenVM.objects.filter(
+        xsref__in=addresses.keys()).values_list('xsref', 'pk'))
+    existing = dict(
+        (addr.ip_int, addr) for addr in
+        Addresses.objects.filter(ip_int__in=wanted.keys()))
+
+    created = []
+    moved = {}
+    for ip_int, (ip, vmref) in wanted.items():
+        vm_id = vm_ids.get(vmref)
+        if vm_id is None:
+            continue
+        addr = existing.get(ip_int)
+        if addr is not None:
+            if addr.vm_id != vm_id:
+                moved.setdefault(vm_id, []).append(addr.pk)
+            continue
+        for pool, (_, first, last, _) in pools:
+            if first <= ip_int <= last:
+                created.append(Addresses(
+                    ip=ip, ip_int=ip_int, version=4, vm_id=vm_id, pool=pool))
+                break
 
-    metrics = session.xenapi.host_metrics.get_record(
-        session.xenapi.host.get_metrics(host)
-    )
-    memory = metrics['memory_total']
-    mem_free = metrics['memory_free']
+    with transaction.atomic():
+        for vm_id, pks in moved.items():
+            Addresses.objects.filter(pk__in=pks).update(vm=vm_id)
+        Addresses.objects.bulk_create(created)
+
+
+def needsFullSync(xenserver, now=None):
+    """
+    Decide whether a poll should fetch the server's whole VM inventory. While
+    an event watcher is keeping the inventory up to date, we only do that
+    every XENZEN_FULL_SYNC_INTERVAL seconds as a safety net.
+    """
+    if now is None:
+        now = timezone.now()
+    heartbeat_cutoff = now - timedelta(
+        seconds=3 * settings.XENZEN_EVENT_TIMEOUT)
+    if (xenserver.event_heartbeat is None or
+            xenserver.event_heartbeat < heartbeat_cutoff):
+        return True
+    if xenserver.last_full_sync is None:
+        return True
+    return xenserver.last_full_sync < now - timedelta(
+        seconds=settings.XENZEN_FULL_SYNC_INTERVAL)
 
-    xenserver.memory = int(memory) / 1048576
-    xenserver.mem_free = int(mem_free) / 1048576
 
+@app.task(time_limit=60)
+def updateVm(xenserver, vmref, vmobj):
+    xenserver = getInstance(XenServer, xenserver)
+    if isGuest(vmobj):
+        try:
+            with xenserverSession(
+                    xenserver, deadline=settings.XENZEN_POLL_DEADLINE
+            ) as session:
+                netip = session.xenapi.VM_guest_metrics.get_record(
+                            vmobj['guest_metrics']
+                        )['networks']['0/ip']
+        except:
+            netip = ''
+
+        syncVm(xenserver, vmref, vmobj, netip)
+
+
+@app.task(time_limit=60)
+def updateServer(xenserver, inventory=True):
+    try:
+        xenserver = getInstance(XenServer, xenserver)
+    except XenServer.DoesNotExist:
+        logger.info("Server %s was deleted before it was polled", xenserver)
+        return
     try:
-        xenserver.cpu_util, ts, vmstats = getHostMetrics(
-            session, xenserver.hostname)
-    except:
-        xenserver.cpu_util = 0
-        vmstats = {}
-        ts = []
+        changed = pollServer(xenserver, inventory)
+    except Exception:
+        finishPoll(xenserver, failed=True)
+        raise
+    finishPoll(xenserver, changed=changed)
+
+
+def pollServer(xenserver, inventory=True):
+    """
+    Update a server's resource usage and VM metrics, and its VM inventory if
+    asked to. Returns whether the inventory changed (None if not synced).
+    """
+    return applySnapshot(xenserver, fetchServer(xenserver, inventory))
+
+
+def fetchServer(xenserver, inventory=True):
+    """
+    Fetch everything a poll of a server needs, without touching the database.
+    Returns a snapshot to pass to applySnapshot().
+    """
+    snapshot = {'inventory': inventory, 'fetched': timezone.now()}
+    with xenserverSession(
+            xenserver, deadline=settings.XENZEN_POLL_DEADLINE) as session:
+        # Get every host in the pool, and its metrics, in one call each.
+        hosts = session.project(HOST_FIELDS).host.get_all_records()
+        metrics = session.project(
+            HOST_METRICS_FIELDS).host_metrics.get_all_records()
+        [pool] = session.project(
+            ['master', 'uuid']).pool.get_all_records().values()
+        resources = {}
+        for ref, host in hosts.items():
+            host_metrics = metrics.get(host['metrics'])
+            if host_metrics is not None:
+                resources[ref] = hostResources(host, host_metrics)
+
+        ref = pickHost(hosts, pool['master'], xenserver.hostname)
+        snapshot['server'] = {'pool_uuid': pool['uuid']}
+        if ref in resources:
+            snapshot['server'].update(resources[ref])
+        else:
+            logger.warning(
+                "No host metrics for %s, so its resources weren't updated",
+                xenserver.hostname)
+        # The other hosts in the pool, by every name we might know them by.
+        snapshot['members'] = {}
+        for member, host in hosts.items():
+            if member == ref or member not in resources:
+                continue
+            for name in (host.get('hostname'), host.get('address')):
+                if name:
+                    snapshot['members'][name] = resources[member]
+
+        # Only fetch the RRD samples we haven't seen, unless we've never
+        # fetched any or it's been too long.
+        cursor = xenserver.rrd_cursor
+        incremental = cursor is not None and (
+            time.time() - cursor <= settings.XENZEN_RRD_MAX_GAP)
+        try:
+            if incremental:
+                cpu_util, ts, vmstats = getHostMetrics(
+                    session, xenserver.hostname, start=cursor,
+                    interval=settings.XENZEN_RRD_INTERVAL)
+            else:
+                cpu_util, ts, vmstats = getHostMetrics(
+                    session, xenserver.hostname)
+        except (IOError, httplib.HTTPException, etree.LxmlError,
+                ValueError) as e:
+            # The rest of the poll can go ahead without the samples, and the
+            # next one will fetch them from the same cursor. Anything else
+            # (such as running out of time) fails the poll.
+            logger.warning(
+                "Failed to fetch RRD updates from %s: %s",
+                xenserver.hostname, e)
+            vmstats = {}
+            ts = []
+        else:
+            snapshot['server']['cpu_util'] = cpu_util
+        snapshot['ts'] = ts
+        snapshot['vmstats'] = vmstats
+        snapshot['incremental'] = incremental
+
+        if inventory:
+            # List the guest VMs, leaving xapi to filter out the rest.
+            snapshot['vms'] = session.project(
+                VM_FIELDS).VM.get_all_records_where(settings.XENZEN_VM_FILTER)
+            snapshot['networks'] = guestNetworks(session)
+    return snapshot
+
+
+def applySnapshot(xenserver, snapshot):
+    """
+    Write a snapshot from fetchServer() to the database. Returns whether the
+    inventory changed, or None if the snapshot doesn't include it.
+    """
+    changed = None
+    inventory = snapshot['inventory']
+    for field, value in snapshot['server'].items():
+        setattr(xenserver, field, value)
+    # Only save the fields we own, so we don't clobber the event watcher's
+    # heartbeat.
+    update_fields = sorted(snapshot['server'])
+    if inventory:
+        xenserver.last_full_sync = snapshot['fetched']
+        update_fields.append('last_full_sync')
+    ts = snapshot['ts']
+    oldest = None
+    if ts:
+        xenserver.rrd_cursor = max(ts)
+        update_fields.append('rrd_cursor')
+        oldest = xenserver.rrd_cursor - settings.XENZEN_RRD_WINDOW
+    xenserver.save(update_fields=update_fields)
+    updateMembers(
+        xenserver, xenserver.pool_uuid, snapshot.get('members', {}))
+
+    if inventory:
+        counts = reconcileVms(
+            xenserver, snapshot['vms'], snapshot['networks'])
+        logger.info(
+            "Synced VMs on %s: %d created, %d updated, %d deleted, "
+            "%d unchanged (writes skipped)", xenserver.hostname,
+            counts['created'], counts['updated'], counts['deleted'],
+            counts['unchanged'])
+        changed = bool(
+            counts['created'] or counts['updated'] or counts['deleted'])
+
+    counts = storeMetrics(
+        ts, snapshot['vmstats'], incremental=snapshot['incremental'],
+        oldest=oldest)
+    logger.info(
+        "Stored metrics for %s: %d created, %d updated, "
+        "%d unchanged (writes skipped)", xenserver.hostname,
+        counts['created'], counts['updated'], counts['unchanged'])
+    return changed
+
+
+def jittered(seconds):
+    """
+    Spread a delay by up to XENZEN_POLL_JITTER (a fraction of it) either way.
+    """
+    jitter = settings.XENZEN_POLL_JITTER
+    return seconds * random.uniform(1 - jitter, 1 + jitter)
+
+
+def finishPoll(xenserver, failed=False, changed=False, now=None):
+    """
+    Release a server's poll lease and schedule its next poll.
+
+    Servers we can't reach back off exponentially, up to
+    XENZEN_POLL_MAX_BACKOFF seconds. Servers whose inventory didn't change
+    are polled less and less often, up to XENZEN_POLL_MAX_INTERVAL seconds,
+    and go back to XENZEN_POLL_INTERVAL as soon as something changes. If
+    changed is None, the poll didn't sync the inventory (a watcher or another
+    server in the pool does that), so there's nothing to go on and the host
+    info and metrics are polled every XENZEN_POLL_INTERVAL.
+    """
+    if now is None:
+        now = timezone.now()
+    base = settings.XENZEN_POLL_INTERVAL
+    interval = xenserver.poll_interval or base
+    failures = 0
+    if failed:
+        failures = xenserver.poll_failures + 1
+        delay = min(base * 2 ** failures, settings.XENZEN_POLL_MAX_BACKOFF)
+    else:
+        if changed or changed is None:
+            interval = base
+        else:
+            interval = min(
+                int(interval * settings.XENZEN_POLL_STRETCH),
+                settings.XENZEN_POLL_MAX_INTERVAL)
+        delay = interval
+
+    xenserver.poll_failures = failures
+    xenserver.poll_interval = interval
+    xenserver.next_poll = now + timedelta(seconds=jittered(delay))
+    xenserver.poll_lease = None
+    XenServer.objects.filter(pk=xenserver.pk).update(
+        poll_failures=xenserver.poll_failures,
+        poll_interval=xenserver.poll_interval,
+        next_poll=xenserver.next_poll,
+        poll_lease=None)
+
+
+def leasePoll(xenserver, countdown, now=None):
+    """
+    Try to take the lease on polling a server, so that no other poll of it
+    can start until this one is done (or the lease expires, if its worker
+    dies). Returns whether we got it.
+    """
+    if now is None:
+        now = timezone.now()
+    until = now + timedelta(
+        seconds=countdown + settings.XENZEN_POLL_LEASE)
+    got = XenServer.objects.filter(pk=xenserver.pk).filter(
+        Q(poll_lease__isnull=True) | Q(poll_lease__lt=now)).update(
+        poll_lease=until)
+    if got:
+        xenserver.poll_lease = until
+    return bool(got)
+
+
+@transaction.atomic
+def storeMetrics(ts, vmstats, incremental=False, oldest=None):
+    """
+    Store the RRD series for each VM (by uuid) and key, skipping the ones
+    whose fingerprint shows they haven't changed. A VM's series all share one
+    XenMetricTimes, with a gap wherever a series has no sample. The samples
+    are merged into the stored series. If incremental is false, they come
+    from a full export, which is coarser than what we've stored, so they only
+    fill in before and after the stored samples. Points from before oldest
+    are dropped. Returns the number of XenMetrics created, updated and left
+    unchanged.
+    """
+    if incremental and not ts:
+        return {'created': 0, 'updated': 0, 'unchanged': 0}
+    vm_ids = dict(XenVM.objects.filter(
+        uuid__in=vmstats.keys()).values_list('uuid', 'pk'))
+    # Each VM's series are rewritten from what we read here, so lock its
+    # XenMetricTimes (in VM order, like compactVms) until we've written them,
+    # or we'd undo a concurrent compaction or lose a concurrent poll's samples.
+    stored_times = dict(
+        (t.vm_id, t) for t in XenMetricTimes.objects.select_for_update(
+        ).filter(vm__in=vm_ids.values()).order_by('vm'))
+    existing = {}
+    for metric in XenMetrics.objects.filter(vm__in=vm_ids.values()):
+        existing.setdefault(metric.vm_id, {})[metric.key] = metric
+
+    new_times = []
+    time_updates = []
+    created = []
+    updates = []
+    unchanged = 0
+    for uuid, stats in vmstats.items():
+        vm_id = vm_ids.get(uuid)
+        if vm_id is None:
+            continue
+        metric_times = stored_times.get(vm_id)
+        old_times = []
+        if metric_times is not None:
+            old_times = list(series.decode_times(metric_times.times))
+        fresh = set(ts)
+        if old_times and not incremental:
+            fresh = set(
+                t for t in ts if t < old_times[0] or t > old_times[-1])
+        times = sorted(t for t in fresh.union(old_times)
+                       if oldest is None or t >= oldest)
+        timesblob = series.encode_times(times)
+        if metric_times is None:
+            new_times.append(XenMetricTimes(vm_id=vm_id, times=timesblob))
+        elif old_times != times:
+            time_updates.append((metric_times.pk, timesblob))
+
+        metrics = existing.get(vm_id, {})
+        for key in set(metrics).union(stats):
+            metric = metrics.get(key)
+            points = {}
+            if metric is not None:
+                points.update(zip(
+                    old_times, series.decode_values(metric.data)))
+            points.update(
+                point for point in zip(ts, stats.get(key, []))
+                if point[0] in fresh)
+            data = series.encode_values([points.get(t) for t in times])
+            digest = seriesFingerprint(timesblob, data)
+            if metric is None:
+                created.append(XenMetrics(
+                    vm_id=vm_id, key=key, data=data, fingerprint=digest))
+            elif metric.fingerprint != digest:
+                updates.append((metric.pk, data, digest))
+            else:
+                unchanged += 1
+
+    for pk, timesblob in time_updates:
+        XenMetricTimes.objects.filter(pk=pk).update(times=timesblob)
+    XenMetricTimes.objects.bulk_create(new_times)
+    for pk, data, digest in updates:
+        XenMetrics.objects.filter(pk=pk).update(
+            data=data, fingerprint=digest)
+    XenMetrics.objects.bulk_create(created)
+    return {
+        'created': len(created),
+        'updated': len(updates),
+        'unchanged': unchanged,
+    }
 
-    xenserver.save()
 
-    # List all the VM objects
-    # allvms = session.xenapi.host.get_resident_VMs(host)
-    allvms = session.xenapi.VM.get_all_records()
-    vmrefs = allvms.keys()
+def seriesFingerprint(timesblob, data):
+    """
+    Return a digest of an encoded series and the times it's aligned to.
+    """
+    return hashlib.sha1(timesblob + data).hexdigest()
 
-    session.xenapi.session.logout()
 
-    # Update all the vm info
-    for vmref, vmobj in allvms.items():
-        updateVm.delay(xenserver, vmref, vmobj)
+def rollupSeries(times, values, resolution, since=0, until=None):
+    """
+    Fold the samples of a series into buckets of resolution seconds, starting
+    with the bucket at since and leaving out any that end after until (which
+    may still get more samples). Returns (start, minimum, average, maximum,
+    last) for each bucket with any samples, in time order.
+    """
+    buckets = []
+    for t, value in zip(times, values):
+        if value is None:
+            continue
+        start = t - t % resolution
+        if start < since or (until is not None and start + resolution > until):
+            continue
+        if buckets and buckets[-1][0] == start:
+            bucket = buckets[-1]
+            bucket[1] = min(bucket[1], value)
+            bucket[2] += value
+            bucket[3] = max(bucket[3], value)
+            bucket[4] = value
+            bucket[5] += 1
+        else:
+            buckets.append([start, value, value, value, value, 1])
+    return [(first, low, float(total) / count, high, last)
+            for first, low, total, high, last, count in buckets]
+
+
+def encodeRollup(buckets):
+    """
+    Encode (start, minimum, average, maximum, last) buckets as the fields of a
+    XenMetricRollup.
+    """
+    columns = zip(*buckets) or [()] * 5
+    return {
+        'times': series.encode_times(columns[0]),
+        'minimum': series.encode_values(columns[1]),
+        'average': series.encode_values(columns[2]),
+        'maximum': series.encode_values(columns[3]),
+        'last': series.encode_values(columns[4]),
+    }
 
-    # Prevent cleaning an unreferenced VM
-    for vm in XenVM.objects.filter(xsref__startswith='TEMPREF'):
-        vmrefs.append(vm.xsref)
 
-    # Purge lost VM's
-    XenVM.objects.filter(
-        xenserver=xenserver).exclude(xsref__in=vmrefs).delete()
+def decodeRollup(rollup):
+    return zip(
+        series.decode_times(rollup.times),
+        series.decode_values(rollup.minimum),
+        series.decode_values(rollup.average),
+        series.decode_values(rollup.maximum),
+        series.decode_values(rollup.last))
+
+
+@transaction.atomic
+def compactVms(vm_ids, now):
+    """
+    Fold the raw samples of the given VMs into each of the
+    XENZEN_METRICS_ROLLUPS, and drop the buckets that are past their
+    retention. storeMetrics trims the raw samples of VMs that are still
+    reporting, so we only trim those of VMs that have stopped. Returns the
+    number of rollups created, updated and deleted, and the number of VMs
+    whose raw samples were trimmed.
+    """
+    stored_times = dict(
+        (t.vm_id, t) for t in XenMetricTimes.objects.select_for_update(
+        ).filter(vm__in=vm_ids).order_by('vm'))
+    raw = {}
+    for metric in XenMetrics.objects.filter(vm__in=vm_ids):
+        raw.setdefault(metric.vm_id, {})[metric.key] = metric
+    rollups = {}
+    for rollup in XenMetricRollup.objects.filter(vm__in=vm_ids):
+        rollups.setdefault(rollup.vm_id, {})[
+            (rollup.key, rollup.resolution)] = rollup
+
+    created = []
+    updates = []
+    deletes = []
+    trims = []
+    oldest = now - settings.XENZEN_RRD_WINDOW
+    for vm_id in vm_ids:
+        metrics = raw.get(vm_id, {})
+        vm_rollups = rollups.get(vm_id, {})
+        times = []
+        if vm_id in stored_times:
+            times = list(series.decode_times(stored_times[vm_id].times))
+        values = dict(
+            (key, series.decode_values(metric.data))
+            for key, metric in metrics.items())
+        # Only fold buckets we've seen the end of, unless the VM has stopped
+        # reporting and won't get any more samples.
+        until = None
+        if times and times[-1] >= now - settings.XENZEN_RRD_MAX_GAP:
+            until = times[-1]
+        keys = set(metrics).union(key for key, _ in vm_rollups)
+
+        for resolution, retention in settings.XENZEN_METRICS_ROLLUPS:
+            for key in keys:
+                rollup = vm_rollups.get((key, resolution))
+                buckets = []
+                if rollup is not None:
+                    buckets = decodeRollup(rollup)
+                since = 0
+                if buckets:
+                    since = buckets[-1][0] + resolution
+                folded = rollupSeries(
+                    times, values.get(key, []), resolution, since, until)
+                kept = [bucket for bucket in buckets + folded
+                        if bucket[0] >= now - retention]
+                if rollup is None:
+                    if kept:
+                        created.append(XenMetricRollup(
+                            vm_id=vm_id, key=key, resolution=resolution,
+                            **encodeRollup(kept)))
+                elif not kept:
+                    deletes.append(rollup.pk)
+                elif folded or len(kept) != len(buckets):
+                    updates.append((rollup.pk, encodeRollup(kept)))
+
+        if until is None and times and times[0] < oldest:
+            keep = bisect.bisect_left(times, oldest)
+            timesblob = series.encode_times(times[keep:])
+            trims.append((vm_id, timesblob, [
+                (metric.pk, series.encode_values(values[key][keep:]))
+                for key, metric in metrics.items()]))
+
+    XenMetricRollup.objects.filter(pk__in=deletes).delete()
+    for pk, fields in updates:
+        XenMetricRollup.objects.filter(pk=pk).update(**fields)
+    XenMetricRollup.objects.bulk_create(created)
+    for vm_id, timesblob, datas in trims:
+        if len(timesblob) == series.HEADER.size:
+            # Nothing left of a VM that stopped reporting long ago.
+            XenMetricTimes.objects.filter(vm=vm_id).delete()
+            XenMetrics.objects.filter(vm=vm_id).delete()
+            continue
+        XenMetricTimes.objects.filter(vm=vm_id).update(times=timesblob)
+        for pk, data in datas:
+            XenMetrics.objects.filter(pk=pk).update(
+                data=data, fingerprint=seriesFingerprint(timesblob, data))
+    return {
+        'created': len(created),
+        'updated': len(updates),
+        'deleted': len(deletes),
+        'trimmed': len(trims),
+    }
 
-    # Update vm metrics
-    for vm, stats in vmstats.items():
-        # Get VM
-        try:
-            vmobj = XenVM.objects.get(uuid=vm)
-        except:
+
+@app.task(time_limit=600)
+def compactMetrics(now=None):
+    """
+    Fold every VM's raw metrics into rollups and enforce the retention of
+    each tier. This runs every XENZEN_METRICS_COMPACT_INTERVAL seconds.
+    """
+    if now is None:
+        now = int(time.time())
+    vm_ids = sorted(
+        set(XenMetricTimes.objects.values_list('vm', flat=True)).union(
+            XenMetricRollup.objects.values_list('vm', flat=True).distinct()))
+    totals = {'created': 0, 'updated': 0, 'deleted': 0, 'trimmed': 0}
+    for i in range(0, len(vm_ids), COMPACT_BATCH_SIZE):
+        counts = compactVms(vm_ids[i:i + COMPACT_BATCH_SIZE], now)
+        for name, count in counts.items():
+            totals[name] += count
+    logger.info(
+        "Compacted metrics of %d VMs: %d rollups created, %d updated, "
+        "%d deleted; %d VMs trimmed", len(vm_ids), totals['created'],
+        totals['updated'], totals['deleted'], totals['trimmed'])
+    return totals
+
+
+def duePolls(servers, now=None):
+    """
+    Take the lease on each of the given servers that is due for a poll within
+    this tick and isn't being polled already. Yields (xenserver, countdown,
+    inventory) for each, where countdown is how long to wait before starting
+    the poll and inventory is whether the poll should sync the VM inventory.
+    """
+    if now is None:
+        now = timezone.now()
+    # Every host in a pool sees the same VMs, so we only fetch the inventory
+    # through one server in each pool.
+    leaders = poolLeaders(servers)
+
+    for xenserver in servers:
+        if xenserver.next_poll is None:
+            # Spread servers we haven't polled yet across the interval, so
+            # they don't all start at once.
+            countdown = random.uniform(0, settings.XENZEN_POLL_INTERVAL)
+        elif xenserver.next_poll <= now + timedelta(
+                seconds=settings.XENZEN_POLL_TICK):
+            # Start within this tick, when the poll is actually due.
+            countdown = max(0, (xenserver.next_poll - now).total_seconds())
+        else:
+            continue
+        if not leasePoll(xenserver, countdown, now=now):
             continue
 
-        for key, stat in stats.items():
-            try:
-                metric = XenMetrics.objects.get(vm=vmobj, key=key)
-                metric.timeblob = json.dumps(ts)
-                metric.datablob = json.dumps(stat)
-            except:
-                metric = XenMetrics.objects.create(
-                    vm=vmobj,
-                    key=key,
-                    timeblob=json.dumps(ts),
-                    datablob=json.dumps(stat)
-                )
-            metric.save()
+        inventory = needsFullSync(xenserver, now=now)
+        if leaders.get(xenserver.pool_uuid, xenserver.pk) != xenserver.pk:
+            inventory = False
+        yield xenserver, countdown, inventory
 
 
 @app.task(time_limit=60)
-def updateVms():
-    servers = XenServer.objects.all()
-    for xenserver in servers:
-        updateServer.delay(xenserver)
+def updateVms(now=None):
+    """
+    Start a poll of every server that is due for one and isn't being polled
+    already. This runs every XENZEN_POLL_TICK seconds.
+    """
+    servers = list(XenServer.objects.all().order_by('pk'))
+    for xenserver, countdown, inventory in duePolls(servers, now=now):
+        updateServer.apply_async(
+            (xenserver.pk,), {'inventory': inventory}, countdown=countdown,
+            expires=countdown + settings.XENZEN_POLL_EXPIRES)
 
 
 @app.task(time_limit=120)
 def complete_vm(vm):
     # Hook task for post provisioning cleanup
+    vm = getInstance(XenVM, vm, 'xenserver')
     xenserver = vm.xenserver
 
-    session = getSession(
-        xenserver.hostname, xenserver.username, xenserver.password)
+    with xenserverSession(
+            xenserver,
+            read_timeout=settings.XENZEN_XENAPI_OPERATION_TIMEOUT) as session:
+        rec = session.xenapi.VM.get_record(vm.xsref)
 
-    rec = session.xenapi.VM.get_record(vm.xsref)
+        vbds = rec['VBDs']
 
-    vbds = rec['VBDs']
-
-    for vbd in vbds:
-        vbrec = session.xenapi.VBD.get_record(vbd)
-        if vbrec['type'] == 'CD' and not vbrec['empty']:
-            session.xenapi.VBD.eject(vbd)
+        for vbd, vbrec in getRecords(session, 'VBD', vbds):
+            if vbrec['type'] == 'CD' and not vbrec['empty']:
+                session.xenapi.VBD.eject(vbd)
 
 
 @app.task(time_limit=120)
 def create_vm(vm, xenserver, template, name, domain, ip, subnet, gateway,
               preseed_url, extra_network_bridges=()):
-    session = getSession(
-        xenserver.hostname, xenserver.username, xenserver.password)
-    return _create_vm(
-        session, vm, template, name, domain, ip, subnet, gateway, preseed_url,
-        extra_network_bridges)
+    vm = getInstance(XenVM, vm)
+    xenserver = getInstance(XenServer, xenserver)
+    template = getInstance(Template, template)
+    with xenserverSession(
+            xenserver,
+            read_timeout=settings.XENZEN_XENAPI_OPERATION_TIMEOUT) as session:
+        return _create_vm(
+            session, vm, template, name, domain, ip, subnet, gateway,
+            preseed_url, extra_network_bridges)
 
 
 def _create_vm(session, vm, template, name, domain, ip, subnet, gateway,
@@ -348,19 +1283,19 @@ def _create_vm(session, vm, template, name, domain, ip, subnet, gateway,
     storage = session.xenapi.SR.get_all()
     ubuntu_vdi = ''
     local_sr = ''
-    for s in storage:
-        store_record = session.xenapi.SR.get_record(s)
+    iso_vdis = []
+    for s, store_record in getRecords(session, 'SR', storage):
         if store_record['type'] == 'iso':
-            vdis = store_record['VDIs']
-            for vdi in vdis:
-                vr = session.xenapi.VDI.get_record(vdi)
-                if vr['name_label'] == template.iso:
-                    ubuntu_vdi = vdi
+            iso_vdis.extend(store_record['VDIs'])
 
         if store_record['name_label'] == 'Local storage':
             # Attatch local SR
             local_sr = s
 
+    for vdi, vr in getRecords(session, 'VDI', iso_vdis):
+        if vr['name_label'] == template.iso:
+            ubuntu_vdi = vdi
+
     if not local_sr:
         raise StorageError("Unable to locate 'Local storage' SR")
 
@@ -369,24 +1304,22 @@ def _create_vm(session, vm, template, name, domain, ip, subnet, gateway,
 
     phys = session.xenapi.PIF.get_all()
     network = None
-    for phy in phys:
-        r = session.xenapi.PIF.get_record(phy)
-
+    for phy, r in getRecords(session, 'PIF', phys):
         if r['gateway']:
-            network = phy
+            network = r['network']
             break
 
-    network = session.xenapi.PIF.get_network(network)
-
     if not network:
         raise NetworkError('Unable to locate VIF network')
 
     extra_networks = []
-    xen_networks = session.xenapi.network.get_all()
+    xen_networks = []
+    if extra_network_bridges:
+        xen_networks = getRecords(
+            session, 'network', session.xenapi.network.get_all())
     for br in extra_network_bridges:
         found = False
-        for net in xen_networks:
-            r = session.xenapi.network.get_record(net)
+        for net, r in xen_networks:
             if r['bridge'] == br:
                 extra_networks.append(net)
                 found = True
@@ -465,6 +1398,8 @@ def _create_vm(session, vm, template, name, domain, ip, subnet, gateway,
 
     # Update our OpaqueRef
     vm.xsref = VM_ref
+    vm.uuid = session.xenapi.VM.get_uuid(VM_ref)
+    vm.fingerprint = ''
     vm.save()
 
     vif = {
@@ -548,5 +1483,3 @@ def _create_vm(session, vm, template, name, domain, ip, subnet, gateway,
 
     # Boot the VM up
     session.xenapi.VM.start(VM_ref, False, False)
-
-    session.xenapi.session.logout()
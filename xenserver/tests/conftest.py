@@ -21,7 +21,8 @@ class TaskCatcher(object):
         given task.
         """
         calls = []
-        self.mp.setattr(task, 'apply_async', lambda *a: calls.append(f(*a)))
+        self.mp.setattr(
+            task, 'apply_async', lambda *a, **kw: calls.append(f(*a)))
         return calls
 
     def catch_updateServer(self):
@@ -29,8 +30,10 @@ class TaskCatcher(object):
         Special case of catch_async for updateServer.
         """
         from xenserver import tasks
+        from xenserver.models import XenServer
         return self.catch_async(
-            tasks.updateServer, lambda args, kwargs: args[0].hostname)
+            tasks.updateServer,
+            lambda args, kwargs: XenServer.objects.get(pk=args[0]).hostname)
 
     def catch_updateVm(self):
         """
@@ -59,6 +62,18 @@ def task_catcher(monkeypatch):
     return TaskCatcher(monkeypatch)
 
 
+@pytest.fixture
+def no_urlopen(task_catcher):
+    """
+    Make every urlopen() fail, for tests that don't care about RRD metrics.
+    """
+    import urllib2
+
+    def urlopen(url, timeout=None):
+        raise urllib2.URLError('urllib2.urlopen() excised for tests.')
+    task_catcher.patch_urlopen(urlopen)
+
+
 @pytest.fixture
 def xs_helper(monkeypatch):
     """
@@ -70,3 +85,23 @@ def xs_helper(monkeypatch):
     xshelper = XenServerHelper()
     monkeypatch.setattr(tasks, 'getSession', xshelper.get_session)
     return xshelper
+
+
+@pytest.fixture
+def fake_xenserver():
+    """
+    Provide a FakeXenServer with a single host in a pool.
+    """
+    from xenserver.tests.helpers import new_xenserver
+    return new_xenserver()
+
+
+@pytest.fixture
+def xs_http(fake_xenserver):
+    """
+    Provide a FakeXenServer with a single host, served over HTTP on localhost.
+    """
+    from xenserver.tests.fake_xen_server import FakeXenHTTPServer
+    server = FakeXenHTTPServer(fake_xenserver).start()
+    yield server
+    server.stop()
@@ -1,4 +1,9 @@
+import BaseHTTPServer
+import SocketServer
 from copy import deepcopy
+import re
+import threading
+import time
 from uuid import uuid4
 import xmlrpclib
 
@@ -15,6 +20,114 @@ def mkref(name):
     return "Ref:%s:%s" % (name, uuid4())
 
 
+def get_object(objs, cls, ref):
+    """
+    Look up an object by ref, failing like xapi does if it doesn't exist.
+    """
+    if ref not in objs:
+        raise xenapi.Failure(['HANDLE_INVALID', cls, ref])
+    return objs[ref]
+
+
+EXPR_TOKEN_RE = re.compile(r'\s*("(?:[^"\\]|\\.)*"|<>|=|\(|\)|\w+)')
+
+
+def parse_expr(expr):
+    """
+    Parse a (subset of a) xapi filter expression, such as the one passed to
+    get_all_records_where, and return a predicate that takes a record.
+
+    We support field and string operands compared with = and <>, the literals
+    true and false, and/or/not, and parentheses.
+    """
+    tokens = []
+    pos = 0
+    expr = expr.strip()
+    while pos < len(expr):
+        match = EXPR_TOKEN_RE.match(expr, pos)
+        if match is None:
+            raise xenapi.Failure(['SYNTAX_ERROR', expr])
+        tokens.append(match.group(1))
+        pos = match.end()
+
+    def peek():
+        return tokens[0] if tokens else None
+
+    def take(expected=None):
+        if not tokens or (expected is not None and tokens[0] != expected):
+            raise xenapi.Failure(['SYNTAX_ERROR', expr])
+        return tokens.pop(0)
+
+    def string():
+        token = take()
+        if not token.startswith('"'):
+            raise xenapi.Failure(['SYNTAX_ERROR', expr])
+        return re.sub(r'\\(.)', r'\1', token[1:-1])
+
+    def operand():
+        if peek() == 'field':
+            take()
+            name = string()
+            return lambda record: field_str(record.get(name))
+        value = string()
+        return lambda record: value
+
+    def atom():
+        if peek() == '(':
+            take()
+            pred = disjunction()
+            take(')')
+            return pred
+        if peek() in ('true', 'false'):
+            value = take() == 'true'
+            return lambda record: value
+        lhs = operand()
+        op = take()
+        rhs = operand()
+        if op == '=':
+            return lambda record: lhs(record) == rhs(record)
+        if op == '<>':
+            return lambda record: lhs(record) != rhs(record)
+        raise xenapi.Failure(['SYNTAX_ERROR', expr])
+
+    def negation():
+        if peek() == 'not':
+            take()
+            pred = negation()
+            return lambda record: not pred(record)
+        return atom()
+
+    def conjunction():
+        preds = [negation()]
+        while peek() == 'and':
+            take()
+            preds.append(negation())
+        return lambda record: all(pred(record) for pred in preds)
+
+    def disjunction():
+        preds = [conjunction()]
+        while peek() == 'or':
+            take()
+            preds.append(conjunction())
+        return lambda record: any(pred(record) for pred in preds)
+
+    pred = disjunction()
+    if tokens:
+        raise xenapi.Failure(['SYNTAX_ERROR', expr])
+    return pred
+
+
+def field_str(value):
+    """
+    Render a field value the way xapi does when comparing it in a filter.
+    """
+    if isinstance(value, bool):
+        return str(value).lower()
+    if value is None:
+        return ''
+    return str(value)
+
+
 class FakeXenServer(object):
     """
     Fake XenServer to use in tests.
@@ -39,13 +152,21 @@ class FakeXenServer(object):
         self.hosts = {}
         self.pools = {}
         self.host_metrics = {}
+        self.VM_guest_metrics = {}
+        self.events = []
+        self.calls = []
+        # If set, this host is a pool slave and refuses logins.
+        self.master_address = None
+
+    def newSession(self, hostname=hostname):
+        url = 'https://%s/' % (hostname)
+        return xenapi.Session(
+            url, transport=StubTransport(self), verbose=self.verbose)
 
     def getSession(self, hostname=hostname, username=username,
                    password=password):
-        url = 'https://%s/' % (hostname)
         # First acquire a valid session by logging in:
-        session = xenapi.Session(
-            url, transport=StubTransport(self), verbose=self.verbose)
+        session = self.newSession(hostname)
         session.xenapi.login_with_password(username, password)
 
         return session
@@ -54,13 +175,24 @@ class FakeXenServer(object):
         assert request.host == self.hostname
         args, method = xmlrpclib.loads(request.body)
         # print (args, method)
-        result = self.call_method(method, args)
-        result_dict = {'Status': 'Success', 'Value': result}
+        try:
+            result = self.call_method(method, args)
+            result_dict = {'Status': 'Success', 'Value': result}
+        except xenapi.Failure as e:
+            result_dict = {'Status': 'Failure', 'ErrorDescription': e.details}
         # print response
         response_body = xmlrpclib.dumps((result_dict,), methodresponse=1)
         return Response(request, 200, response_body)
 
     def call_method(self, method, args):
+        self.calls.append(method)
+        if (self.master_address is not None and
+                method == 'session.login_with_password'):
+            raise xenapi.Failure(['HOST_IS_SLAVE', self.master_address])
+        if not method.startswith('session.login'):
+            # Like xapi, reject any session we don't know about.
+            if not args or args[0] not in self.sessions:
+                raise xenapi.Failure(['SESSION_INVALID', args and args[0]])
         handler = self.handlers.get(method)
         if handler is None:
             handler = getattr(self, 'h_' + method.replace('.', '_'), None)
@@ -69,6 +201,12 @@ class FakeXenServer(object):
         assert handler is not None
         return handler(*args)
 
+    def invalidate_sessions(self):
+        """
+        Forget all existing sessions, as xapi does when it restarts.
+        """
+        self.sessions.clear()
+
     # State management helpers.
 
     def add_SR(self, name_label, type, **kw):
@@ -133,9 +271,64 @@ class FakeXenServer(object):
     def add_pool(self, master_host, **kw):
         ref = mkref("pool")
         kw['master'] = master_host
+        kw.setdefault('uuid', str(uuid4()))
         self.pools[ref] = kw
         return ref
 
+    def add_VM(self, name_label, **kw):
+        ref = mkref("VM")
+        self.VMs[ref] = {
+            'name_label': name_label,
+            'is_a_template': False,
+            'is_control_domain': False,
+            'power_state': 'Running',
+            'VCPUs_max': '1',
+            'memory_static_max': str(1024*1024*1024),
+            'uuid': str(uuid4()),
+            'guest_metrics': 'OpaqueRef:NULL',
+        }
+        self.VMs[ref].update(kw)
+        self.emit('VM', 'add', ref)
+        return ref
+
+    def add_guest_metrics(self, VM, networks):
+        ref = mkref("VM_guest_metrics")
+        self.VM_guest_metrics[ref] = {'networks': networks}
+        self.VMs[VM]['guest_metrics'] = ref
+        self.emit('VM_guest_metrics', 'add', ref)
+        self.emit('VM', 'mod', VM)
+        return ref
+
+    # Events.
+
+    def event_objects(self, cls):
+        return {
+            'vm': self.VMs,
+            'vm_guest_metrics': self.VM_guest_metrics,
+            'host': self.hosts,
+            'host_metrics': self.host_metrics,
+        }[cls.lower()]
+
+    def snapshot(self, cls, ref):
+        if cls.lower() == 'host_metrics':
+            return self.host_metrics_record(ref)
+        return deepcopy(self.event_objects(cls)[ref])
+
+    def emit(self, cls, operation, ref):
+        """
+        Record an event for the given object, for event.from to return.
+        """
+        event = {
+            'id': len(self.events) + 1,
+            # Like xapi, we report class names in lower case.
+            'class': cls.lower(),
+            'operation': operation,
+            'ref': ref,
+        }
+        if operation != 'del':
+            event['snapshot'] = self.snapshot(cls, ref)
+        self.events.append(event)
+
     # XMLRPC handler methods.
 
     def h_session_login_with_password(self, username, password):
@@ -150,11 +343,11 @@ class FakeXenServer(object):
 
     def h_SR_get_record(self, session, ref):
         assert session in self.sessions
-        return self.SRs[ref]
+        return get_object(self.SRs, 'SR', ref)
 
     def h_VDI_get_record(self, session, ref):
         assert session in self.sessions
-        return self.VDIs[ref]
+        return get_object(self.VDIs, 'VDI', ref)
 
     def h_network_get_all(self, session):
         assert session in self.sessions
@@ -162,7 +355,7 @@ class FakeXenServer(object):
 
     def h_network_get_record(self, session, ref):
         assert session in self.sessions
-        return self.networks[ref]
+        return get_object(self.networks, 'network', ref)
 
     def h_PIF_get_all(self, session):
         assert session in self.sessions
@@ -170,7 +363,7 @@ class FakeXenServer(object):
 
     def h_PIF_get_record(self, session, ref):
         assert session in self.sessions
-        return self.PIFs[ref]
+        return get_object(self.PIFs, 'PIF', ref)
 
     def h_PIF_get_network(self, session, ref):
         assert session in self.sessions
@@ -185,10 +378,16 @@ class FakeXenServer(object):
             'is_control_domain': False,
             'power_state': 'Running',
             'uuid': str(uuid4()),
+            'guest_metrics': 'OpaqueRef:NULL',
         }
         self.VMs[ref].update(deepcopy(params))
+        self.emit('VM', 'add', ref)
         return ref
 
+    def h_VM_get_uuid(self, session, ref):
+        assert session in self.sessions
+        return get_object(self.VMs, 'VM', ref)['uuid']
+
     def h_VIF_create(self, session, params):
         assert session in self.sessions
         ref = mkref("VIF")
@@ -211,6 +410,10 @@ class FakeXenServer(object):
         self.VBDs[ref] = deepcopy(params)
         return ref
 
+    def h_VBD_get_record(self, session, ref):
+        assert session in self.sessions
+        return get_object(self.VBDs, 'VBD', ref)
+
     def h_VM_start(self, session, ref, start_paused, force):
         assert session in self.sessions
         self.VM_operations.append((ref, "start"))
@@ -225,6 +428,14 @@ class FakeXenServer(object):
         assert session in self.sessions
         return self.pools.keys()
 
+    def h_pool_get_all_records(self, session):
+        assert session in self.sessions
+        return self.pools
+
+    def h_pool_get_uuid(self, session, pool):
+        assert session in self.sessions
+        return self.pools[pool]["uuid"]
+
     def h_pool_get_master(self, session, pool):
         assert session in self.sessions
         return self.pools[pool]["master"]
@@ -241,20 +452,32 @@ class FakeXenServer(object):
         assert session in self.sessions
         return self.hosts.keys()
 
+    def h_host_get_all_records(self, session):
+        assert session in self.sessions
+        return self.hosts
+
     def h_host_get_record(self, session, host):
         # NOTE: This returns whatever we have in the host dict. It does not
         # validate or filter fields in any way.
         assert session in self.sessions
-        return self.hosts[host]
+        return get_object(self.hosts, 'host', host)
 
     def h_host_get_metrics(self, session, host):
         assert session in self.sessions
         return self.hosts[host]['metrics']
 
     def h_host_metrics_get_record(self, session, metrics):
+        assert session in self.sessions
+        return self.host_metrics_record(metrics)
+
+    def h_host_metrics_get_all_records(self, session):
+        assert session in self.sessions
+        return {ref: self.host_metrics_record(ref)
+                for ref in self.host_metrics}
+
+    def host_metrics_record(self, metrics):
         # NOTE: This returns a partial metrics dict containing only the fields
         # we directly use.
-        assert session in self.sessions
         md = self.host_metrics[metrics]
         # TODO: Subtract VM memory usage.
         return {
@@ -266,9 +489,42 @@ class FakeXenServer(object):
         assert session in self.sessions
         return self.VMs
 
+    def h_VM_get_all_records_where(self, session, expr):
+        assert session in self.sessions
+        pred = parse_expr(expr)
+        return {ref: vm for ref, vm in self.VMs.items() if pred(vm)}
+
+    def h_VM_guest_metrics_get_all_records(self, session):
+        assert session in self.sessions
+        return self.VM_guest_metrics
+
+    def h_VM_guest_metrics_get_record(self, session, ref):
+        assert session in self.sessions
+        return get_object(self.VM_guest_metrics, 'VM_guest_metrics', ref)
+
+    def h_event_from(self, session, classes, token, timeout):
+        # NOTE: This never blocks, even if there are no new events.
+        assert session in self.sessions
+        # Class names are matched case-insensitively, and reported in lower
+        # case.
+        classes = [cls.lower() for cls in classes]
+        if token == '':
+            events = [
+                {'id': 0, 'class': cls, 'operation': 'add', 'ref': ref,
+                 'snapshot': self.snapshot(cls, ref)}
+                for cls in classes for ref in self.event_objects(cls)]
+        else:
+            events = [e for e in self.events[int(token):]
+                      if e['class'] in classes]
+        return {
+            'events': events,
+            'valid_ref_counts': {},
+            'token': str(len(self.events)),
+        }
+
     def h_VM_get_record(self, session, vm):
         assert session in self.sessions
-        return self.VMs[vm]
+        return get_object(self.VMs, 'VM', vm)
 
 
 class Request(object):
@@ -300,7 +556,7 @@ class Response(object):
         return "<Response code=%r body=%r>" % (self.code, self.body)
 
 
-class StubTransport(xmlrpclib.Transport):
+class StubTransport(xenapi.ProjectingTransportMixin, xmlrpclib.Transport):
     def __init__(self, xenserver):
         xmlrpclib.Transport.__init__(self)
         self.xenserver = xenserver
@@ -315,6 +571,7 @@ class StubTransport(xmlrpclib.Transport):
         response = self.xenserver.handle_request(request)
         if verbose:
             print response
+        xenapi.record_wire_bytes(len(request_body), len(response.body))
         return self.parse_response(response)
 
     def parse_response(self, response):
@@ -325,3 +582,73 @@ class StubTransport(xmlrpclib.Transport):
         p.feed(response.body)
         p.close()
         return u.close()
+
+
+class FakeXenRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.fake.connections += 1
+
+    def do_POST(self):
+        fake = self.server.fake
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        request = Request(fake.xenserver.hostname, self.path, body)
+        response = fake.xenserver.handle_request(request)
+        # Pretend to be a slow (or hung) host.
+        time.sleep(fake.delay)
+        self.send_response(response.code)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(response.body)))
+        self.end_headers()
+        if fake.trickle:
+            # Pretend to be a host that sends its response a little at a time.
+            for i in range(0, len(response.body), 256):
+                self.wfile.write(response.body[i:i + 256])
+                self.wfile.flush()
+                time.sleep(fake.trickle)
+        else:
+            self.wfile.write(response.body)
+        if not fake.keep_alive:
+            # Drop the connection without telling the client, like a server
+            # that times out idle connections.
+            self.close_connection = 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class FakeXenHTTPServer(object):
+    """
+    Serve a FakeXenServer over real HTTP on localhost, for testing transports.
+    """
+
+    def __init__(self, xenserver):
+        self.xenserver = xenserver
+        self.connections = 0
+        self.keep_alive = True
+        self.delay = 0
+        self.trickle = 0
+        self.httpd = ThreadingHTTPServer(
+            ('127.0.0.1', 0), FakeXenRequestHandler)
+        self.httpd.fake = self
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+
+    @property
+    def url(self):
+        return 'http://%s:%s/' % self.httpd.server_address
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
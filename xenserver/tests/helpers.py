@@ -16,6 +16,15 @@ DEFAULT_SUBNET = "192.168.199.0/24"
 DEFAULT_GATEWAY = "192.168.199.1"
 
 
+def new_xenserver():
+    """
+    Return a FakeXenServer with a single host in a pool.
+    """
+    xs = FakeXenServer()
+    xs.add_pool(xs.add_host((1, 2), mem=1024*1024*1024))
+    return xs
+
+
 class FakeXenHost(object):
     """
     A wrapper around a single xen server and its associated API data.
@@ -103,7 +112,8 @@ class XenServerHelper(object):
         vm = self.db_xenvm(xs, name, template, **kw)
         host, domain = name.split('.', 1)
         tasks.create_vm(
-            vm, xs, template, host, domain, None, None, None, None)
+            vm.pk, xs.pk, template.pk, host, domain, None, None, None, None)
+        vm.refresh_from_db()
         return vm
 
     def db_zone(self, name):
@@ -138,6 +138,7 @@ class MatchesXenServerVM(BaseXenServerMatcher):
         'suspend_SR': Never(),
         'power_state': 'Running',
         'uuid': Always(),
+        'guest_metrics': Always(),
     }
 
 
@@ -0,0 +1,135 @@
+"""
+Tests for Session call hooks and xenapi.CallStats.
+"""
+
+import pytest
+
+import xenapi
+from xenserver.tests.helpers import new_fake_host
+from xenserver.tests.test_session import new_http_session
+
+
+def new_stats_session(host):
+    stats = xenapi.CallStats()
+    session = host.get_session()
+    session.call_hooks.append(stats)
+    return session, stats
+
+
+class TestCallHooks(object):
+
+    def test_call_info(self):
+        """
+        Each call is reported to the hooks with its host, method, duration and
+        payload sizes.
+        """
+        host = new_fake_host('xs01.local')
+        session = host.get_session()
+        calls = []
+        session.call_hooks.append(calls.append)
+        session.xenapi.host.get_all()
+        [call] = calls
+        assert call.host == host.api.hostname
+        assert call.method == 'host.get_all'
+        assert call.seconds >= 0
+        assert call.request_bytes > 0
+        assert call.response_bytes > 0
+        assert call.retries == 0
+        assert call.error is None
+
+    def test_failure(self):
+        host = new_fake_host('xs01.local')
+        session = host.get_session()
+        calls = []
+        session.call_hooks.append(calls.append)
+        with pytest.raises(xenapi.Failure):
+            session.xenapi.VM.get_record('Ref:VM:missing')
+        [call] = calls
+        assert isinstance(call.error, xenapi.Failure)
+
+    def test_retries(self):
+        """
+        Retries after SESSION_INVALID are counted against the original call.
+        """
+        host = new_fake_host('xs01.local')
+        session = host.get_session()
+        calls = []
+        session.call_hooks.append(calls.append)
+        host.api.invalidate_sessions()
+        session.xenapi.host.get_all()
+        assert calls[-1].method == 'host.get_all'
+        assert calls[-1].retries == 1
+
+    def test_broken_hook(self):
+        """
+        A hook that raises doesn't break the call.
+        """
+        host = new_fake_host('xs01.local')
+        session = host.get_session()
+        session.call_hooks.append(lambda call: 1 / 0)
+        assert session.xenapi.host.get_all() == host.api.hosts.keys()
+
+    def test_pooled_transport_sizes(self, xs_http):
+        """
+        PooledTransport reports the bytes it sends and receives.
+        """
+        session = new_http_session(xs_http)
+        calls = []
+        session.call_hooks.append(calls.append)
+        xs_http.xenserver.add_VM('vm01')
+        session.xenapi.VM.get_all_records()
+        small = calls[-1].response_bytes
+        for i in range(10):
+            xs_http.xenserver.add_VM('vm%02d' % (i + 2,))
+        session.xenapi.VM.get_all_records()
+        assert calls[-1].response_bytes > small > 0
+        assert calls[-1].request_bytes > 0
+
+
+class TestCallStats(object):
+
+    def test_snapshot(self):
+        host = new_fake_host('xs01.local')
+        session, stats = new_stats_session(host)
+        for _ in range(3):
+            session.xenapi.host.get_all()
+        with pytest.raises(xenapi.Failure):
+            session.xenapi.VM.get_record('Ref:VM:missing')
+
+        hostname = host.api.hostname
+        snapshot = stats.snapshot()
+        assert sorted(snapshot) == [
+            (hostname, 'VM.get_record'), (hostname, 'host.get_all')]
+        get_all = snapshot[(hostname, 'host.get_all')]
+        assert get_all['count'] == 3
+        assert get_all['errors'] == 0
+        assert get_all['request_bytes'] > 0
+        # Every call is counted in the last bucket.
+        assert get_all['buckets'][-1] == (30.0, 3)
+        assert snapshot[(hostname, 'VM.get_record')]['errors'] == 1
+
+        stats.reset()
+        assert stats.snapshot() == {}
+
+    def test_histogram(self):
+        stats = xenapi.CallStats(buckets=[0.1, 1])
+        for seconds in [0.05, 0.5, 0.5, 5]:
+            stats(xenapi.CallInfo('xs01', 'VM.start', seconds, 0, 0, 0, None))
+        snapshot = stats.snapshot()[('xs01', 'VM.start')]
+        assert snapshot['buckets'] == [(0.1, 1), (1, 3)]
+        assert snapshot['count'] == 4
+        assert snapshot['seconds'] == 6.05
+
+    def test_prometheus_text(self):
+        stats = xenapi.CallStats(buckets=[1])
+        stats(xenapi.CallInfo('xs01', 'VM.start', 0.5, 10, 20, 1, None))
+        text = stats.prometheus_text()
+        labels = '{host="xs01",method="VM.start"'
+        assert 'xenapi_calls_total%s} 1\n' % (labels,) in text
+        assert 'xenapi_session_retries_total%s} 1\n' % (labels,) in text
+        assert 'xenapi_request_bytes_total%s} 10\n' % (labels,) in text
+        assert 'xenapi_response_bytes_total%s} 20\n' % (labels,) in text
+        assert 'xenapi_call_seconds_bucket%s,le="1"} 1\n' % (labels,) in text
+        assert 'xenapi_call_seconds_bucket%s,le="+Inf"} 1\n' % (
+            labels,) in text
+        assert '# TYPE xenapi_call_seconds histogram\n' in text
@@ -0,0 +1,74 @@
+"""
+Tests for the data migrations in xenserver.migrations.
+"""
+
+import json
+
+import pytest
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+
+from xenserver import series
+
+
+def migrate(target):
+    """
+    Migrate the xenserver app to the given migration (or the latest, if None)
+    and return the historical models as of that migration.
+    """
+    executor = MigrationExecutor(connection)
+    if target is None:
+        targets = executor.loader.graph.leaf_nodes('xenserver')
+    else:
+        targets = [('xenserver', target)]
+    executor.migrate(targets)
+    executor.loader.build_graph()
+    return executor.loader.project_state(targets).apps
+
+
+@pytest.mark.django_db(transaction=True)
+class TestConvertMetrics(object):
+    """
+    Test migration 0014, which converts metrics from JSON to binary series.
+    """
+
+    def test_convert(self):
+        """
+        Each VM's JSON series get one shared set of timestamps, with gaps
+        where a series has no sample, and migrating back restores the JSON.
+        """
+        apps = migrate('0013_binary_metrics')
+        try:
+            XenVM = apps.get_model('xenserver', 'XenVM')
+            XenMetrics = apps.get_model('xenserver', 'XenMetrics')
+            vm = XenVM.objects.create(
+                name='vm01.local', status='Running', xsref='Ref:VM:1',
+                sockets=1, memory=1024)
+            XenMetrics.objects.create(
+                vm=vm, key='cpu0', timeblob=json.dumps([20, 10]),
+                datablob=json.dumps([0.5, 0.25]), data=b'')
+            XenMetrics.objects.create(
+                vm=vm, key='memory', timeblob=json.dumps([10]),
+                datablob=json.dumps([1024.0]), data=b'')
+
+            apps = migrate('0014_convert_metrics')
+            XenMetrics = apps.get_model('xenserver', 'XenMetrics')
+            XenMetricTimes = apps.get_model('xenserver', 'XenMetricTimes')
+            times = XenMetricTimes.objects.get(vm=vm.pk).times
+            assert list(series.decode_times(times)) == [10, 20]
+            data = dict(XenMetrics.objects.values_list('key', 'data'))
+            assert series.decode_values(data['cpu0']) == [0.25, 0.5]
+            assert series.decode_values(data['memory']) == [1024.0, None]
+
+            apps = migrate('0013_binary_metrics')
+            XenMetrics = apps.get_model('xenserver', 'XenMetrics')
+            XenMetricTimes = apps.get_model('xenserver', 'XenMetricTimes')
+            assert not XenMetricTimes.objects.exists()
+            assert sorted(
+                (metric.key, json.loads(metric.timeblob),
+                 json.loads(metric.datablob))
+                for metric in XenMetrics.objects.all()) == [
+                ('cpu0', [10, 20], [0.25, 0.5]),
+                ('memory', [10, 20], [1024.0, None])]
+        finally:
+            migrate(None)
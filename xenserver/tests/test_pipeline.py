@@ -0,0 +1,189 @@
+"""
+Tests for xenserver.pipeline.SyncPipeline.
+"""
+
+import time
+from datetime import timedelta
+
+import pytest
+from django.utils import timezone
+
+from xenserver import tasks
+from xenserver.models import XenServer
+from xenserver.pipeline import SyncPipeline
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "Timed out"
+        time.sleep(0.01)
+
+
+@pytest.mark.django_db
+class TestSyncPipeline(object):
+
+    def test_fetch_and_apply(self, xs_helper, task_catcher, no_urlopen):
+        """
+        A fetched snapshot is written by apply(), which schedules the next
+        poll and counts both stages.
+        """
+        _, xs01 = xs_helper.new_host('xs01.local')
+        _, xs02 = xs_helper.new_host('xs02.local')
+        done = []
+        pipeline = SyncPipeline(done=lambda *a: done.append(a))
+        pipeline.apply([
+            pipeline.fetch((xs01.pk, xs01.hostname, True, None)),
+            pipeline.fetch((xs02.pk, xs02.hostname, False, None))])
+        xs01.refresh_from_db()
+        xs02.refresh_from_db()
+        assert xs01.last_full_sync is not None
+        assert xs02.last_full_sync is None
+        assert xs01.next_poll is not None
+        assert xs02.next_poll is not None
+        assert sorted(hostname for hostname, _ in done) == [
+            'xs01.local', 'xs02.local']
+        stats = pipeline.stats()
+        assert stats['fetch']['count'] == 2
+        assert stats['apply']['count'] == 2
+        assert stats['apply']['batches'] == 1
+
+    def test_fetch_failure(self, xs_helper, monkeypatch):
+        """
+        A server we can't fetch from backs off, without touching the rest of
+        its batch.
+        """
+        _, xs01 = xs_helper.new_host('xs01.local')
+        _, xs02 = xs_helper.new_host('xs02.local')
+        fetch = tasks.fetchServer
+
+        def flaky(xenserver, inventory=True):
+            if xenserver.pk == xs01.pk:
+                raise Exception("Oops")
+            return fetch(xenserver, inventory)
+        monkeypatch.setattr(tasks, 'fetchServer', flaky)
+        pipeline = SyncPipeline()
+        pipeline.apply([
+            pipeline.fetch((xs01.pk, xs01.hostname, True, None)),
+            pipeline.fetch((xs02.pk, xs02.hostname, True, None))])
+        xs01.refresh_from_db()
+        xs02.refresh_from_db()
+        assert xs01.poll_failures == 1
+        assert xs02.poll_failures == 0
+        assert xs02.last_full_sync is not None
+        assert pipeline.stats()['fetch']['errors'] == 1
+
+    def test_apply_failure(self, xs_helper, monkeypatch):
+        """
+        A snapshot we can't write is rolled back on its own.
+        """
+        _, xs01 = xs_helper.new_host('xs01.local')
+        _, xs02 = xs_helper.new_host('xs02.local')
+        apply = tasks.applySnapshot
+
+        def flaky(xenserver, snapshot):
+            changed = apply(xenserver, snapshot)
+            if xenserver.pk == xs01.pk:
+                raise Exception("Oops")
+            return changed
+        monkeypatch.setattr(tasks, 'applySnapshot', flaky)
+        pipeline = SyncPipeline()
+        pipeline.apply([
+            pipeline.fetch((xs01.pk, xs01.hostname, True, None)),
+            pipeline.fetch((xs02.pk, xs02.hostname, True, None))])
+        assert XenServer.objects.get(pk=xs01.pk).last_full_sync is None
+        assert XenServer.objects.get(pk=xs01.pk).poll_failures == 1
+        assert XenServer.objects.get(pk=xs02.pk).last_full_sync is not None
+        assert pipeline.stats()['apply']['errors'] == 1
+
+    def test_deleted_server(self, xs_helper):
+        """
+        Servers deleted before they're fetched are skipped.
+        """
+        _, xs = xs_helper.new_host('xs01.local')
+        pk = xs.pk
+        xs.delete()
+        assert SyncPipeline().fetch((pk, "xs01.local", True, None)) is None
+
+    def test_expired_lease(self, xs_helper, settings):
+        """
+        Polls whose lease would run out before their deadline are dropped,
+        leaving the lease to expire.
+        """
+        settings.XENZEN_POLL_DEADLINE = 20
+        _, xs = xs_helper.new_host('xs01.local')
+        lease = timezone.now() + timedelta(seconds=10)
+        XenServer.objects.filter(pk=xs.pk).update(poll_lease=lease)
+        pipeline = SyncPipeline()
+        assert pipeline.fetch((xs.pk, xs.hostname, True, lease)) is None
+        assert pipeline.stats()['fetch']['expired'] == 1
+        assert XenServer.objects.get(pk=xs.pk).poll_lease == lease
+
+
+class TestSyncPipelineThreads(object):
+    """
+    These tests stub out fetch() and apply(), since the worker threads can't
+    see the test database.
+    """
+
+    def test_backpressure(self, monkeypatch):
+        """
+        Fetchers stop when the queue is full, so only queue_size snapshots
+        (plus one per fetcher) are ever held.
+        """
+        pipeline = SyncPipeline(fetchers=2, appliers=0, queue_size=3)
+        monkeypatch.setattr(pipeline, 'fetch', lambda job: job)
+        pipeline.start()
+        for i in range(10):
+            pipeline.submit(i, 'xs%02d' % (i,))
+        wait_for(lambda: pipeline.snapshots.full())
+        time.sleep(0.1)
+        assert pipeline.jobs.qsize() == 10 - 3 - 2
+        # Draining the queue lets the fetchers carry on.
+        fetched = []
+        while len(fetched) < 10:
+            fetched.append(pipeline.snapshots.get(timeout=5))
+        assert sorted(pk for pk, _, _, _ in fetched) == range(10)
+        pipeline.stop()
+
+    def test_fetch_crash(self, monkeypatch):
+        """
+        An unexpected error fetching a server fails its poll, releasing the
+        lease, and the fetcher carries on.
+        """
+        pipeline = SyncPipeline(fetchers=1, appliers=0)
+
+        def fetch(job):
+            if job[0] == 1:
+                raise ValueError("Broken")
+            return job
+        monkeypatch.setattr(pipeline, 'fetch', fetch)
+        abandoned = []
+        monkeypatch.setattr(
+            pipeline, 'abandon', lambda pk, hostname: abandoned.append(pk))
+        pipeline.start()
+        pipeline.submit(1, 'xs01')
+        pipeline.submit(2, 'xs02')
+        assert pipeline.snapshots.get(timeout=5)[0] == 2
+        pipeline.stop()
+        assert abandoned == [1]
+        assert pipeline.stats()['fetch']['errors'] == 1
+
+    def test_batches(self, monkeypatch):
+        """
+        Appliers write whatever has queued up in batches, and every snapshot
+        is applied before stop() returns.
+        """
+        pipeline = SyncPipeline(
+            fetchers=4, appliers=2, queue_size=8, batch_size=5)
+        monkeypatch.setattr(pipeline, 'fetch', lambda job: job)
+        batches = []
+        monkeypatch.setattr(
+            pipeline, 'apply', lambda batch: batches.append(batch))
+        pipeline.start()
+        for i in range(20):
+            pipeline.submit(i, 'xs%02d' % (i,))
+        pipeline.stop()
+        assert all(1 <= len(batch) <= 5 for batch in batches)
+        assert sorted(job[0] for batch in batches for job in batch) == range(
+            20)
@@ -0,0 +1,89 @@
+"""
+Tests for xenserver.poller.FleetPoller.
+"""
+
+import time
+
+import pytest
+
+from xenserver.models import XenServer
+from xenserver.poller import FleetPoller
+
+
+@pytest.mark.django_db
+class TestFleetPoller(object):
+
+    def test_schedule(self, xs_helper):
+        """
+        Every active server that is due is leased and queued, with the
+        inventory fetched through one server per pool.
+        """
+        _, xs01 = xs_helper.new_host('xs01.local')
+        _, xs02 = xs_helper.new_host('xs02.local')
+        _, xs03 = xs_helper.new_host('xs03.local')
+        XenServer.objects.filter(pk__in=[xs01.pk, xs02.pk]).update(
+            pool_uuid='pool-a')
+        XenServer.objects.filter(pk=xs03.pk).update(active=False)
+        poller = FleetPoller(workers=2)
+        poller.schedule()
+        assert sorted((hostname, inventory)
+                      for _, _, hostname, inventory, _ in poller.pending) == [
+            ('xs01.local', True), ('xs02.local', False)]
+        assert XenServer.objects.get(pk=xs01.pk).poll_lease is not None
+        assert XenServer.objects.get(pk=xs03.pk).poll_lease is None
+
+        # Leased servers aren't queued again.
+        poller.schedule()
+        assert len(poller.pending) == 2
+
+    def test_schedule_hostnames(self, xs_helper):
+        """
+        We can limit the poller to some servers.
+        """
+        xs_helper.new_host('xs01.local')
+        xs_helper.new_host('xs02.local')
+        poller = FleetPoller(hostnames=['xs02.local'])
+        poller.schedule()
+        assert [hostname for _, _, hostname, _, _ in poller.pending] == [
+            'xs02.local']
+
+    def test_dispatch(self, monkeypatch):
+        """
+        Only polls that are due are handed to the pipeline, and we're told
+        when the next one is due.
+        """
+        poller = FleetPoller()
+        now = time.time()
+        poller.pending = [
+            (now - 1, 1, 'xs01.local', True, None),
+            (now + 30, 2, 'xs02.local', True, None)]
+        wait = poller.dispatch()
+        assert poller.pipeline.jobs.get_nowait() == (
+            1, 'xs01.local', True, None)
+        assert poller.pipeline.jobs.empty()
+        assert 0 < wait <= 30
+        assert [pk for _, pk, _, _, _ in poller.pending] == [2]
+
+    def test_poll(self, xs_helper, task_catcher, no_urlopen):
+        """
+        A poll updates the server and records how long it took.
+        """
+        _, xs = xs_helper.new_host('xs01.local')
+        poller = FleetPoller()
+        poller.pipeline.apply([
+            poller.pipeline.fetch((xs.pk, xs.hostname, True, None))])
+        xs.refresh_from_db()
+        assert xs.last_full_sync is not None
+        assert xs.next_poll is not None
+        [(hostname, seconds)] = poller.summary()
+        assert hostname == 'xs01.local'
+        assert seconds >= 0
+
+    def test_summary(self):
+        """
+        The summary lists the slowest servers first.
+        """
+        poller = FleetPoller()
+        poller.durations = {'xs01': 0.5, 'xs02': 2.0, 'xs03': 1.0}
+        assert poller.summary() == [
+            ('xs02', 2.0), ('xs03', 1.0), ('xs01', 0.5)]
@@ -0,0 +1,88 @@
+"""
+Tests for xenserver.series.
+"""
+
+import pytest
+
+from xenserver import series
+
+
+class TestSeries(object):
+
+    def test_times(self):
+        blob = series.encode_times([10, 20, 2 ** 32 - 1])
+        assert len(blob) == series.HEADER.size + 12
+        assert list(series.decode_times(blob)) == [10, 20, 2 ** 32 - 1]
+
+    def test_values(self):
+        """
+        Values are stored as float32, with NaN for gaps.
+        """
+        blob = series.encode_values([0.5, None, 0.1])
+        assert len(blob) == series.HEADER.size + 12
+        assert series.decode_values(blob) == [
+            0.5, None, pytest.approx(0.1)]
+
+    def test_empty(self):
+        assert list(series.decode_times(series.encode_times([]))) == []
+        assert series.decode_values(series.encode_values([])) == []
+
+    def test_buffer(self):
+        """
+        We can decode the buffers database drivers return.
+        """
+        blob = buffer(series.encode_values([1.0, 2.0]))
+        assert series.decode_values(blob) == [1.0, 2.0]
+
+    def test_bad_header(self):
+        """
+        Blobs in another format or version are rejected.
+        """
+        blob = series.encode_times([10])
+        with pytest.raises(ValueError):
+            series.decode_values(blob)
+        with pytest.raises(ValueError):
+            series.decode_times('[10]' + blob[4:])
+        with pytest.raises(ValueError):
+            series.decode_times(blob[:2] + chr(2) + blob[3:])
+
+    def test_truncated(self):
+        blob = series.encode_times([10, 20])
+        with pytest.raises(ValueError):
+            series.decode_times(blob[:-4])
+
+
+class TestDownsample(object):
+
+    def test_short(self):
+        """
+        Series that already fit are left alone.
+        """
+        assert series.downsample([10, 20], [1.0, None], 2) == [
+            (10, 1.0), (20, None)]
+
+    def test_min_max(self):
+        """
+        Each run keeps its lowest and highest values, in the order they
+        happened, at the run's first and last timestamps.
+        """
+        times = range(0, 80, 10)
+        values = [1.0, 5.0, 0.0, 2.0, 3.0, 3.0, 9.0, 1.0]
+        assert series.downsample(times, values, 4) == [
+            (0, 5.0), (30, 0.0), (40, 9.0), (70, 1.0)]
+
+    def test_gaps(self):
+        times = range(0, 80, 10)
+        values = [None, None, None, None, 1.0, None, 2.0, None]
+        assert series.downsample(times, values, 4) == [
+            (0, None), (30, None), (40, 1.0), (70, 2.0)]
+
+    def test_rollup(self):
+        """
+        Rolled up series are drawn with their minimums and maximums.
+        """
+        times = range(0, 40, 10)
+        average = [2.0, 2.0, 2.0, 2.0]
+        assert series.downsample(
+            times, average, 2, lows=[1.0, 0.5, 1.5, 1.0],
+            highs=[3.0, 3.5, 2.5, 4.0]) == [(0, 0.5), (30, 4.0)]
@@ -0,0 +1,235 @@
+"""
+Tests for extensions to xenapi.Session.
+"""
+
+import threading
+import time
+
+import pytest
+
+import xenapi
+from xenserver.tests.fake_xen_server import StubTransport
+from xenserver.tests.helpers import new_fake_host
+
+
+def new_http_session(server, pool=None):
+    transport = xenapi.PooledTransport(pool, use_https=False)
+    session = xenapi.Session(server.url, transport=transport)
+    xs = server.xenserver
+    session.xenapi.login_with_password(xs.username, xs.password)
+    return session
+
+
+class TestBatch(object):
+
+    def test_results_in_order(self):
+        """
+        Results are returned in the same order as the calls.
+        """
+        host = new_fake_host('xs01.local')
+        session = host.get_session()
+        srs = [host.sr['local'], host.sr['iso']]
+        results = session.batch([('SR.get_record', (sr,)) for sr in srs])
+        assert [r['name_label'] for r in results] == [
+            'Local storage', 'ISOs']
+
+    def test_empty_batch(self):
+        host = new_fake_host('xs01.local')
+        assert host.get_session().batch([]) == []
+
+    def test_failures_in_place(self):
+        """
+        A call that fails has its Failure in the results, and doesn't stop the
+        other calls from being made.
+        """
+        host = new_fake_host('xs01.local')
+        session = host.get_session()
+        results = session.batch([
+            ('SR.get_record', (host.sr['local'],)),
+            ('SR.get_record', ('Ref:SR:missing',)),
+            ('PIF.get_record', (host.pif['eth0'],)),
+        ])
+        assert results[0]['name_label'] == 'Local storage'
+        assert isinstance(results[1], xenapi.Failure)
+        assert results[1].details == ['HANDLE_INVALID', 'SR', 'Ref:SR:missing']
+        assert results[2]['device'] == 'eth0'
+
+    def test_other_errors_raised(self):
+        """
+        Errors that aren't xapi failures are raised once the batch is done.
+        """
+        host = new_fake_host('xs01.local')
+        session = host.get_session()
+        with pytest.raises(RuntimeError):
+            session.batch([
+                ('SR.get_record', (host.sr['local'],)),
+                ('SR.no_such_method', ()),
+            ])
+
+    def test_concurrent_over_pooled_transport(self, xs_http):
+        """
+        With a pooled transport, calls are made concurrently over several
+        connections, but no more than max_workers at once.
+        """
+        xs = xs_http.xenserver
+        lock = threading.Lock()
+        active = [0, 0]
+
+        def slow_get_record(session, host):
+            with lock:
+                active[0] += 1
+                active[1] = max(active)
+            time.sleep(0.05)
+            with lock:
+                active[0] -= 1
+            return xs.hosts[host]
+
+        xs.handlers['host.get_record'] = slow_get_record
+        session = new_http_session(xs_http)
+        [host] = xs.hosts.keys()
+        results = session.batch(
+            [('host.get_record', (host,))] * 9, max_workers=3)
+        assert results == [xs.hosts[host]] * 9
+        assert active[1] == 3
+
+    def test_concurrent_relogin(self, xs_http):
+        """
+        If the session has expired, concurrent calls only log in once.
+        """
+        xs = xs_http.xenserver
+        session = new_http_session(xs_http)
+        xs.invalidate_sessions()
+        [host] = xs.hosts.keys()
+        session.batch([('host.get_record', (host,))] * 8, max_workers=4)
+        assert xs.calls.count('session.login_with_password') == 2
+
+
+class NonProjectingTransport(StubTransport):
+    supports_projection = False
+
+
+class TestProject(object):
+
+    def add_vms(self, xs):
+        for name in ['vm01', 'vm02']:
+            xs.add_VM(name, other_config={'name_label': 'hidden'},
+                      platform={'acpi': '1'})
+
+    def test_get_all_records(self):
+        """
+        Only the requested fields of each record are kept, including fields
+        with nested structs.
+        """
+        host = new_fake_host('xs01.local')
+        self.add_vms(host.api)
+        session = host.get_session()
+        records = session.project(['name_label', 'platform']).VM.\
+            get_all_records()
+        assert records == {
+            ref: {'name_label': vm['name_label'], 'platform': {'acpi': '1'}}
+            for ref, vm in host.api.VMs.items()}
+
+    def test_get_record(self):
+        host = new_fake_host('xs01.local')
+        self.add_vms(host.api)
+        [ref] = [r for r, vm in host.api.VMs.items()
+                 if vm['name_label'] == 'vm01']
+        session = host.get_session()
+        assert session.project(['name_label', 'uuid']).VM.get_record(ref) == {
+            'name_label': 'vm01', 'uuid': host.api.VMs[ref]['uuid']}
+
+    def test_other_calls_unaffected(self):
+        """
+        Calls that don't return records are left alone, as are failures.
+        """
+        host = new_fake_host('xs01.local')
+        session = host.get_session()
+        projected = session.project(['name_label'])
+        assert projected.host.get_all() == host.api.hosts.keys()
+        with pytest.raises(xenapi.Failure):
+            projected.VM.get_record('Ref:VM:missing')
+
+    def test_unsupported_transport(self):
+        """
+        With a transport that can't project while parsing, the records are
+        filtered afterwards.
+        """
+        host = new_fake_host('xs01.local')
+        self.add_vms(host.api)
+        session = xenapi.Session(
+            'https://localhost/', transport=NonProjectingTransport(host.api))
+        session.xenapi.login_with_password('user', 'pass')
+        records = session.project(['name_label']).VM.get_all_records()
+        assert sorted(records.values()) == [
+            {'name_label': 'vm01'}, {'name_label': 'vm02'}]
+
+    def test_pooled_transport(self, xs_http):
+        """
+        PooledTransport projects records as it parses them.
+        """
+        self.add_vms(xs_http.xenserver)
+        session = new_http_session(xs_http)
+        records = session.project(['name_label']).VM.get_all_records()
+        assert sorted(records.values()) == [
+            {'name_label': 'vm01'}, {'name_label': 'vm02'}]
+        # The projection doesn't leak into later calls.
+        records = session.xenapi.VM.get_all_records()
+        assert all('uuid' in r for r in records.values())
+
+
+class TestGetAllRecordsWhere(object):
+
+    def add_vms(self, xs):
+        xs.add_VM('vm01')
+        xs.add_VM('vm02', power_state='Halted')
+        xs.add_VM('template', is_a_template=True)
+        xs.add_VM('dom0', is_control_domain=True)
+
+    def names(self, records):
+        return sorted(r['name_label'] for r in records.values())
+
+    def test_filters(self):
+        host = new_fake_host('xs01.local')
+        self.add_vms(host.api)
+        vm = host.get_session().xenapi.VM
+        assert self.names(vm.get_all_records_where(
+            'field "is_a_template"="false" and '
+            'field "is_control_domain"="false"')) == ['vm01', 'vm02']
+        assert self.names(vm.get_all_records_where(
+            'field "power_state"<>"Running" or '
+            '(field "is_control_domain"="true")')) == ['dom0', 'vm02']
+        assert self.names(vm.get_all_records_where(
+            'not (field "name_label"="vm01")')) == ['dom0', 'template', 'vm02']
+        assert self.names(vm.get_all_records_where('true')) == [
+            'dom0', 'template', 'vm01', 'vm02']
+
+    def test_syntax_error(self):
+        host = new_fake_host('xs01.local')
+        vm = host.get_session().xenapi.VM
+        with pytest.raises(xenapi.Failure) as excinfo:
+            vm.get_all_records_where('field "name_label"=')
+        assert excinfo.value.details[0] == 'SYNTAX_ERROR'
+
+    def test_projected(self):
+        host = new_fake_host('xs01.local')
+        self.add_vms(host.api)
+        records = host.get_session().project(['name_label']).VM.\
+            get_all_records_where('field "power_state"="Halted"')
+        assert records.values() == [{'name_label': 'vm02'}]
+
+
+class TestDeadline(object):
+
+    def test_expired_deadline(self):
+        """
+        Once the deadline has passed, calls fail with Timeout before they're
+        sent, whatever the transport.
+        """
+        host = new_fake_host('xs01.local')
+        session = host.get_session()
+        calls = len(host.api.calls)
+        with xenapi.deadline(-1):
+            with pytest.raises(xenapi.Timeout):
+                session.xenapi.host.get_all()
+        assert len(host.api.calls) == calls
+        assert session.xenapi.host.get_all() == host.api.hosts.keys()
@@ -0,0 +1,270 @@
+"""
+Tests for xenapi.SessionPool.
+"""
+
+import errno
+import socket
+import xmlrpclib
+
+import pytest
+
+import xenapi
+from xenapi import SessionPool
+from xenserver.tests.helpers import new_xenserver
+
+
+class FakeClock(object):
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+def new_pool(xs, max_idle=300):
+    clock = FakeClock()
+    pool = SessionPool(xs.newSession, max_idle=max_idle, clock=clock)
+    return pool, clock
+
+
+def count_logins(xs):
+    return xs.calls.count('session.login_with_password')
+
+
+class TestSessionPool(object):
+
+    def test_acquire_logs_in(self, fake_xenserver):
+        """
+        Acquiring a session from an empty pool logs in a new session.
+        """
+        xs = fake_xenserver
+        pool, _ = new_pool(xs)
+        session = pool.acquire(xs.hostname, xs.username, xs.password)
+        assert session._session in xs.sessions
+        assert session.API_version == '1.2'
+        assert count_logins(xs) == 1
+
+    def test_release_and_reuse(self, fake_xenserver):
+        """
+        A released session is handed out again without logging in.
+        """
+        xs = fake_xenserver
+        pool, _ = new_pool(xs)
+        session = pool.acquire(xs.hostname, xs.username, xs.password)
+        pool.release(session)
+        assert pool.idle_count() == 1
+        assert xs.calls.count('session.logout') == 0
+
+        assert pool.acquire(xs.hostname, xs.username, xs.password) is session
+        assert pool.idle_count() == 0
+        assert count_logins(xs) == 1
+
+    def test_concurrent_sessions(self, fake_xenserver):
+        """
+        A session that is in use is not handed out a second time.
+        """
+        xs = fake_xenserver
+        pool, _ = new_pool(xs)
+        s1 = pool.acquire(xs.hostname, xs.username, xs.password)
+        s2 = pool.acquire(xs.hostname, xs.username, xs.password)
+        assert s1 is not s2
+        assert count_logins(xs) == 2
+
+    def test_api_version_cached(self, fake_xenserver):
+        """
+        The API version is only negotiated for the first session to a host.
+        """
+        xs = fake_xenserver
+        pool, _ = new_pool(xs)
+        pool.acquire(xs.hostname, xs.username, xs.password)
+        pool.acquire(xs.hostname, xs.username, xs.password)
+        assert xs.calls.count('pool.get_all') == 1
+        assert xs.calls.count('host.get_API_version_major') == 1
+
+    def test_idle_sessions_expire(self, fake_xenserver):
+        """
+        Sessions that sit idle for too long are logged out.
+        """
+        xs = fake_xenserver
+        pool, clock = new_pool(xs, max_idle=60)
+        session = pool.acquire(xs.hostname, xs.username, xs.password)
+        handle = session._session
+        pool.release(session)
+
+        clock.advance(61)
+        pool.expire()
+        assert pool.idle_count() == 0
+        assert handle not in xs.sessions
+
+        assert pool.acquire(xs.hostname, xs.username, xs.password) is not (
+            session)
+        assert count_logins(xs) == 2
+
+    def test_changed_password(self, fake_xenserver):
+        """
+        An idle session logged in with old credentials is not reused.
+        """
+        xs = fake_xenserver
+        pool, _ = new_pool(xs)
+        session = pool.acquire(xs.hostname, xs.username, xs.password)
+        pool.release(session)
+
+        xs.password = 'newpass'
+        new_session = pool.acquire(xs.hostname, xs.username, 'newpass')
+        assert new_session is not session
+        assert session._session is None
+
+    def test_stale_session_revalidated(self, fake_xenserver):
+        """
+        A pooled session that xapi no longer recognises logs in again.
+        """
+        xs = fake_xenserver
+        pool, _ = new_pool(xs)
+        session = pool.acquire(xs.hostname, xs.username, xs.password)
+        pool.release(session)
+
+        xs.invalidate_sessions()
+        session = pool.acquire(xs.hostname, xs.username, xs.password)
+        assert session.xenapi.host.get_all() == xs.hosts.keys()
+        assert count_logins(xs) == 2
+        # We didn't need to negotiate the API version again.
+        assert xs.calls.count('pool.get_all') == 1
+
+    def test_release_foreign_session(self, fake_xenserver):
+        """
+        Releasing a session that didn't come from the pool logs it out.
+        """
+        xs = fake_xenserver
+        pool, _ = new_pool(xs)
+        session = xs.getSession()
+        handle = session._session
+        pool.release(session)
+        assert pool.idle_count() == 0
+        assert handle not in xs.sessions
+
+
+class DeadTransport(xmlrpclib.Transport):
+    """
+    A transport for a host that doesn't answer.
+    """
+
+    def request(self, host, handler, request_body, verbose=0):
+        raise socket.error(errno.ECONNREFUSED, 'Connection refused')
+
+
+class FakeNetwork(object):
+    """
+    A set of fake servers by hostname. Hosts that aren't in it don't answer.
+    """
+
+    def __init__(self):
+        self.servers = {}
+
+    def add(self, hostname, master=None):
+        xs = new_xenserver()
+        xs.hostname = hostname
+        xs.master_address = master
+        self.servers[hostname] = xs
+        return xs
+
+    def newSession(self, hostname):
+        if hostname in self.servers:
+            return self.servers[hostname].newSession(hostname)
+        return xenapi.Session(
+            'https://%s/' % (hostname,), transport=DeadTransport())
+
+
+class TestPoolMasters(object):
+
+    def test_follow_redirect(self):
+        """
+        Logging in to a pool slave gets us a session for the master, and we
+        go straight to the master after that.
+        """
+        net = FakeNetwork()
+        master = net.add('xs01')
+        slave = net.add('xs02', master='xs01')
+        pool = SessionPool(net.newSession, clock=FakeClock())
+
+        session = pool.acquire('xs02', master.username, master.password)
+        assert session._session in master.sessions
+        assert pool.master_for('xs02') == 'xs01'
+        assert count_logins(slave) == 1
+
+        pool.acquire('xs02', master.username, master.password)
+        assert count_logins(slave) == 1
+        assert count_logins(master) == 2
+
+    def test_shared_sessions(self):
+        """
+        Every host in a pool shares the master's idle sessions.
+        """
+        net = FakeNetwork()
+        master = net.add('xs01')
+        net.add('xs02', master='xs01')
+        pool = SessionPool(net.newSession, clock=FakeClock())
+
+        session = pool.acquire('xs02', master.username, master.password)
+        pool.release(session)
+        assert pool.acquire('xs01', master.username, master.password) is (
+            session)
+
+    def test_failover(self):
+        """
+        If the master we were redirected to stops answering, we ask the slave
+        again and find the new master.
+        """
+        net = FakeNetwork()
+        net.add('xs01')
+        net.add('xs02', master='xs01')
+        pool = SessionPool(net.newSession, clock=FakeClock())
+        xs = net.servers['xs01']
+        pool.acquire('xs02', xs.username, xs.password)
+
+        # xs01 dies and xs03 takes over.
+        del net.servers['xs01']
+        new_master = net.add('xs03')
+        net.servers['xs02'].master_address = 'xs03'
+
+        session = pool.acquire('xs02', xs.username, xs.password)
+        assert session._session in new_master.sessions
+        assert pool.master_for('xs02') == 'xs03'
+
+    def test_unreachable_host(self):
+        """
+        A host that doesn't answer and isn't a remembered master fails the
+        login as usual.
+        """
+        net = FakeNetwork()
+        pool = SessionPool(net.newSession, clock=FakeClock())
+        with pytest.raises(socket.error):
+            pool.acquire('xs01', 'user', 'pass')
+
+    def test_redirect_loop(self):
+        net = FakeNetwork()
+        net.add('xs01', master='xs02')
+        net.add('xs02', master='xs01')
+        pool = SessionPool(net.newSession, clock=FakeClock())
+        with pytest.raises(xenapi.Failure) as excinfo:
+            pool.acquire('xs01', 'user', 'pass')
+        assert excinfo.value.details[0] == 'HOST_IS_SLAVE'
+
+    def test_discard(self):
+        """
+        Releasing a session with discard=True logs it out and forgets any
+        redirect to its host.
+        """
+        net = FakeNetwork()
+        master = net.add('xs01')
+        net.add('xs02', master='xs01')
+        pool = SessionPool(net.newSession, clock=FakeClock())
+        session = pool.acquire('xs02', master.username, master.password)
+        handle = session._session
+
+        pool.release(session, discard=True)
+        assert pool.idle_count() == 0
+        assert handle not in master.sessions
+        assert pool.master_for('xs02') == 'xs02'
@@ -2,15 +2,26 @@
 Some quick and dirty tests for a very small subset of the code.
 """
 
+from datetime import timedelta
+import errno
+import json
+import logging
+import socket
+import time
+from StringIO import StringIO
+
+from django.utils import timezone
 import pytest
 from testtools.assertions import assert_that
 from testtools.matchers import MatchesSetwise
 
-from xenserver import tasks
-from xenserver.tests.helpers import VM_MEM
+import xenapi
+from xenserver import series, tasks
+from xenserver.models import (
+    Addresses, XenMetricRollup, XenMetrics, XenMetricTimes, XenServer, XenVM)
+from xenserver.tests.helpers import HOST_CPUS, VM_MEM
 from xenserver.tests.matchers import (
-    ExtractValues, MatchesSetOfLists, MatchesVMNamed, MatchesXenServerVIF,
-    MatchesXenServerVM)
+    ExtractValues, MatchesSetOfLists, MatchesXenServerVIF, MatchesXenServerVM)
 
 
 def apply_task(task, *args, **kw):
@@ -73,7 +84,8 @@ class TestCreateVM(object):
         assert xsh.api.VMs == {}
 
         apply_task(tasks.create_vm,
-                   [vm, xs, templ, None, None, None, None, None, None],
+                   [vm.pk, xs.pk, templ.pk,
+                    None, None, None, None, None, None],
                    {'extra_network_bridges': []})
 
         vm.refresh_from_db()
@@ -118,7 +130,8 @@ class TestCreateVM(object):
         assert xsh.api.VMs == {}
 
         apply_task(tasks.create_vm,
-                   [vm, xs, templ, None, None, None, None, None, None],
+                   [vm.pk, xs.pk, templ.pk,
+                    None, None, None, None, None, None],
                    {'extra_network_bridges': ['xenbr1']})
 
         vm.refresh_from_db()
@@ -190,9 +203,354 @@ class TestUpdateVms(object):
         apply_task(tasks.updateVms)
         assert sorted(us_calls) == ['xs01.local', 'xs02.local', 'xs03.local']
 
+    def test_pool_inventory_once(self, xs_helper, task_catcher):
+        """
+        Every server is updated, but we only fetch the inventory through the
+        first server in each pool.
+        """
+        _, xs01 = xs_helper.new_host('xs01.local')
+        _, xs02 = xs_helper.new_host('xs02.local')
+        _, xs03 = xs_helper.new_host('xs03.local')
+        XenServer.objects.filter(pk__in=[xs01.pk, xs02.pk]).update(
+            pool_uuid='pool-a')
+        us_calls = task_catcher.catch_async(
+            tasks.updateServer,
+            lambda args, kwargs: (
+                XenServer.objects.get(pk=args[0]).hostname,
+                kwargs['inventory']))
+        apply_task(tasks.updateVms)
+        assert sorted(us_calls) == [
+            ('xs01.local', True), ('xs02.local', False), ('xs03.local', True)]
+
+    def test_pool_leader_failing(self, xs_helper, task_catcher):
+        """
+        A server that is failing its polls (such as a pool's old master)
+        doesn't lead its pool.
+        """
+        _, xs01 = xs_helper.new_host('xs01.local')
+        _, xs02 = xs_helper.new_host('xs02.local')
+        XenServer.objects.filter(pk__in=[xs01.pk, xs02.pk]).update(
+            pool_uuid='pool-a')
+        XenServer.objects.filter(pk=xs01.pk).update(poll_failures=2)
+        us_calls = task_catcher.catch_async(
+            tasks.updateServer,
+            lambda args, kwargs: (
+                XenServer.objects.get(pk=args[0]).hostname,
+                kwargs['inventory']))
+        apply_task(tasks.updateVms)
+        assert sorted(us_calls) == [
+            ('xs01.local', False), ('xs02.local', True)]
+
+
+@pytest.mark.django_db
+class TestPollScheduling(object):
+    """
+    Test the per-server poll schedule kept by updateVms and updateServer.
+    """
+
+    def catch_polls(self, task_catcher):
+        calls = []
+        task_catcher.mp.setattr(
+            tasks.updateServer, 'apply_async',
+            lambda args, kwargs, countdown, expires: calls.append(
+                (XenServer.objects.get(pk=args[0]).hostname, countdown)))
+        return calls
+
+    def test_new_servers_spread(self, xs_helper, task_catcher, settings):
+        """
+        Servers we've never polled start at random points in the interval.
+        """
+        for i in range(10):
+            xs_helper.new_host('xs%02d.local' % (i,))
+        calls = self.catch_polls(task_catcher)
+        apply_task(tasks.updateVms)
+        assert len(calls) == 10
+        countdowns = [countdown for _, countdown in calls]
+        assert all(0 <= c <= settings.XENZEN_POLL_INTERVAL
+                   for c in countdowns)
+        assert len(set(countdowns)) > 1
+
+    def test_stale_polls_expire(self, xs_helper, task_catcher, settings):
+        """
+        Poll messages expire a little while after they were due to run.
+        """
+        xs_helper.new_host('xs01.local')
+        calls = []
+        task_catcher.mp.setattr(
+            tasks.updateServer, 'apply_async',
+            lambda args, kwargs, countdown, expires: calls.append(
+                (countdown, expires)))
+        apply_task(tasks.updateVms)
+        [(countdown, expires)] = calls
+        assert expires == countdown + settings.XENZEN_POLL_EXPIRES
+
+    def test_due_servers(self, xs_helper, task_catcher):
+        """
+        Only servers that are due within this tick are polled, at the time
+        they're due.
+        """
+        now = timezone.now()
+        _, xs01 = xs_helper.new_host('xs01.local')
+        _, xs02 = xs_helper.new_host('xs02.local')
+        _, xs03 = xs_helper.new_host('xs03.local')
+        XenServer.objects.filter(pk=xs01.pk).update(
+            next_poll=now - timedelta(seconds=5))
+        XenServer.objects.filter(pk=xs02.pk).update(
+            next_poll=now + timedelta(seconds=4))
+        XenServer.objects.filter(pk=xs03.pk).update(
+            next_poll=now + timedelta(seconds=30))
+        calls = self.catch_polls(task_catcher)
+        apply_task(tasks.updateVms, [now])
+        assert sorted(calls) == [('xs01.local', 0), ('xs02.local', 4)]
+
+    def test_no_overlap(self, xs_helper, task_catcher):
+        """
+        A server that is still being polled isn't polled again until the
+        poll finishes or its lease expires.
+        """
+        now = timezone.now()
+        _, xs = xs_helper.new_host('xs01.local')
+        XenServer.objects.filter(pk=xs.pk).update(next_poll=now)
+        calls = self.catch_polls(task_catcher)
+        apply_task(tasks.updateVms, [now])
+        apply_task(tasks.updateVms, [now + timedelta(seconds=10)])
+        assert calls == [('xs01.local', 0)]
+
+        # The worker died, so the lease expires.
+        later = now + timedelta(seconds=300)
+        apply_task(tasks.updateVms, [later])
+        assert len(calls) == 2
+
+    def test_lease_released(self, xs_helper, task_catcher, no_urlopen):
+        _, xs = xs_helper.new_host('xs01.local')
+        assert tasks.leasePoll(xs, 0)
+        assert not tasks.leasePoll(xs, 0)
+        apply_task(tasks.updateServer, [xs.pk])
+        assert tasks.leasePoll(xs, 0)
+
+    def test_backoff(self, xs_helper, settings):
+        """
+        Each failed poll doubles the delay before the next one, up to a
+        maximum, and a successful one resets it.
+        """
+        settings.XENZEN_POLL_JITTER = 0
+        now = timezone.now()
+        _, xs = xs_helper.new_host('xs01.local')
+        delays = []
+        for _ in range(6):
+            tasks.finishPoll(xs, failed=True, now=now)
+            delays.append((xs.next_poll - now).total_seconds())
+        assert delays == [120, 240, 480, 900, 900, 900]
+        assert XenServer.objects.get(pk=xs.pk).poll_failures == 6
+
+        tasks.finishPoll(xs, changed=True, now=now)
+        assert (xs.next_poll - now).total_seconds() == 60
+        assert XenServer.objects.get(pk=xs.pk).poll_failures == 0
+
+    def test_quiet_servers_stretch(self, xs_helper, settings):
+        """
+        Servers whose inventory doesn't change are polled less often, until
+        something changes.
+        """
+        settings.XENZEN_POLL_JITTER = 0
+        now = timezone.now()
+        _, xs = xs_helper.new_host('xs01.local')
+        intervals = []
+        for _ in range(6):
+            tasks.finishPoll(xs, now=now)
+            intervals.append(xs.poll_interval)
+        assert intervals == [90, 135, 202, 300, 300, 300]
+        tasks.finishPoll(xs, changed=True, now=now)
+        assert XenServer.objects.get(pk=xs.pk).poll_interval == 60
+
+    def test_no_inventory_no_stretch(
+            self, xs_helper, task_catcher, settings, no_urlopen):
+        """
+        Polls that don't sync the inventory (because a watcher or another
+        server in the pool does) keep the usual interval, so host info and
+        metrics stay fresh.
+        """
+        settings.XENZEN_POLL_JITTER = 0
+        _, xs = xs_helper.new_host('xs01.local')
+        for _ in range(3):
+            apply_task(tasks.updateServer, [xs.pk], {'inventory': False})
+            assert XenServer.objects.get(pk=xs.pk).poll_interval == 60
+        # A full sync that finds nothing changed still stretches it.
+        apply_task(tasks.updateServer, [xs.pk])
+        assert XenServer.objects.get(pk=xs.pk).poll_interval == 90
+
+    def test_failed_poll(self, xs_helper, task_catcher):
+        """
+        A poll of an unreachable server schedules its next poll with backoff.
+        """
+        _, xs = xs_helper.new_host('xs01.local')
+
+        def unreachable(*args):
+            raise socket.error(errno.ECONNREFUSED, 'Connection refused')
+        task_catcher.mp.setattr(tasks, 'getSession', unreachable)
+        with pytest.raises(socket.error):
+            apply_task(tasks.updateServer, [xs.pk])
+        xs = XenServer.objects.get(pk=xs.pk)
+        assert xs.poll_failures == 1
+        assert xs.next_poll is not None
+        assert xs.poll_lease is None
+
+
+@pytest.mark.django_db
+class TestXenserverSession(object):
+    """
+    Test xenserver.tasks.xenserverSession.
+    """
+
+    def test_deadline(self, xs_helper):
+        """
+        Calls made after the session's deadline has passed raise
+        xenapi.Timeout.
+        """
+        _, xs = xs_helper.new_host('xs01.local')
+        with tasks.xenserverSession(xs, deadline=60) as session:
+            session.xenapi.host.get_all()
+        with pytest.raises(xenapi.Timeout):
+            with tasks.xenserverSession(xs, deadline=-1) as session:
+                session.xenapi.host.get_all()
+        assert xenapi.current_deadline() is None
+
+    def test_read_timeout(self, xs_helper):
+        """
+        A read_timeout replaces the usual one for the calls in the block.
+        """
+        xsh, xs = xs_helper.new_host('xs01.local')
+        timeouts = []
+
+        def get_all(session):
+            timeouts.append(getattr(xenapi.XenAPI._limits, 'read_timeout'))
+            return []
+        xsh.api.handlers['host.get_all'] = get_all
+        with tasks.xenserverSession(xs, read_timeout=600) as session:
+            session.xenapi.host.get_all()
+        with tasks.xenserverSession(xs) as session:
+            session.xenapi.host.get_all()
+        assert timeouts == [600, None]
+
+    def test_power_operations(self, xs_helper, settings):
+        """
+        Power operations, which block until they're done, wait up to
+        XENZEN_XENAPI_OPERATION_TIMEOUT for a response.
+        """
+        settings.XENZEN_XENAPI_OPERATION_TIMEOUT = 321
+        xsh, xs = xs_helper.new_host('xs01.local')
+        vm = xs_helper.new_vm(xs, 'vm01.local')
+        timeouts = []
+
+        def start(session, ref, start_paused, force):
+            timeouts.append(getattr(xenapi.XenAPI._limits, 'read_timeout'))
+            return ''
+        xsh.api.handlers['VM.start'] = start
+        apply_task(tasks.start_vm, [vm.pk])
+        assert timeouts == [321]
+
+
+@pytest.mark.django_db
+class TestGetRecords(object):
+    """
+    Test xenserver.tasks.getRecords.
+    """
+
+    def test_vanished(self, xs_helper):
+        """
+        Objects that have vanished since we listed them are skipped.
+        """
+        xsh, _ = xs_helper.new_host('xs01.local')
+        records = tasks.getRecords(
+            xsh.get_session(), 'host', [xsh.host_ref, 'Ref:host:gone'])
+        assert [record[0] for record in records] == [xsh.host_ref]
+
+    def test_failure(self, xs_helper):
+        """
+        Any other failure is raised.
+        """
+        xsh, _ = xs_helper.new_host('xs01.local')
+
+        def get_record(session, ref):
+            raise xenapi.Failure(['INTERNAL_ERROR', 'oops'])
+        xsh.api.handlers['host.get_record'] = get_record
+        with pytest.raises(xenapi.Failure) as excinfo:
+            tasks.getRecords(xsh.get_session(), 'host', [xsh.host_ref])
+        assert excinfo.value.details[0] == 'INTERNAL_ERROR'
 
-def no_urlopen(url):
-    raise NotImplementedError('urllib2.urlopen() excised for tests.')
+
+@pytest.mark.django_db
+class TestTaskArguments(object):
+    """
+    Tasks are sent primary keys, but still accept model instances from
+    messages queued by older versions.
+    """
+
+    def test_messages_are_json(self, xs_helper, task_catcher):
+        """
+        The polls we queue only carry JSON-serialisable arguments.
+        """
+        xs_helper.new_host('xs01.local')
+        calls = task_catcher.catch_async(
+            tasks.updateServer, lambda args, kwargs: (args, kwargs))
+        apply_task(tasks.updateVms)
+        [(args, kwargs)] = calls
+        assert json.loads(json.dumps([args, kwargs])) == [
+            list(args), kwargs]
+
+    def test_legacy_instances(self, xs_helper, task_catcher, no_urlopen):
+        """
+        A task given a (possibly stale) model instance refetches it.
+        """
+        _, xs = xs_helper.new_host('xs01.local')
+        XenServer.objects.filter(pk=xs.pk).update(poll_failures=3)
+        apply_task(tasks.updateServer, [xs])
+        xs.refresh_from_db()
+        assert xs.poll_failures == 0
+        assert xs.last_full_sync is not None
+
+    def test_deleted_server(self, xs_helper):
+        """
+        Polls for servers that have since been deleted are dropped.
+        """
+        _, xs = xs_helper.new_host('xs01.local')
+        pk = xs.pk
+        xs.delete()
+        apply_task(tasks.updateServer, [pk])
+        assert not XenServer.objects.filter(pk=pk).exists()
+
+
+@pytest.mark.django_db
+class TestNeedsFullSync(object):
+    """
+    Test xenserver.tasks.needsFullSync.
+    """
+
+    def test_no_watcher(self, xs_helper):
+        """
+        Without a live event watcher, every poll is a full sync.
+        """
+        _, xs = xs_helper.new_host('xs01.local')
+        now = timezone.now()
+        assert tasks.needsFullSync(xs, now)
+        xs.event_heartbeat = now - timedelta(minutes=10)
+        xs.last_full_sync = now
+        assert tasks.needsFullSync(xs, now)
+
+    def test_live_watcher(self, xs_helper, settings):
+        """
+        With a live event watcher, we only need a full sync every
+        XENZEN_FULL_SYNC_INTERVAL seconds.
+        """
+        settings.XENZEN_FULL_SYNC_INTERVAL = 900
+        _, xs = xs_helper.new_host('xs01.local')
+        now = timezone.now()
+        xs.event_heartbeat = now
+        assert tasks.needsFullSync(xs, now)
+        xs.last_full_sync = now - timedelta(seconds=899)
+        assert not tasks.needsFullSync(xs, now)
+        xs.last_full_sync = now - timedelta(seconds=901)
+        assert tasks.needsFullSync(xs, now)
 
 
 @pytest.mark.django_db
@@ -201,63 +559,693 @@ class TestUpdateServer(object):
     Test xenserver.tasks.updateServer task.
     """
 
-    def test_first_run(self, xs_helper, task_catcher):
+    def test_first_run(self, xs_helper, task_catcher, no_urlopen):
         """
         The first run of updateServer() after a new host is added will update
-        the two fields that reflect resource usage.
+        the host's free memory, and record the full sync.
 
         NOTE: We stub out urllib2.urlopen() so that it doesn't try to talk to
-        the network. The failure to fetch host metrics is silently ignored.
+        the network. The failure to fetch host metrics is logged, and leaves
+        the CPU utilisation alone.
         """
-        task_catcher.patch_urlopen(no_urlopen)
         _, xs = xs_helper.new_host('xs01.local')
         uv_calls = task_catcher.catch_updateVm()
         xs01before = xs_helper.get_db_xenserver_dict('xs01.local')
-        apply_task(tasks.updateServer, [xs])
+        apply_task(tasks.updateServer, [xs.pk])
         xs01after = xs_helper.get_db_xenserver_dict('xs01.local')
-        # Two fields have changed.
         assert xs01before.pop('mem_free') != xs01after.pop('mem_free')
-        assert xs01before.pop('cpu_util') != xs01after.pop('cpu_util')
+        assert xs01before.pop('last_full_sync') is None
+        assert xs01after.pop('last_full_sync') is not None
+        assert xs01before.pop('pool_uuid') == ''
+        assert xs01after.pop('pool_uuid') != ''
+        # The next poll has been scheduled.
+        assert xs01before.pop('next_poll') is None
+        assert xs01after.pop('next_poll') is not None
+        assert xs01before.pop('poll_interval') is None
+        assert xs01after.pop('poll_interval') is not None
         # All the others are the same.
         assert xs01before == xs01after
         assert uv_calls == []
 
-    def test_one_vm(self, xs_helper, task_catcher):
+    def test_one_vm(self, xs_helper, task_catcher, no_urlopen):
         """
-        If a server has a single VM running on it, we schedule a single
-        updateVm task.
+        If a server has a single VM running on it, we update its XenVM in
+        place rather than scheduling an updateVm task.
 
         NOTE: We stub out urllib2.urlopen() so that it doesn't try to talk to
         the network. The failure to fetch host metrics is silently ignored.
         """
-        task_catcher.patch_urlopen(no_urlopen)
-        _, xs = xs_helper.new_host('xs01.local')
+        xsh, xs = xs_helper.new_host('xs01.local')
         vm = xs_helper.new_vm(xs, 'vm01.local')
         uv_calls = task_catcher.catch_updateVm()
+        vm01before = xs_helper.get_db_xenvm_dict('vm01.local')
 
-        apply_task(tasks.updateServer, [xs])
-        assert_that(uv_calls, MatchesSetOfLists([
-            ('xs01.local', vm.xsref, MatchesVMNamed('vm01.local'))]))
+        apply_task(tasks.updateServer, [xs.pk])
+        vm01after = xs_helper.get_db_xenvm_dict('vm01.local')
+        assert uv_calls == []
+        # The uuid was filled in from the VM record.
+        assert vm01after.pop('uuid') == xsh.api.VMs[vm.xsref]['uuid']
+        vm01before.pop('uuid')
+        assert vm01before.pop('fingerprint') == ''
+        assert vm01after.pop('fingerprint') != ''
+        assert vm01before == vm01after
 
-    def test_two_vms(self, xs_helper, task_catcher):
+    def test_two_vms(self, xs_helper, task_catcher, no_urlopen):
         """
-        If a server has two VMs running on it, we schedule an updateVm task for
-        each.
+        If a server has two VMs running on it, we update both of them.
 
         NOTE: We stub out urllib2.urlopen() so that it doesn't try to talk to
         the network. The failure to fetch host metrics is silently ignored.
         """
-        task_catcher.patch_urlopen(no_urlopen)
-        _, xs = xs_helper.new_host('xs01.local')
+        xsh, xs = xs_helper.new_host('xs01.local')
         vm01 = xs_helper.new_vm(xs, 'vm01.local')
         vm02 = xs_helper.new_vm(xs, 'vm02.local')
+
+        apply_task(tasks.updateServer, [xs.pk])
+        for vm in [vm01, vm02]:
+            assert XenVM.objects.get(pk=vm.pk).uuid == (
+                xsh.api.VMs[vm.xsref]['uuid'])
+
+    def test_new_vms(self, xs_helper, task_catcher, no_urlopen):
+        """
+        VMs we don't know about yet are created, with the address their guest
+        agent reports.
+        """
+        xsh, xs = xs_helper.new_host('xs01.local')
+        vm01 = xsh.api.add_VM('vm01.local', VCPUs_max='2')
+        xsh.api.add_guest_metrics(vm01, {'0/ip': '192.168.199.10'})
+        xsh.api.add_VM('vm02.local', power_state='Halted')
+
+        apply_task(tasks.updateServer, [xs.pk])
+        vms = dict((vm.name, vm) for vm in XenVM.objects.all())
+        assert sorted(vms) == ['vm01.local', 'vm02.local']
+        assert vms['vm01.local'].xsref == vm01
+        assert vms['vm01.local'].sockets == 2
+        assert vms['vm01.local'].memory == 1024
+        assert vms['vm01.local'].ip == '192.168.199.10'
+        assert vms['vm01.local'].xenserver == xs
+        assert vms['vm02.local'].status == 'Halted'
+        assert vms['vm02.local'].ip == ''
+        [address] = Addresses.objects.all()
+        assert address.vm == vms['vm01.local']
+        assert address.ip == '192.168.199.10'
+
+    def test_all_addresses(self, xs_helper, task_catcher, no_urlopen):
+        """
+        Every address a guest reports is added to the address table, using a
+        single call for all the guest metrics.
+        """
+        xsh, xs = xs_helper.new_host('xs01.local')
+        vm01 = xsh.api.add_VM('vm01.local')
+        xsh.api.add_guest_metrics(vm01, {
+            '0/ip': '192.168.199.10',
+            '0/ipv4/0': '192.168.199.10',
+            '0/ipv6/0': 'fe80::1',
+            '1/ip': '192.168.199.11',
+            '2/ip': '10.0.0.1',
+        })
+        vm02 = xsh.api.add_VM('vm02.local')
+        xsh.api.add_guest_metrics(vm02, {'0/ip': '192.168.199.12'})
+
+        apply_task(tasks.updateServer, [xs.pk])
+        vms = dict((vm.name, vm) for vm in XenVM.objects.all())
+        assert vms['vm01.local'].ip == '192.168.199.10'
+        # 10.0.0.1 isn't in any of the zone's pools.
+        assert sorted(Addresses.objects.values_list('ip', 'vm__name')) == [
+            ('192.168.199.10', 'vm01.local'),
+            ('192.168.199.11', 'vm01.local'),
+            ('192.168.199.12', 'vm02.local'),
+        ]
+        assert xsh.api.calls.count('VM_guest_metrics.get_all_records') == 1
+        assert 'VM_guest_metrics.get_record' not in xsh.api.calls
+
+    def test_moved_address(self, xs_helper, task_catcher, no_urlopen):
+        """
+        An address that now belongs to a different VM is moved to it.
+        """
+        xsh, xs = xs_helper.new_host('xs01.local')
+        vm01 = xsh.api.add_VM('vm01.local')
+        xsh.api.add_guest_metrics(vm01, {'0/ip': '192.168.199.10'})
+        apply_task(tasks.updateServer, [xs.pk])
+
+        vm02 = xsh.api.add_VM('vm02.local')
+        xsh.api.add_guest_metrics(vm01, {})
+        xsh.api.add_guest_metrics(vm02, {'0/ip': '192.168.199.10'})
+        apply_task(tasks.updateServer, [xs.pk])
+        [address] = Addresses.objects.all()
+        assert address.vm.name == 'vm02.local'
+
+    def test_unchanged_vms_not_written(
+            self, xs_helper, task_catcher, no_urlopen):
+        """
+        Once a VM's fingerprint is up to date, we don't write it again until
+        something changes.
+        """
+        xsh, xs = xs_helper.new_host('xs01.local')
+        vm01 = xsh.api.add_VM('vm01.local')
+        vm02 = xsh.api.add_VM('vm02.local')
+        networks = {}
+        assert tasks.reconcileVms(xs, xsh.api.VMs, networks) == {
+            'created': 2, 'updated': 0, 'unchanged': 0, 'deleted': 0}
+        assert tasks.reconcileVms(xs, xsh.api.VMs, networks) == {
+            'created': 0, 'updated': 0, 'unchanged': 2, 'deleted': 0}
+
+        xsh.api.VMs[vm01]['power_state'] = 'Halted'
+        del xsh.api.VMs[vm02]
+        assert tasks.reconcileVms(xs, xsh.api.VMs, networks) == {
+            'created': 0, 'updated': 1, 'unchanged': 0, 'deleted': 1}
+        assert XenVM.objects.get(xsref=vm01).status == 'Halted'
+
+    def test_purge(self, xs_helper, task_catcher, no_urlopen):
+        """
+        VMs that have gone away are deleted, except ones we're still
+        provisioning.
+        """
+        xsh, xs = xs_helper.new_host('xs01.local')
+        vm01 = xs_helper.new_vm(xs, 'vm01.local')
+        vm02 = xs_helper.new_vm(xs, 'vm02.local')
+        del xsh.api.VMs[vm02.xsref]
+        templ = xs_helper.db_template("default")
+        provisioning = xs_helper.db_xenvm(
+            xs, 'vm03.local', templ, xsref='TEMPREF-vm03')
+
+        apply_task(tasks.updateServer, [xs.pk])
+        assert sorted(XenVM.objects.values_list('pk', flat=True)) == sorted(
+            [vm01.pk, provisioning.pk])
+
+    def test_filtered_vms(self, xs_helper, task_catcher, no_urlopen):
+        """
+        Templates and the control domain are filtered out by xapi, so we don't
+        create XenVMs for them, and we purge any we already have.
+        """
+        xsh, xs = xs_helper.new_host('xs01.local')
+        vm = xs_helper.new_vm(xs, 'vm01.local')
+        templ = xsh.api.add_VM('template', is_a_template=True)
+        xsh.api.add_VM('dom0', is_control_domain=True)
+        XenVM.objects.create(
+            xsref=templ, name='template', status='Halted', sockets=1,
+            memory=1024, xenserver=xs)
+
+        apply_task(tasks.updateServer, [xs.pk])
+        assert list(XenVM.objects.values_list('xsref', flat=True)) == [
+            vm.xsref]
+        assert 'VM.get_all_records' not in xsh.api.calls
+
+    def test_without_inventory(self, xs_helper, task_catcher, no_urlopen):
+        """
+        If we don't need the inventory, we don't fetch it and we don't purge
+        any VMs.
+        """
+        xsh, xs = xs_helper.new_host('xs01.local')
+        vm = xs_helper.new_vm(xs, 'vm01.local')
+        xsh.api.VMs.clear()
         uv_calls = task_catcher.catch_updateVm()
 
-        apply_task(tasks.updateServer, [xs])
-        assert_that(uv_calls, MatchesSetOfLists([
-            ('xs01.local', vm01.xsref, MatchesVMNamed('vm01.local')),
-            ('xs01.local', vm02.xsref, MatchesVMNamed('vm02.local')),
+        apply_task(tasks.updateServer, [xs.pk], {'inventory': False})
+        assert uv_calls == []
+        assert 'VM.get_all_records_where' not in xsh.api.calls
+        assert XenVM.objects.filter(pk=vm.pk).exists()
+        assert xs_helper.get_db_xenserver('xs01.local').last_full_sync is None
+
+    def test_pool_members(self, xs_helper, task_catcher, no_urlopen):
+        """
+        Every host in the pool that we know, by hostname or address, has its
+        resources recorded from a single fetch of all the host records.
+        """
+        xsh, xs01 = xs_helper.new_host('xs01.local')
+        xsh.get_info().update(hostname='xs01.local', address='10.0.0.1')
+        xsh.api.add_host((1, 2), mem=8*1024*1024*1024, cpu_info={
+            'cpu_count': 4}, hostname='xs02.local', address='10.0.0.2')
+        xsh.api.add_host((1, 2), mem=4*1024*1024*1024, cpu_info={
+            'cpu_count': 2}, hostname='xs03.local', address='10.0.0.3')
+        zone = xs_helper.db_zone('zone1')
+        xs_helper.db_xenserver('xs02.local', zone)
+        xs_helper.db_xenserver('10.0.0.3', zone)
+        xs_helper.db_xenserver('xs04.local', zone)
+
+        apply_task(tasks.updateServer, [xs01.pk])
+        servers = dict(
+            (xs.hostname, xs) for xs in XenServer.objects.all())
+        pool_uuid = servers['xs01.local'].pool_uuid
+        assert pool_uuid != ''
+        assert servers['xs01.local'].cores == HOST_CPUS
+        assert (servers['xs02.local'].cores,
+                servers['xs02.local'].memory,
+                servers['xs02.local'].pool_uuid) == (4, 8*1024, pool_uuid)
+        assert (servers['10.0.0.3'].cores,
+                servers['10.0.0.3'].memory,
+                servers['10.0.0.3'].pool_uuid) == (2, 4*1024, pool_uuid)
+        assert servers['xs04.local'].pool_uuid == ''
+        assert 'host.get_record' not in xsh.api.calls
+        assert 'host_metrics.get_record' not in xsh.api.calls
+
+    def test_no_host_metrics(self, xs_helper, task_catcher, no_urlopen):
+        """
+        If the host has no metrics record, its resources are left as they
+        were, but the rest of the poll goes ahead.
+        """
+        xsh, xs = xs_helper.new_host('xs01.local')
+        XenServer.objects.filter(pk=xs.pk).update(memory=1234)
+        vm = xs_helper.new_vm(xs, 'vm01.local')
+        xsh.api.VMs[vm.xsref]['name_label'] = 'vm02.local'
+        xsh.api.host_metrics.clear()
+
+        apply_task(tasks.updateServer, [xs.pk])
+        xs = XenServer.objects.get(pk=xs.pk)
+        assert (xs.memory, xs.poll_failures) == (1234, 0)
+        assert xs.pool_uuid != ''
+        assert xs.last_full_sync is not None
+        assert XenVM.objects.get(pk=vm.pk).name == 'vm02.local'
+
+    def test_rrd_errors(self, xs_helper, task_catcher):
+        """
+        A broken RRD export leaves the cursor where it was, but the rest of
+        the poll goes ahead. Running out of time fails the poll.
+        """
+        _, xs = xs_helper.new_host('xs01.local')
+        errors = [StringIO('<xport><meta>'), xenapi.Timeout('Too slow')]
+
+        def urlopen(url, timeout=None):
+            error = errors.pop(0)
+            if isinstance(error, Exception):
+                raise error
+            return error
+        task_catcher.patch_urlopen(urlopen)
+
+        apply_task(tasks.updateServer, [xs.pk])
+        xs = XenServer.objects.get(pk=xs.pk)
+        assert (xs.rrd_cursor, xs.poll_failures) == (None, 0)
+        assert xs.last_full_sync is not None
+
+        with pytest.raises(xenapi.Timeout):
+            apply_task(tasks.updateServer, [xs.pk])
+        assert XenServer.objects.get(pk=xs.pk).poll_failures == 1
+
+    def test_rrd_cursor(self, xs_helper, task_catcher, settings):
+        """
+        The first poll fetches a whole window of RRD samples, and later polls
+        only fetch the samples since the newest one we've stored, unless
+        that was too long ago.
+        """
+        xsh, xs = xs_helper.new_host('xs01.local')
+        vm = xs_helper.new_vm(xs, 'vm01.local')
+        legend = ['AVERAGE:host:h:cpu0', 'AVERAGE:vm:%s:cpu0' % (vm.uuid,)]
+        now = int(time.time())
+        exports = [
+            [(now - 60, [0.5, 0.1]), (now - 120, [0.5, 0.2])],
+            [(now, [0.5, 0.3]), (now - 60, [0.5, 0.1])],
+            [(now + 300, [0.5, 0.4]), (now, [0.5, 0.4]),
+             (now - 300, [0.5, 0.9])],
+        ]
+        urls = []
+
+        def urlopen(url, timeout=None):
+            urls.append(url)
+            return rrd_updates(legend, exports.pop(0))
+        task_catcher.patch_urlopen(urlopen)
+
+        def start(url):
+            return int(url.split('&start=')[1].split('&')[0])
+
+        apply_task(tasks.updateServer, [xs.pk])
+        assert abs(start(urls[0]) - (now - settings.XENZEN_RRD_WINDOW)) < 5
+        assert 'interval' not in urls[0]
+        assert XenServer.objects.get(pk=xs.pk).rrd_cursor == now - 60
+
+        apply_task(tasks.updateServer, [xs.pk])
+        assert start(urls[1]) == now - 60
+        assert urls[1].endswith('&interval=%d' % (
+            settings.XENZEN_RRD_INTERVAL,))
+        assert XenServer.objects.get(pk=xs.pk).rrd_cursor == now
+        assert stored_series(vm, 'cpu0') == [
+            (now - 120, pytest.approx(0.2)), (now - 60, pytest.approx(0.1)),
+            (now, pytest.approx(0.3))]
+
+        # After a gap, we fetch the whole window again. It's coarser than
+        # the samples we've kept, so it only fills in around them.
+        XenServer.objects.filter(pk=xs.pk).update(
+            rrd_cursor=now - settings.XENZEN_RRD_MAX_GAP - 60)
+        apply_task(tasks.updateServer, [xs.pk])
+        assert 'interval' not in urls[2]
+        assert stored_series(vm, 'cpu0') == [
+            (now - 300, pytest.approx(0.9)), (now - 120, pytest.approx(0.2)),
+            (now - 60, pytest.approx(0.1)), (now, pytest.approx(0.3)),
+            (now + 300, pytest.approx(0.4))]
+
+    def test_renamed_vm(self, xs_helper, task_catcher, no_urlopen):
+        """
+        A renamed VM keeps its XenVM, and its metrics.
+        """
+        xsh, xs = xs_helper.new_host('xs01.local')
+        vm = xs_helper.new_vm(xs, 'vm01.local')
+        apply_task(tasks.updateServer, [xs.pk])
+        XenMetrics.objects.create(vm=vm, key='cpu0', data='')
+        xsh.api.VMs[vm.xsref]['name_label'] = 'vm02.local'
+        apply_task(tasks.updateServer, [xs.pk])
+        assert list(XenVM.objects.values_list('pk', 'name')) == [
+            (vm.pk, 'vm02.local')]
+        assert XenMetrics.objects.filter(vm=vm).exists()
+
+    def test_migrated_vm(self, xs_helper, task_catcher, no_urlopen):
+        """
+        A VM that shows up on another server, with a new ref, is moved
+        rather than recreated.
+        """
+        xsh01, xs01 = xs_helper.new_host('xs01.local')
+        xsh02, xs02 = xs_helper.new_host('xs02.local')
+        vm = xs_helper.new_vm(xs01, 'vm01.local')
+        record = xsh01.api.VMs.pop(vm.xsref)
+        newref = xsh02.api.add_VM(
+            'vm01.local', uuid=record['uuid'], VCPUs_max='4')
+        apply_task(tasks.updateServer, [xs02.pk])
+        apply_task(tasks.updateServer, [xs01.pk])
+        [moved] = XenVM.objects.all()
+        assert (moved.pk, moved.xenserver, moved.xsref, moved.sockets) == (
+            vm.pk, xs02, newref, 4)
+
+    def test_pool_purge(self, xs_helper):
+        """
+        The inventory covers the whole pool, so VMs on other servers in the
+        pool that it doesn't have, and duplicates of ones it does, are
+        deleted.
+        """
+        xsh, xs01 = xs_helper.new_host('xs01.local')
+        _, xs02 = xs_helper.new_host('xs02.local')
+        _, xs03 = xs_helper.new_host('xs03.local')
+        XenServer.objects.filter(pk__in=[xs01.pk, xs02.pk]).update(
+            pool_uuid='pool-a')
+        xs01.refresh_from_db()
+        templ = xs_helper.db_template('default')
+        xsh.api.add_VM('vm01.local')
+        tasks.reconcileVms(xs01, xsh.api.VMs, {})
+        xs_helper.db_xenvm(xs02, 'gone.local', templ, xsref='Ref:VM:gone')
+        # A uuid-less duplicate, as migration 0010 leaves behind.
+        xs_helper.db_xenvm(xs02, 'vm01.local', templ, xsref='Ref:VM:old')
+        xs_helper.db_xenvm(xs03, 'other.local', templ, xsref='Ref:VM:other')
+
+        assert tasks.reconcileVms(xs01, xsh.api.VMs, {})['deleted'] == 2
+        assert sorted(XenVM.objects.values_list('name', 'xenserver')) == [
+            ('other.local', xs03.pk), ('vm01.local', xs01.pk)]
+
+    def test_duplicate_names(self, xs_helper, task_catcher, no_urlopen):
+        """
+        VMs that share a name are told apart by their uuid, and left alone
+        once they're synced.
+        """
+        xsh, xs = xs_helper.new_host('xs01.local')
+        xsh.api.add_VM('vm01.local')
+        xsh.api.add_VM('vm01.local')
+        apply_task(tasks.updateServer, [xs.pk])
+        pks = sorted(XenVM.objects.values_list('pk', flat=True))
+        assert len(pks) == 2
+        apply_task(tasks.updateServer, [xs.pk])
+        assert sorted(XenVM.objects.values_list('pk', flat=True)) == pks
+
+
+def rrd_updates(legend, rows):
+    """
+    Build an rrd_updates export with the given legend keys and rows of
+    (timestamp, values).
+    """
+    xml = (
+        '<xport><meta><start>0</start><step>5</step><end>10</end>'
+        '<rows>%d</rows><columns>%d</columns><legend>%s</legend></meta>'
+        '<data>%s</data></xport>' % (
+            len(rows), len(legend),
+            ''.join('<entry>%s</entry>' % (key,) for key in legend),
+            ''.join('<row><t>%s</t>%s</row>' % (
+                t, ''.join('<v>%s</v>' % (v,) for v in values))
+                for t, values in rows)))
+    return StringIO(xml.encode('utf-8'))
+
+
+def stored_series(vm, key):
+    """
+    Return the (timestamp, value) points stored for one of a VM's metrics.
+    """
+    times = XenMetricTimes.objects.get(vm=vm).times
+    data = XenMetrics.objects.get(vm=vm, key=key).data
+    return zip(series.decode_times(times), series.decode_values(data))
+
+
+class TestParseRrdUpdates(object):
+    """
+    Test xenserver.tasks.parseRrdUpdates and getHostMetrics.
+    """
+
+    LEGEND = [
+        'AVERAGE:host:h1:cpu0',
+        'AVERAGE:host:h1:cpu1',
+        'AVERAGE:host:h1:cpu_avg',
+        'AVERAGE:host:h1:memory_free_kib',
+        'AVERAGE:vm:vm1:cpu0',
+        'AVERAGE:vm:vm1:memory',
+        'MAX:vm:vm1:cpu0',
+        'AVERAGE:vm:vm2:cpu0',
+    ]
+
+    def test_parse(self):
+        """
+        Host CPU columns are averaged, and each VM's AVERAGE columns are
+        collected by VM uuid and metric, with None for gaps.
+        """
+        cpu, ts, vmstats = tasks.parseRrdUpdates(rrd_updates(self.LEGEND, [
+            (10, [0.5, 0.25, 0.9, 1024, 0.1, 2048, 0.9, 'NaN']),
+            (5, [0.25, 'NaN', 0.9, 1024, 0.2, 2048, 0.9, 0.3]),
         ]))
+        assert cpu == 33
+        assert ts == [10, 5]
+        assert vmstats == {
+            'vm1': {'cpu0': [0.1, 0.2], 'memory': [2048.0, 2048.0]},
+            'vm2': {'cpu0': [None, 0.3]},
+        }
+
+    def test_no_rows(self):
+        """
+        An export without any rows has no CPU usage and empty series.
+        """
+        assert tasks.parseRrdUpdates(rrd_updates(self.LEGEND, [])) == (
+            0, [], {'vm1': {'cpu0': [], 'memory': []}, 'vm2': {'cpu0': []}})
+
+    @pytest.mark.django_db
+    def test_get_host_metrics(self, xs_helper, task_catcher):
+        """
+        getHostMetrics fetches a day of updates from the host and parses them.
+        """
+        xsh, _ = xs_helper.new_host('xs01.local')
+        urls = []
+
+        def urlopen(url, timeout=None):
+            urls.append(url)
+            return rrd_updates(self.LEGEND[:1], [(5, [0.5])])
+        task_catcher.patch_urlopen(urlopen)
+        session = xsh.get_session()
+        assert tasks.getHostMetrics(session, 'xs01.local') == (50, [5], {})
+        [url] = urls
+        assert url.startswith(
+            'http://xs01.local/rrd_updates?session_id=%s&start=' % (
+                session._session,))
+
+
+@pytest.mark.django_db
+class TestStoreMetrics(object):
+    """
+    Test xenserver.tasks.storeMetrics.
+    """
+
+    def test_skip_unchanged(self, xs_helper):
+        _, xs = xs_helper.new_host('xs01.local')
+        vm = xs_helper.new_vm(xs, 'vm01.local')
+        XenVM.objects.filter(pk=vm.pk).update(uuid='vm01-uuid')
+        vmstats = {
+            'vm01-uuid': {'cpu0': [0.5, 0.25], 'memory': [1.0, 2.0]},
+            'unknown-uuid': {'cpu0': [0.1, 0.1]},
+        }
+        assert tasks.storeMetrics([10, 20], vmstats) == {
+            'created': 2, 'updated': 0, 'unchanged': 0}
+        assert tasks.storeMetrics([10, 20], vmstats) == {
+            'created': 0, 'updated': 0, 'unchanged': 2}
+
+        vmstats['vm01-uuid']['cpu0'] = [0.25, 0.75]
+        assert tasks.storeMetrics([20, 30], vmstats) == {
+            'created': 0, 'updated': 2, 'unchanged': 0}
+        assert stored_series(vm, 'cpu0') == [(10, 0.5), (20, 0.25), (30, 0.75)]
+
+    def test_incremental(self, xs_helper):
+        """
+        Incremental samples are merged into the stored series in time order,
+        and points older than the window are dropped.
+        """
+        _, xs = xs_helper.new_host('xs01.local')
+        vm = xs_helper.new_vm(xs, 'vm01.local')
+        XenVM.objects.filter(pk=vm.pk).update(uuid='vm01-uuid')
+        tasks.storeMetrics([20, 10], {'vm01-uuid': {'cpu0': [0.25, 0.125]}})
+        assert stored_series(vm, 'cpu0') == [(10, 0.125), (20, 0.25)]
+
+        assert tasks.storeMetrics(
+            [30, 20], {'vm01-uuid': {'cpu0': [0.375, None]}},
+            incremental=True, oldest=15) == {
+            'created': 0, 'updated': 1, 'unchanged': 0}
+        assert stored_series(vm, 'cpu0') == [(20, None), (30, 0.375)]
+
+        # With no new samples, there's nothing to do.
+        assert tasks.storeMetrics([], {}, incremental=True) == {
+            'created': 0, 'updated': 0, 'unchanged': 0}
+
+    def test_shared_times(self, xs_helper):
+        """
+        A VM's series share its timestamps, with gaps where a series has no
+        samples. A full export only adds the samples after the stored ones.
+        """
+        _, xs = xs_helper.new_host('xs01.local')
+        vm = xs_helper.new_vm(xs, 'vm01.local')
+        XenVM.objects.filter(pk=vm.pk).update(uuid='vm01-uuid')
+        tasks.storeMetrics([10, 20], {'vm01-uuid': {
+            'cpu0': [0.5, 0.25], 'memory': [1.0, 2.0]}})
+        assert tasks.storeMetrics(
+            [30], {'vm01-uuid': {'cpu1': [0.75]}}, incremental=True) == {
+            'created': 1, 'updated': 2, 'unchanged': 0}
+        assert XenMetricTimes.objects.count() == 1
+        assert stored_series(vm, 'cpu0') == [
+            (10, 0.5), (20, 0.25), (30, None)]
+        assert stored_series(vm, 'cpu1') == [
+            (10, None), (20, None), (30, 0.75)]
+
+        tasks.storeMetrics([30, 40], {'vm01-uuid': {'cpu1': [0.5, 0.25]}})
+        assert stored_series(vm, 'cpu0') == [
+            (10, 0.5), (20, 0.25), (30, None), (40, None)]
+        assert stored_series(vm, 'cpu1') == [
+            (10, None), (20, None), (30, 0.75), (40, 0.25)]
+
+
+class TestRollupSeries(object):
+    """
+    Test xenserver.tasks.rollupSeries.
+    """
+
+    def test_buckets(self):
+        times = [0, 60, 120, 300, 360, 600]
+        values = [1.0, 3.0, 2.0, None, 4.0, 5.0]
+        assert tasks.rollupSeries(times, values, 300) == [
+            (0, 1.0, 2.0, 3.0, 2.0),
+            (300, 4.0, 4.0, 4.0, 4.0),
+            (600, 5.0, 5.0, 5.0, 5.0)]
+
+    def test_since_until(self):
+        """
+        Buckets before since, and ones that end after until, are left out.
+        """
+        times = [0, 300, 360, 600]
+        values = [1.0, 2.0, 3.0, 4.0]
+        assert tasks.rollupSeries(
+            times, values, 300, since=300, until=600) == [
+            (300, 2.0, 2.5, 3.0, 3.0)]
+
+
+@pytest.mark.django_db
+class TestCompactMetrics(object):
+    """
+    Test xenserver.tasks.compactMetrics.
+    """
+
+    def rollup(self, vm, key, resolution):
+        rollup = XenMetricRollup.objects.get(
+            vm=vm, key=key, resolution=resolution)
+        return tasks.decodeRollup(rollup)
+
+    def test_compact(self, xs_helper, settings):
+        """
+        Raw samples are folded into each tier once their buckets are
+        complete, and only once.
+        """
+        settings.XENZEN_METRICS_ROLLUPS = ((300, 86400), (3600, 86400))
+        settings.XENZEN_RRD_WINDOW = 7200
+        _, xs = xs_helper.new_host('xs01.local')
+        vm = xs_helper.new_vm(xs, 'vm01.local')
+        XenVM.objects.filter(pk=vm.pk).update(uuid='vm01-uuid')
+        now = 36000
+        ts = range(now - 3600, now + 1, 60)
+        tasks.storeMetrics(ts, {'vm01-uuid': {
+            'cpu0': [float(t % 300) / 300 for t in ts]}})
+
+        assert tasks.compactMetrics(now=now) == {
+            'created': 2, 'updated': 0, 'deleted': 0, 'trimmed': 0}
+        buckets = self.rollup(vm, 'cpu0', 300)
+        assert len(buckets) == 12
+        assert buckets[0] == (
+            now - 3600, 0.0, pytest.approx(0.4), pytest.approx(0.8),
+            pytest.approx(0.8))
+        assert self.rollup(vm, 'cpu0', 3600) == [
+            (now - 3600, 0.0, pytest.approx(0.4), pytest.approx(0.8),
+             pytest.approx(0.8))]
+
+        # Nothing new to fold.
+        assert tasks.compactMetrics(now=now) == {
+            'created': 0, 'updated': 0, 'deleted': 0, 'trimmed': 0}
+
+        tasks.storeMetrics(
+            range(now + 60, now + 301, 60), {'vm01-uuid': {'cpu0': [
+                1.0, 1.0, 1.0, 1.0, 1.0]}}, incremental=True)
+        assert tasks.compactMetrics(now=now + 300) == {
+            'created': 0, 'updated': 1, 'deleted': 0, 'trimmed': 0}
+        assert self.rollup(vm, 'cpu0', 300)[-1] == (
+            now, 0.0, pytest.approx(0.8), 1.0, 1.0)
+
+    def test_retention(self, xs_helper, settings):
+        """
+        Buckets past their retention are dropped, as are the raw samples of
+        VMs that have stopped reporting, and rollups outlive the raw samples
+        they came from.
+        """
+        settings.XENZEN_METRICS_ROLLUPS = ((300, 7200),)
+        settings.XENZEN_RRD_WINDOW = 3600
+        _, xs = xs_helper.new_host('xs01.local')
+        vm = xs_helper.new_vm(xs, 'vm01.local')
+        XenVM.objects.filter(pk=vm.pk).update(uuid='vm01-uuid')
+        ts = range(0, 1801, 60)
+        tasks.storeMetrics(ts, {'vm01-uuid': {'cpu0': [0.5] * len(ts)}})
+        tasks.compactMetrics(now=1800)
+        assert len(self.rollup(vm, 'cpu0', 300)) == 6
+
+        # storeMetrics trims the raw samples of VMs that are still reporting.
+        assert tasks.compactMetrics(now=4500) == {
+            'created': 0, 'updated': 0, 'deleted': 0, 'trimmed': 0}
+        assert [point[0] for point in stored_series(vm, 'cpu0')] == ts
+
+        # Once the VM has stopped reporting, its last bucket is folded too.
+        assert tasks.compactMetrics(now=5500) == {
+            'created': 0, 'updated': 1, 'deleted': 0, 'trimmed': 1}
+        assert [b[0] for b in self.rollup(vm, 'cpu0', 300)] == [
+            0, 300, 600, 900, 1200, 1500, 1800]
+        assert not XenMetricTimes.objects.filter(vm=vm).exists()
+        assert not XenMetrics.objects.filter(vm=vm).exists()
+
+        assert tasks.compactMetrics(now=9100) == {
+            'created': 0, 'updated': 0, 'deleted': 1, 'trimmed': 0}
+        assert not XenMetricRollup.objects.filter(vm=vm).exists()
+
+
+class TestGuestAddresses(object):
+    """
+    Test xenserver.tasks.guestAddresses.
+    """
+
+    def test_order(self):
+        assert tasks.guestAddresses({
+            '1/ip': '10.0.1.1',
+            '0/ipv6/1': 'fe80::2',
+            '0/ipv6/0': 'fe80::1',
+            '0/ip': '10.0.0.1',
+            '0/ipv4/0': '10.0.0.1',
+            '0/ipv4/1': '10.0.0.2',
+        }) == ['10.0.0.1', '10.0.0.2', 'fe80::1', 'fe80::2', '10.0.1.1']
+
+    def test_ignores_other_keys(self):
+        assert tasks.guestAddresses({'0/mac': 'aa:bb', '0/ip': ''}) == []
+
+    def test_primary_ip(self):
+        assert tasks.primaryIp(['fe80::1', '10.0.0.1']) == '10.0.0.1'
+        assert tasks.primaryIp(['fe80::1']) == ''
 
 
 @pytest.mark.django_db
@@ -268,16 +1256,136 @@ class TestUpdateVm(object):
 
     def test_first_run(self, xs_helper, task_catcher):
         """
-        The first run of updateVm() after a new VM is provisioned will update
-        the uuid field.
+        Provisioning a VM records its uuid, so the first run of updateVm()
+        afterwards only records the VM's fingerprint.
         """
         xsh, xs = xs_helper.new_host('xs01.local')
         vm = xs_helper.new_vm(xs, 'vm01.local')
+        assert vm.uuid == xsh.api.VMs[vm.xsref]['uuid']
         vm01before = xs_helper.get_db_xenvm_dict('vm01.local')
         vmobj = xsh.get_session().xenapi.VM.get_record(vm.xsref)
-        apply_task(tasks.updateVm, [xs, vm.xsref, vmobj])
+        apply_task(tasks.updateVm, [xs.pk, vm.xsref, vmobj])
         vm01after = xs_helper.get_db_xenvm_dict('vm01.local')
-        # One field has changed.
-        assert vm01before.pop('uuid') != vm01after.pop('uuid')
+        assert vm01before.pop('fingerprint') != vm01after.pop('fingerprint')
         # All the others are the same.
         assert vm01before == vm01after
+
+    def test_no_uuid_yet(self, xs_helper, task_catcher):
+        """
+        A VM we don't know the uuid of yet is found by its name, and gets its
+        uuid filled in.
+        """
+        xsh, xs = xs_helper.new_host('xs01.local')
+        vm = xs_helper.new_vm(xs, 'vm01.local')
+        XenVM.objects.filter(pk=vm.pk).update(uuid=None, xsref='TEMPREF1')
+        vmobj = xsh.get_session().xenapi.VM.get_record(vm.xsref)
+        apply_task(tasks.updateVm, [xs.pk, vm.xsref, vmobj])
+        [synced] = XenVM.objects.all()
+        assert (synced.pk, synced.uuid, synced.xsref) == (
+            vm.pk, vmobj['uuid'], vm.xsref)
+
+    def test_blank_uuid(self, xs_helper, task_catcher):
+        """
+        Blank uuids, as forms save them, are stored as null, so several VMs
+        can be without one and are still found by their name.
+        """
+        xsh, xs = xs_helper.new_host('xs01.local')
+        vm = xs_helper.new_vm(xs, 'vm01.local')
+        vmref = vm.xsref
+        vm.uuid, vm.xsref = '', 'TEMPREF1'
+        vm.save()
+        other = xs_helper.db_xenvm(
+            xs, 'vm02.local', xs_helper.db_template('default'),
+            xsref='TEMPREF2')
+        other.uuid = ''
+        other.save()
+        assert list(XenVM.objects.values_list('uuid', flat=True)) == [
+            None, None]
+        vmobj = xsh.get_session().xenapi.VM.get_record(vmref)
+        apply_task(tasks.updateVm, [xs.pk, vmref, vmobj])
+        assert XenVM.objects.get(pk=vm.pk).uuid == vmobj['uuid']
+
+    def test_renamed(self, xs_helper, task_catcher):
+        """
+        A renamed VM is updated in place.
+        """
+        xsh, xs = xs_helper.new_host('xs01.local')
+        vm = xs_helper.new_vm(xs, 'vm01.local')
+        xsh.api.VMs[vm.xsref]['name_label'] = 'vm02.local'
+        vmobj = xsh.get_session().xenapi.VM.get_record(vm.xsref)
+        apply_task(tasks.updateVm, [xs.pk, vm.xsref, vmobj])
+        assert list(XenVM.objects.values_list('pk', 'name')) == [
+            (vm.pk, 'vm02.local')]
+
+    def test_synced_through_pool(self, xs_helper, task_catcher):
+        """
+        A VM we already know through another server in its pool is updated
+        rather than duplicated.
+        """
+        _, xs01 = xs_helper.new_host('xs01.local')
+        xsh, xs02 = xs_helper.new_host('xs02.local')
+        vm = xs_helper.new_vm(xs02, 'vm01.local')
+        vmobj = xsh.get_session().xenapi.VM.get_record(vm.xsref)
+        apply_task(tasks.updateVm, [xs01.pk, vm.xsref, vmobj])
+        assert XenVM.objects.get(xsref=vm.xsref).xenserver == xs01
+        assert XenVM.objects.filter(name='vm01.local').count() == 1
+
+
+class TestLogCallStats(object):
+    """
+    Test xenserver.tasks.logCallStats.
+    """
+
+    def test_interval(self, caplog, monkeypatch, settings):
+        """
+        The statistics are logged one line per host and method, at most once
+        per interval.
+        """
+        settings.XENZEN_XENAPI_STATS_INTERVAL = 300
+        caplog.set_level(logging.INFO, logger='xenserver.call_stats')
+        stats = xenapi.CallStats()
+        monkeypatch.setattr(tasks, 'call_stats', stats)
+        monkeypatch.setattr(tasks, 'stats_logged', 1000)
+        stats(xenapi.CallInfo('xs01', 'VM.get_all_records', 0.5, 100, 2000,
+                              1, None))
+        stats(xenapi.CallInfo('xs01', 'host.get_all', 0.25, 50, 80, 0,
+                              xenapi.Timeout('Too slow')))
+
+        assert not tasks.logCallStats(now=1200)
+        assert tasks.logCallStats(now=1300)
+        assert [record.getMessage() for record in caplog.records
+                if record.name == 'xenserver.call_stats'] == [
+            "host=xs01 method=VM.get_all_records calls=1 errors=0 "
+            "retries=1 seconds=0.500 request_bytes=100 response_bytes=2000",
+            "host=xs01 method=host.get_all calls=1 errors=1 retries=0 "
+            "seconds=0.250 request_bytes=50 response_bytes=80",
+        ]
+        assert not tasks.logCallStats(now=1400)
+
+    @pytest.mark.django_db
+    def test_after_tasks(self, monkeypatch):
+        """
+        Worker processes log their statistics as they run tasks.
+        """
+        monkeypatch.setattr(tasks, 'stats_logged', 0)
+        apply_task(tasks.updateVms)
+        assert tasks.stats_logged > 0
+
+
+class TestRouting(object):
+    def test_tasks_routed(self, settings):
+        """
+        Every task is routed to one of the declared queues, and polling never
+        shares a queue with interactive work.
+        """
+        from celery import current_app
+        queues = set(q.name for q in settings.CELERY_QUEUES)
+        names = [name for name in current_app.tasks
+                 if name.startswith('xenserver.tasks.')]
+        assert names
+        for name in names:
+            assert settings.CELERY_ROUTES[name]['queue'] in queues
+        routes = settings.CELERY_ROUTES
+        assert routes['xenserver.tasks.updateServer']['queue'] not in set([
+            routes['xenserver.tasks.start_vm']['queue'],
+            routes['xenserver.tasks.create_vm']['queue']])
@@ -0,0 +1,186 @@
+"""
+Tests for xenapi.PooledTransport and xenapi.ConnectionPool.
+"""
+
+import time
+
+import pytest
+
+import xenapi
+
+
+def new_session(server, pool):
+    transport = xenapi.PooledTransport(pool, use_https=False)
+    session = xenapi.Session(server.url, transport=transport)
+    xs = server.xenserver
+    session.xenapi.login_with_password(xs.username, xs.password)
+    return session
+
+
+class TestPooledTransport(object):
+
+    def test_connection_reused(self, xs_http):
+        """
+        Consecutive calls are made over a single keep-alive connection.
+        """
+        pool = xenapi.ConnectionPool()
+        session = new_session(xs_http, pool)
+        for _ in range(3):
+            session.xenapi.host.get_all()
+        assert xs_http.connections == 1
+        # Login and API version negotiation make five calls, and we made
+        # three more.
+        assert pool.stats() == {
+            'created': 1, 'reused': 7, 'dropped': 0, 'idle': 1}
+
+    def test_connections_shared_between_sessions(self, xs_http):
+        """
+        Sessions with transports that share a pool share its connections.
+        """
+        pool = xenapi.ConnectionPool()
+        new_session(xs_http, pool).xenapi.host.get_all()
+        new_session(xs_http, pool).xenapi.host.get_all()
+        assert xs_http.connections == 1
+
+    def test_half_closed_connection(self, xs_http):
+        """
+        If the server drops an idle connection, we make a new one rather than
+        failing the call.
+        """
+        pool = xenapi.ConnectionPool()
+        session = new_session(xs_http, pool)
+        xs_http.keep_alive = False
+        session.xenapi.host.get_all()
+        session.xenapi.host.get_all()
+        assert session.xenapi.host.get_all() == xs_http.xenserver.hosts.keys()
+        stats = pool.stats()
+        assert stats['dropped'] >= 2
+        assert xs_http.connections == stats['created']
+
+    def test_idle_timeout(self, xs_http):
+        """
+        Connections that have been idle for too long are not reused.
+        """
+        pool = xenapi.ConnectionPool(idle_timeout=-1)
+        session = new_session(xs_http, pool)
+        session.xenapi.host.get_all()
+        assert pool.stats()['reused'] == 0
+        assert xs_http.connections == pool.stats()['created']
+
+    def test_pool_size(self):
+        """
+        No more than maxsize idle connections are kept per host.
+        """
+        pool = xenapi.ConnectionPool(maxsize=1)
+        conns = [pool.get('k', lambda: FakeConnection())[0] for _ in range(3)]
+        for conn in conns:
+            pool.put('k', conn)
+        assert pool.stats()['idle'] == 1
+        assert [c.closed for c in conns] == [False, True, True]
+
+
+class FakeConnection(object):
+    sock = None
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class TestTimeouts(object):
+
+    def test_read_timeout(self, xs_http):
+        """
+        A host that takes too long to respond raises Timeout, not Failure, and
+        its connection isn't reused.
+        """
+        pool = xenapi.ConnectionPool()
+        session = new_session(xs_http, pool)
+        session._ServerProxy__transport.read_timeout = 0.1
+        xs_http.delay = 0.5
+        with pytest.raises(xenapi.Timeout):
+            session.xenapi.host.get_all()
+        assert pool.stats()['idle'] == 0
+
+        xs_http.delay = 0
+        assert session.xenapi.host.get_all() == xs_http.xenserver.hosts.keys()
+
+    def test_read_timeout_override(self, xs_http):
+        """
+        read_timeout() lets calls that are expected to block take longer.
+        """
+        session = new_session(xs_http, xenapi.ConnectionPool())
+        session._ServerProxy__transport.read_timeout = 0.1
+        xs_http.delay = 0.3
+        with xenapi.read_timeout(5):
+            assert session.xenapi.host.get_all() == (
+                xs_http.xenserver.hosts.keys())
+
+    def test_deadline(self, xs_http):
+        """
+        A deadline cuts a slow call short, even without a read timeout.
+        """
+        session = new_session(xs_http, xenapi.ConnectionPool())
+        xs_http.delay = 2
+        start = time.time()
+        with pytest.raises(xenapi.Timeout):
+            with xenapi.deadline(0.2):
+                session.xenapi.host.get_all()
+        assert time.time() - start < 1
+        assert xenapi.current_deadline() is None
+
+    def test_deadline_trickle(self, xs_http):
+        """
+        A response that trickles in can't run much past the deadline.
+        """
+        session = new_session(xs_http, xenapi.ConnectionPool())
+        for i in range(100):
+            xs_http.xenserver.add_VM('vm%02d.local' % (i,))
+        xs_http.trickle = 0.02
+        start = time.time()
+        with pytest.raises(xenapi.Timeout):
+            with xenapi.deadline(0.3):
+                session.xenapi.VM.get_all_records()
+        assert time.time() - start < 1
+
+    def test_nested_deadline(self):
+        """
+        An inner deadline can't extend an outer one.
+        """
+        with xenapi.deadline(1):
+            outer = xenapi.current_deadline()
+            with xenapi.deadline(60):
+                assert xenapi.current_deadline() == outer
+            with xenapi.deadline(0.5):
+                assert xenapi.current_deadline() < outer
+            assert xenapi.current_deadline() == outer
+
+    def test_time_left(self):
+        """
+        A blocking operation gets its own timeout or what's left of the
+        deadline, whichever is shorter, and none once the deadline has
+        passed.
+        """
+        assert xenapi.time_left(None) is None
+        assert xenapi.time_left(5) == 5
+        with xenapi.deadline(1):
+            assert 0 < xenapi.time_left(None) <= 1
+            assert 0 < xenapi.time_left(60) <= 1
+            assert xenapi.time_left(0.5) == 0.5
+        with xenapi.deadline(-1):
+            with pytest.raises(xenapi.Timeout):
+                xenapi.time_left(5)
+
+    def test_batch_deadline(self, xs_http):
+        """
+        Calls made by Session.batch() on other threads share the caller's
+        deadline.
+        """
+        session = new_session(xs_http, xenapi.ConnectionPool())
+        host = xs_http.xenserver.hosts.keys()[0]
+        xs_http.delay = 2
+        start = time.time()
+        with pytest.raises(xenapi.Timeout):
+            with xenapi.deadline(0.2):
+                session.batch([('host.get_record', (host,))] * 4)
+        assert time.time() - start < 1
@@ -2,11 +2,15 @@
 Some quick and dirty tests for a very small subset of the code.
 """
 
+import json
+import time
+
 from django.core.urlresolvers import reverse
 import pytest
 from testtools.assertions import assert_that
 from testtools.matchers import Always, MatchesListwise
 
+from xenserver import tasks
 from xenserver.models import Addresses, XenVM
 from xenserver.tests.helpers import DEFAULT_GATEWAY
 from xenserver.tests.matchers import listmatcher
@@ -39,7 +43,7 @@ class TestProvision(object):
         [vm] = XenVM.objects.all()
 
         assert_that(createvm_calls, MatchesListwise([listmatcher([
-            vm, xs, templ, "foo", "example.com", addr.ip,
+            vm.pk, xs.pk, templ.pk, "foo", "example.com", addr.ip,
             "255.255.255.0", DEFAULT_GATEWAY, Always(), []])]))
 
     def test_provision_second_vif(self, task_catcher, xs_helper, admin_client):
@@ -67,5 +71,120 @@ class TestProvision(object):
         [vm] = XenVM.objects.all()
 
         assert_that(createvm_calls, MatchesListwise([listmatcher([
-            vm, xs, templ, "foo", "example.com", addr.ip,
+            vm.pk, xs.pk, templ.pk, "foo", "example.com", addr.ip,
             "255.255.255.0", DEFAULT_GATEWAY, Always(), ["xenbr1"]])]))
+
+
+@pytest.mark.django_db
+class TestPowerActions(object):
+
+    @pytest.mark.parametrize('view', [
+        'start_vm', 'stop_vm', 'reboot_vm', 'terminate_vm'])
+    def test_status_resynced(self, view, xs_helper, admin_client, settings):
+        """
+        The status a power action sets is replaced by the next sync, even if
+        xapi's record of the VM hasn't changed.
+        """
+        settings.PRETEND_MODE = True
+        xsh, xs = xs_helper.new_host("xs01.local")
+        xsh.api.add_VM("vm01.local")
+        tasks.reconcileVms(xs, xsh.api.VMs, {})
+        [vm] = XenVM.objects.all()
+        status = vm.status
+
+        admin_client.get(reverse(view, args=[vm.pk]))
+        vm.refresh_from_db()
+        assert vm.status != status
+        assert tasks.reconcileVms(xs, xsh.api.VMs, {})['updated'] == 1
+        vm.refresh_from_db()
+        assert vm.status == status
+
+
+@pytest.mark.django_db
+class TestMetrics(object):
+
+    def test_get_metrics(self, xs_helper, admin_client):
+        """
+        A VM's metrics are returned as [ms, value] points, with None for gaps.
+        """
+        _, xs = xs_helper.new_host("xs01.local")
+        vm = xs_helper.new_vm(xs, "vm01.local")
+        XenVM.objects.filter(pk=vm.pk).update(uuid="vm01-uuid")
+        tasks.storeMetrics([10, 20], {"vm01-uuid": {
+            "cpu0": [0.5, None], "memory": [1024.0, 2048.0]}})
+
+        resp = admin_client.get(reverse('get_metrics', args=[vm.pk]))
+        assert resp.status_code == 200
+        assert json.loads(resp.content) == {
+            "cpu0": [[10000, 0.5], [20000, None]],
+            "memory": [[10000, 1024.0], [20000, 2048.0]],
+        }
+
+    def test_no_metrics(self, xs_helper, admin_client):
+        """
+        A VM we haven't stored any metrics for has none.
+        """
+        _, xs = xs_helper.new_host("xs01.local")
+        vm = xs_helper.new_vm(xs, "vm01.local")
+        resp = admin_client.get(reverse('get_metrics', args=[vm.pk]))
+        assert json.loads(resp.content) == {}
+
+    def test_range(self, xs_helper, admin_client):
+        """
+        We can ask for a range of a VM's metrics, downsampled to a number of
+        points.
+        """
+        _, xs = xs_helper.new_host("xs01.local")
+        vm = xs_helper.new_vm(xs, "vm01.local")
+        XenVM.objects.filter(pk=vm.pk).update(uuid="vm01-uuid")
+        now = int(time.time())
+        ts = range(now - 600, now, 60)
+        tasks.storeMetrics(ts, {"vm01-uuid": {
+            "cpu0": [float(i) for i in range(10)]}})
+
+        url = reverse('get_metrics', args=[vm.pk])
+        resp = admin_client.get(url, {
+            "from": (now - 300) * 1000, "to": (now - 120) * 1000})
+        assert json.loads(resp.content) == {"cpu0": [
+            [(now - 300) * 1000, 5.0], [(now - 240) * 1000, 6.0],
+            [(now - 180) * 1000, 7.0], [(now - 120) * 1000, 8.0]]}
+
+        resp = admin_client.get(url, {"max_points": 4})
+        assert json.loads(resp.content) == {"cpu0": [
+            [(now - 600) * 1000, 0.0], [(now - 360) * 1000, 4.0],
+            [(now - 300) * 1000, 5.0], [(now - 60) * 1000, 9.0]]}
+
+        resp = admin_client.get(url, {"max_points": "lots"})
+        assert resp.status_code == 400
+
+    def test_rollups(self, xs_helper, admin_client, settings):
+        """
+        Ranges that reach back past the raw samples come from the finest
+        rollup that covers them, followed by the raw samples that haven't
+        been folded into it yet.
+        """
+        settings.XENZEN_RRD_WINDOW = 3600
+        settings.XENZEN_METRICS_ROLLUPS = ((300, 20000), (3600, 86400))
+        _, xs = xs_helper.new_host("xs01.local")
+        vm = xs_helper.new_vm(xs, "vm01.local")
+        XenVM.objects.filter(pk=vm.pk).update(uuid="vm01-uuid")
+        now = int(time.time())
+        start = now - 7000 - (now - 7000) % 3600
+        ts = range(start, start + 3601, 60)
+        tasks.storeMetrics(ts, {"vm01-uuid": {"cpu0": [0.5] * len(ts)}})
+        tasks.compactMetrics(now=start + 3600)
+
+        url = reverse('get_metrics', args=[vm.pk])
+        resp = admin_client.get(url, {"from": start * 1000})
+        assert [point[0] for point in json.loads(resp.content)["cpu0"]] == [
+            (start + i * 300) * 1000 for i in range(13)]
+        resp = admin_client.get(url, {"from": (now - 30000) * 1000})
+        assert json.loads(resp.content)["cpu0"] == [
+            [start * 1000, 0.5], [(start + 3600) * 1000, 0.5]]
+
+        # Samples stored since the last compaction are included too.
+        tasks.storeMetrics([start + 3660], {"vm01-uuid": {"cpu0": [1.0]}},
+                           incremental=True)
+        resp = admin_client.get(url, {"from": start * 1000})
+        assert json.loads(resp.content)["cpu0"][-2:] == [
+            [(start + 3600) * 1000, 0.5], [(start + 3660) * 1000, 1.0]]
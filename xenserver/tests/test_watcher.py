@@ -0,0 +1,206 @@
+"""
+Tests for xenserver.watcher.EventWatcher.
+"""
+
+import threading
+from StringIO import StringIO
+
+from django.core.management import call_command
+import pytest
+
+from xenserver.management.commands import xenzen_watch
+from xenserver.models import Addresses, XenServer, XenVM
+from xenserver.tests.helpers import HOST_MEM
+from xenserver.watcher import EventWatcher
+
+
+def new_watcher(xs_helper, hostname='xs01.local'):
+    xsh, xs = xs_helper.new_host(hostname)
+    watcher = EventWatcher(xs)
+    watcher.host_ref = xsh.host_ref
+    return xsh, xs, watcher
+
+
+def vm_names(xs):
+    return sorted(XenVM.objects.filter(xenserver=xs).values_list(
+        'name', flat=True))
+
+
+@pytest.mark.django_db
+class TestEventWatcher(object):
+
+    def test_initial_snapshot(self, xs_helper):
+        """
+        The first batch of events is a full sync of guest VMs and host info.
+        Templates, the control domain and VMs we don't see are left out.
+        """
+        xsh, xs, watcher = new_watcher(xs_helper)
+        xsh.api.add_VM('vm01.local')
+        xsh.api.add_VM('template', is_a_template=True)
+        xsh.api.add_VM('dom0', is_control_domain=True)
+        xs_helper.db_xenvm(xs, 'gone.local', xs_helper.db_template('default'),
+                           xsref='Ref:VM:gone')
+
+        watcher.poll(xsh.get_session())
+
+        assert vm_names(xs) == ['vm01.local']
+        assert watcher.token == str(len(xsh.api.events))
+        xs.refresh_from_db()
+        assert xs.event_heartbeat is not None
+        assert xs.memory == HOST_MEM
+        assert xs.mem_free == HOST_MEM - 1024
+
+    def test_deltas(self, xs_helper):
+        """
+        After the initial snapshot, only the changes are applied.
+        """
+        xsh, xs, watcher = new_watcher(xs_helper)
+        vm01 = xsh.api.add_VM('vm01.local')
+        session = xsh.get_session()
+        watcher.poll(session)
+
+        vm02 = xsh.api.add_VM('vm02.local')
+        xsh.api.add_guest_metrics(vm01, {'0/ip': '192.168.199.10'})
+        watcher.poll(session)
+        assert vm_names(xs) == ['vm01.local', 'vm02.local']
+        assert XenVM.objects.get(xsref=vm01).ip == '192.168.199.10'
+
+        xsh.api.VMs[vm02]['power_state'] = 'Halted'
+        xsh.api.emit('VM', 'mod', vm02)
+        xsh.api.VMs.pop(vm01)
+        xsh.api.emit('VM', 'del', vm01)
+        watcher.poll(session)
+        assert vm_names(xs) == ['vm02.local']
+        assert XenVM.objects.get(xsref=vm02).status == 'Halted'
+
+    def test_all_addresses(self, xs_helper):
+        """
+        Every address in a guest metrics change is added to the address
+        table, as a full sync would.
+        """
+        xsh, xs, watcher = new_watcher(xs_helper)
+        vm01 = xsh.api.add_VM('vm01.local')
+        session = xsh.get_session()
+        watcher.poll(session)
+
+        xsh.api.add_guest_metrics(vm01, {'0/ip': '192.168.199.10'})
+        watcher.poll(session)
+        metrics = xsh.api.VMs[vm01]['guest_metrics']
+        xsh.api.VM_guest_metrics[metrics]['networks'].update({
+            '0/ipv6/0': 'fe80::1', '1/ip': '192.168.199.11'})
+        xsh.api.emit('VM_guest_metrics', 'mod', metrics)
+        watcher.poll(session)
+        assert XenVM.objects.get(xsref=vm01).ip == '192.168.199.10'
+        assert sorted(Addresses.objects.values_list('ip', 'vm__name')) == [
+            ('192.168.199.10', 'vm01.local'),
+            ('192.168.199.11', 'vm01.local'),
+        ]
+
+    def test_host_metrics(self, xs_helper):
+        """
+        Changes to the host's memory are picked up from host_metrics events.
+        """
+        xsh, xs, watcher = new_watcher(xs_helper)
+        session = xsh.get_session()
+        watcher.poll(session)
+
+        metrics = xsh.get_info()['metrics']
+        xsh.api.host_metrics[metrics]['memory_free'] = 2048*1024*1024
+        xsh.api.emit('host_metrics', 'mod', metrics)
+        watcher.poll(session)
+        xs.refresh_from_db()
+        assert xs.mem_free == 2048
+
+    def test_resume_after_reconnect(self, xs_helper):
+        """
+        A new session carries on from the last token instead of starting
+        over.
+        """
+        xsh, xs, watcher = new_watcher(xs_helper)
+        tokens = []
+
+        def event_from(session, classes, token, timeout):
+            tokens.append(token)
+            return xsh.api.h_event_from(session, classes, token, timeout)
+
+        xsh.api.handlers['event.from'] = event_from
+        xsh.api.add_VM('vm01.local')
+        watcher.poll(xsh.get_session())
+        first_token = watcher.token
+
+        xsh.api.invalidate_sessions()
+        xsh.api.add_VM('vm02.local')
+        watcher.poll(xsh.get_session())
+        assert vm_names(xs) == ['vm01.local', 'vm02.local']
+        assert tokens == ['', first_token]
+
+    def test_class_names(self, xs_helper):
+        """
+        xapi reports event classes in lower case, and we apply them whatever
+        their case.
+        """
+        xsh, xs, watcher = new_watcher(xs_helper)
+        session = xsh.get_session()
+        watcher.poll(session)
+        vm01 = xsh.api.add_VM('vm01.local')
+        xsh.api.add_guest_metrics(vm01, {'0/ip': '192.168.199.10'})
+        assert set(e['class'] for e in xsh.api.events) == set([
+            'vm', 'vm_guest_metrics'])
+        watcher.poll(session)
+        assert XenVM.objects.get(xsref=vm01).ip == '192.168.199.10'
+
+        snapshot = dict(xsh.api.VMs[vm01], name_label='vm02.local')
+        watcher.apply([{'class': 'VM', 'operation': 'mod', 'ref': vm01,
+                        'snapshot': snapshot}])
+        assert vm_names(xs) == ['vm02.local']
+
+    def test_pool(self, xs_helper):
+        """
+        A watcher keeps the inventory of its whole pool, and stands in for a
+        watcher on every server in it.
+        """
+        xsh, xs, watcher = new_watcher(xs_helper)
+        _, xs02 = xs_helper.new_host('xs02.local')
+        XenServer.objects.filter(pk__in=[xs.pk, xs02.pk]).update(
+            pool_uuid='pool-a')
+        xs.refresh_from_db()
+        watcher.xenserver = xs
+        session = xsh.get_session()
+        xs_helper.db_xenvm(
+            xs02, 'gone.local', xs_helper.db_template('default'),
+            xsref='Ref:VM:gone')
+        vm01 = xsh.api.add_VM('vm01.local')
+        watcher.poll(session)
+        assert sorted(XenVM.objects.values_list('name', flat=True)) == [
+            'vm01.local']
+        xs02.refresh_from_db()
+        assert xs02.event_heartbeat is not None
+
+        xsh.api.VMs.pop(vm01)
+        xsh.api.emit('VM', 'del', vm01)
+        XenVM.objects.filter(xsref=vm01).update(xenserver=xs02)
+        watcher.poll(session)
+        assert not XenVM.objects.exists()
+
+
+@pytest.mark.django_db
+class TestWatchCommand(object):
+
+    def test_one_watcher_per_pool(self, xs_helper, monkeypatch):
+        """
+        Every server in a pool gets the same events, so we only watch one.
+        """
+        _, xs01 = xs_helper.new_host('xs01.local')
+        _, xs02 = xs_helper.new_host('xs02.local')
+        xs_helper.new_host('xs03.local')
+        XenServer.objects.filter(pk__in=[xs01.pk, xs02.pk]).update(
+            pool_uuid='pool-a')
+        watched = []
+        lock = threading.Lock()
+
+        def run(self, stop=None):
+            with lock:
+                watched.append(self.xenserver.hostname)
+        monkeypatch.setattr(xenzen_watch.EventWatcher, 'run', run)
+        call_command('xenzen_watch', stdout=StringIO())
+        assert sorted(watched) == ['xs01.local', 'xs03.local']
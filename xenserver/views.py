@@ -1,4 +1,6 @@
+import bisect
 import json
+import time
 import urlparse
 import uuid
 from operator import itemgetter
@@ -8,13 +10,14 @@ from django.contrib.auth.decorators import login_required
 from django.core.urlresolvers import reverse
 from django.db.models import Sum, Max
 from django.forms import CheckboxSelectMultiple, ValidationError
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import (
+    HttpResponse, HttpResponseBadRequest, HttpResponseRedirect)
 from django.shortcuts import render, redirect
 
-from xenserver import forms, tasks, iputil
+from xenserver import forms, tasks, iputil, series
 from xenserver.models import (
-    Addresses, AddressPool, AuditLog, Project, Template, XenMetrics, XenServer,
-    XenVM, Zone)
+    Addresses, AddressPool, AuditLog, Project, Template, XenMetricRollup,
+    XenMetrics, XenMetricTimes, XenServer, XenVM, Zone)
 
 
 def getIp(pool):
@@ -513,10 +516,13 @@ def start_vm(request, id):
 
     if vm.xsref:
         vm.status = 'Starting'
+        # So the next sync writes the real status, even if xapi's record of
+        # the VM hasn't changed.
+        vm.fingerprint = ''
         vm.save()
 
         if not settings.PRETEND_MODE:
-            tasks.start_vm.delay(vm)
+            tasks.start_vm.delay(vm.pk)
 
         log_action(request.user, 3, "Started VM %s on %s" % (
             vm.name,
@@ -536,10 +542,11 @@ def stop_vm(request, id):
 
     if vm.xsref:
         vm.status = 'Stopping'
+        vm.fingerprint = ''
         vm.save()
 
         if not settings.PRETEND_MODE:
-            tasks.shutdown_vm.delay(vm)
+            tasks.shutdown_vm.delay(vm.pk)
 
         log_action(request.user, 3, "Shutdown VM %s on %s" % (
             vm.name,
@@ -559,10 +566,11 @@ def reboot_vm(request, id):
 
     if vm.xsref:
         vm.status = 'Rebooting'
+        vm.fingerprint = ''
         vm.save()
 
         if not settings.PRETEND_MODE:
-            tasks.reboot_vm.delay(vm)
+            tasks.reboot_vm.delay(vm.pk)
 
         log_action(request.user, 3, "Rebooted VM %s on %s" % (
             vm.name,
@@ -582,10 +590,11 @@ def terminate_vm(request, id):
 
     if vm.xsref:
         vm.status = 'Terminating'
+        vm.fingerprint = ''
         vm.save()
 
         if not settings.PRETEND_MODE:
-            tasks.destroy_vm.delay(vm)
+            tasks.destroy_vm.delay(vm.pk)
 
         log_action(request.user, 3, "Terminated VM %s on %s" % (
             vm.name,
@@ -717,8 +726,8 @@ def provision(request):
             # Send provisioning to celery
             if not settings.PRETEND_MODE:
                 tasks.create_vm.delay(
-                    vmobj, server, template, host, domain, ip, netmask,
-                    gateway, url, extra_network_bridges)
+                    vmobj.pk, server.pk, template.pk, host, domain, ip,
+                    netmask, gateway, url, extra_network_bridges)
 
             log_action(request.user, 3, "Provisioned VM %s on %s" % (
                 hostname,
@@ -741,7 +750,7 @@ def complete_provision(request, hostname):
     vm = XenVM.objects.get(name=hostname)
 
     # Send our completion task to Celery
-    tasks.complete_vm.delay(vm)
+    tasks.complete_vm.delay(vm.pk)
 
     return HttpResponse(json.dumps('{}'), content_type="application/json")
 
@@ -772,18 +781,102 @@ def get_preseed(request, id):
     return HttpResponse(seed, content_type="text/plain")
 
 
+def getMetricSeries(vm, start=None, end=None):
+    """
+    Return the VM's metrics between start and end (in seconds), as (times,
+    values, lows, highs) by key. Ranges that reach back past the raw samples
+    come from the finest rollup that still covers them, followed by the raw
+    samples that haven't been folded into it yet.
+    """
+    now = time.time()
+    resolution = None
+    if start is not None and start < now - settings.XENZEN_RRD_WINDOW:
+        tiers = sorted(settings.XENZEN_METRICS_ROLLUPS)
+        resolution = tiers[-1][0]
+        for tier, retention in tiers:
+            if start >= now - retention:
+                resolution = tier
+                break
+
+    def span(times):
+        first = 0
+        last = len(times)
+        if start is not None:
+            first = bisect.bisect_left(times, start)
+        if end is not None:
+            last = bisect.bisect_right(times, end)
+        return first, last
+
+    d = {}
+    try:
+        raw_times = list(series.decode_times(
+            XenMetricTimes.objects.get(vm=vm).times))
+    except XenMetricTimes.DoesNotExist:
+        raw_times = []
+    raw = dict((m.key, series.decode_values(m.data))
+               for m in XenMetrics.objects.filter(vm=vm))
+
+    if resolution is None:
+        first, last = span(raw_times)
+        for key, values in raw.items():
+            md = values[first:last]
+            d[key] = (raw_times[first:last], md, md, md)
+        return d
+
+    rollups = dict(
+        (r.key, r) for r in XenMetricRollup.objects.filter(
+            vm=vm, resolution=resolution))
+    for key in set(rollups).union(raw):
+        t, md, lows, highs = [], [], [], []
+        since = 0
+        r = rollups.get(key)
+        if r is not None:
+            t = list(series.decode_times(r.times))
+            md, lows, highs = [series.decode_values(blob)
+                               for blob in (r.average, r.minimum, r.maximum)]
+            if t:
+                since = t[-1] + resolution
+        # Compaction only folds complete buckets, so the newest samples are
+        # still raw.
+        if key in raw:
+            keep = bisect.bisect_left(raw_times, since)
+            tail = raw[key][keep:]
+            t += raw_times[keep:]
+            md += tail
+            lows += tail
+            highs += tail
+        first, last = span(t)
+        d[key] = (t[first:last], md[first:last], lows[first:last],
+                  highs[first:last])
+    return d
+
+
 @login_required
 def get_metrics(request, id):
+    """
+    Return the VM's metrics as [ms, value] points by key. The from and to
+    parameters (in ms) limit the range, and each series is downsampled to at
+    most max_points points (XENZEN_METRICS_MAX_POINTS by default).
+    """
     vm = XenVM.objects.get(id=id)
 
-    metrics = XenMetrics.objects.filter(vm=vm)
+    try:
+        start = end = None
+        if request.GET.get('from'):
+            start = int(request.GET['from']) // 1000
+        if request.GET.get('to'):
+            end = int(request.GET['to']) // 1000
+        max_points = max(2, int(request.GET.get(
+            'max_points', settings.XENZEN_METRICS_MAX_POINTS)))
+    except ValueError:
+        return HttpResponseBadRequest(
+            "from, to and max_points must be integers")
 
     d = {}
 
-    for m in metrics:
-        t = json.loads(m.timeblob)
-        md = json.loads(m.datablob)
+    for key, (t, md, lows, highs) in getMetricSeries(vm, start, end).items():
+        points = series.downsample(t, md, max_points, lows, highs)
 
-        d[m.key] = [[i*1000, j] for i, j in zip(t, md)]
+        d[key] = [[i*1000, j] for i, j in points]
 
     return HttpResponse(json.dumps(d), content_type="application/json")
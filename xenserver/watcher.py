@@ -0,0 +1,167 @@
+"""
+Keep the inventory in sync by following each XenServer's event stream.
+
+Rather than downloading every VM record on every poll, an EventWatcher asks
+xapi for the changes to the VM, VM_guest_metrics, host and host_metrics
+classes with event.from and applies only those to the database. The first
+call (with an empty token) returns every object, which we treat as a full
+sync. After that we pass the token from the previous batch, so when the
+connection drops we pick up exactly where we left off.
+"""
+
+import logging
+import threading
+
+from django.conf import settings
+from django.utils import timezone
+
+import xenapi
+from xenserver import tasks
+from xenserver.models import XenServer
+
+
+logger = logging.getLogger(__name__)
+
+
+EVENT_CLASSES = ['VM', 'VM_guest_metrics', 'host', 'host_metrics']
+
+
+class EventWatcher(object):
+    """
+    Follow event.from for a single XenServer and apply the changes it reports
+    to the database.
+    """
+
+    def __init__(self, xenserver, timeout=30, retry_delay=10):
+        self.xenserver = xenserver
+        self.timeout = timeout
+        self.retry_delay = retry_delay
+        self.token = ''
+        self.host_ref = None
+        self.host = None
+        self.host_metrics = {}
+        # Guest VM records by ref, and guest metrics networks by ref, so we
+        # can rebuild a VM's addresses when either of them changes.
+        self.vms = {}
+        self.guest_networks = {}
+
+    def run(self, stop=None):
+        """
+        Watch for events until stop (a threading.Event) is set, reconnecting
+        whenever something goes wrong.
+        """
+        if stop is None:
+            stop = threading.Event()
+        while not stop.is_set():
+            try:
+                with tasks.xenserverSession(self.xenserver) as session:
+                    self.host_ref = tasks.findHost(
+                        session, self.xenserver.hostname)
+                    while not stop.is_set():
+                        self.poll(session)
+            except Exception:
+                logger.exception(
+                    "Lost event stream for %s, reconnecting in %ss",
+                    self.xenserver.hostname, self.retry_delay)
+                stop.wait(self.retry_delay)
+
+    def poll(self, session):
+        """
+        Wait for the next batch of events and apply it.
+        """
+        initial = not self.token
+        # The initial call returns every object, so there's no need to wait.
+        timeout = 0.0 if initial else float(self.timeout)
+        event_from = getattr(session.xenapi.event, 'from')
+        # event.from blocks for up to the timeout we give it, so the response
+        # may take that much longer than usual.
+        with xenapi.read_timeout(
+                timeout + settings.XENZEN_XENAPI_READ_TIMEOUT):
+            result = event_from(EVENT_CLASSES, self.token, timeout)
+        self.apply(result['events'], initial=initial)
+        self.token = result['token']
+        # The event stream covers the whole pool, so this watcher stands in
+        # for one on every server in it.
+        servers = XenServer.objects.filter(pk=self.xenserver.pk)
+        if self.xenserver.pool_uuid:
+            servers = XenServer.objects.filter(
+                pool_uuid=self.xenserver.pool_uuid)
+        servers.update(event_heartbeat=timezone.now())
+        tasks.logCallStats()
+
+    def apply(self, events, initial=False):
+        """
+        Apply a batch of events to the database. If initial is true, the batch
+        is a snapshot of every object and any VM not in it is purged.
+        """
+        if initial:
+            self.vms = {}
+            self.guest_networks = {}
+        changed = set()
+        deleted = set()
+        host_changed = False
+
+        for event in events:
+            # xapi reports class names in lower case, whatever case we
+            # asked for them in.
+            cls, ref = event['class'].lower(), event['ref']
+            snapshot = event.get('snapshot')
+            if event['operation'] == 'del':
+                snapshot = None
+
+            if cls == 'vm':
+                if snapshot is None or not tasks.isGuest(snapshot):
+                    self.vms.pop(ref, None)
+                    deleted.add(ref)
+                    changed.discard(ref)
+                else:
+                    self.vms[ref] = snapshot
+                    changed.add(ref)
+                    deleted.discard(ref)
+            elif cls == 'vm_guest_metrics':
+                if snapshot is None:
+                    self.guest_networks.pop(ref, None)
+                else:
+                    self.guest_networks[ref] = snapshot.get('networks', {})
+                changed.update(vmref for vmref, vm in self.vms.items()
+                               if vm.get('guest_metrics') == ref)
+            elif cls == 'host' and ref == self.host_ref:
+                if snapshot is not None:
+                    self.host = snapshot
+                    host_changed = True
+            elif cls == 'host_metrics':
+                if snapshot is None:
+                    self.host_metrics.pop(ref, None)
+                else:
+                    self.host_metrics[ref] = snapshot
+                    if self.host and self.host.get('metrics') == ref:
+                        host_changed = True
+
+        addresses = {}
+        for vmref in changed:
+            addresses[vmref] = self.vm_addresses(vmref)
+            tasks.syncVm(
+                self.xenserver, vmref, self.vms[vmref],
+                tasks.primaryIp(addresses[vmref]))
+        tasks.reconcileAddresses(self.xenserver, addresses)
+        if deleted:
+            tasks.poolVms(self.xenserver).filter(xsref__in=deleted).delete()
+        if initial:
+            tasks.purgeVms(self.xenserver, self.vms.keys())
+        if host_changed:
+            self.update_host()
+
+    def vm_addresses(self, vmref):
+        networks = self.guest_networks.get(
+            self.vms[vmref].get('guest_metrics'), {})
+        return tasks.guestAddresses(networks)
+
+    def update_host(self):
+        metrics = self.host_metrics.get(self.host.get('metrics'))
+        if metrics is None:
+            return
+        XenServer.objects.filter(pk=self.xenserver.pk).update(
+            cores=int(self.host['cpu_info']['cpu_count']),
+            memory=int(metrics['memory_total']) / 1048576,
+            mem_free=int(metrics['memory_free']) / 1048576,
+        )